@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+"""
+Compares the analysis backends on a local memory capture.
+
+The capture and its rekall profile are put where a download would have put
+them, and the plugins are run with each backend: rekall in the
+threatresponse/rekall container ('docker') and volatility3 in this process
+('native').  Uploads go to the S3 stand-in of benchmarks/fakes.py, so no
+AWS account is needed, but the docker backend needs a docker daemon and the
+native backend volatility3 and ISF symbols for the capture's kernel; see
+volatility_symbols_dir.
+
+The wall time of each backend, the size of its output and the peak memory
+allocated by this process (tracemalloc) are reported.  The memory of the
+rekall container is not included.
+
+Usage:
+    python benchmarks/analysis.py --capture PATH --profile ZIP
+        [--backends docker,native] [--json PATH]
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import time
+import tracemalloc
+
+from unittest import mock
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, ROOT)
+
+from benchmarks.fakes import FakeS3  # noqa: E402
+from benchmarks.fakes import get_instance_ids  # noqa: E402
+from ssm_acquire.analyze import get_analyzer  # noqa: E402
+from ssm_acquire.config import analyze_backends  # noqa: E402
+
+
+_CREDENTIALS = {'Credentials': {
+    'AccessKeyId': 'AKIAFAKE',
+    'SecretAccessKey': 'fake',
+    'SessionToken': 'fake'
+}}
+
+
+def _stage(instance_id, capture, profile):
+    """Links the capture and profile into the download directory."""
+    directory = '/tmp/{}'.format(instance_id)
+
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+
+    capture_name = 'capture.aff4' if capture.endswith('.aff4') else 'capture.elf'
+
+    os.symlink(os.path.abspath(capture), os.path.join(directory, capture_name))
+    shutil.copy(profile, directory)
+
+    return directory
+
+
+def _measure(backend, capture, profile):
+    instance_id = get_instance_ids(1)[0]
+    directory = _stage(instance_id, capture, profile)
+    s3_client = FakeS3()
+
+    tracemalloc.start()
+    started = time.time()
+
+    try:
+        with mock.patch('boto3.client', return_value=s3_client), \
+                mock.patch.dict(os.environ, {
+                    'SSM_ACQUIRE_ASSET_BUCKET': 'ssm-acquire-benchmark'
+                }):
+            get_analyzer(instance_id, _CREDENTIALS, backend).run_rekall_plugins()
+    finally:
+        wall = time.time() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return {
+        'wall_s': round(wall, 3),
+        'peak_mib': round(peak / 1024.0 / 1024.0, 2),
+        'output_bytes': dict(
+            (key.split('/')[-1], len(fake_object.body))
+            for key, fake_object in s3_client.objects.items()
+        )
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--capture', required=True)
+    parser.add_argument('--profile', required=True,
+        help='The rekall profile zip for the docker backend.')
+    parser.add_argument('--backends', default=','.join(analyze_backends))
+    parser.add_argument('--json', help='Write the results to this file.')
+    args = parser.parse_args(argv)
+
+    results = {}
+
+    for backend in [b.strip() for b in args.backends.split(',') if b.strip()]:
+        if backend not in analyze_backends:
+            parser.error('Unknown backend: {}'.format(backend))
+
+        result = results[backend] = _measure(backend, args.capture, args.profile)
+
+        print('{:<8} {:>9.2f} s {:>9.2f} MiB  {}'.format(
+            backend,
+            result['wall_s'],
+            result['peak_mib'],
+            ', '.join(
+                '{} {} B'.format(name, size)
+                for name, size in sorted(result['output_bytes'].items())
+            )
+        ))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,512 @@
+"""
+Local stand-ins for SSM, S3 and docker, for benchmarks/orchestration.py.
+
+The stand-ins implement the calls ssm_acquire makes, with the same request
+and response shapes as boto3 and docker-py, and count every call by
+operation.  Latencies are simulated with sleeps, so the polling loops and
+thread pools of ssm_acquire behave as they would against AWS while the
+benchmark measures their overhead.
+"""
+import hashlib
+import io
+import json
+import os
+import shlex
+import threading
+import time
+import uuid
+
+from botocore.exceptions import ClientError
+
+
+def _client_error(code, operation, message=''):
+    return ClientError(
+        {'Error': {'Code': code, 'Message': message or code}},
+        operation
+    )
+
+
+class _CallCounter(object):
+    """Counts the calls of a fake client by operation, across threads."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def count(self, operation):
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+
+    def total(self):
+        with self.lock:
+            return sum(self.calls.values())
+
+    def reset(self):
+        with self.lock:
+            self.calls.clear()
+
+
+class _RateLimit(object):
+    """
+    Token bucket that allows rate calls per second on average, in bursts of
+    up to rate calls.  A rate of None never throttles.
+    """
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.tokens = rate or 0
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def allow(self):
+        if not self.rate:
+            return True
+
+        with self.lock:
+            now = time.time()
+            self.tokens = min(
+                self.rate,
+                self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+
+            if self.tokens < 1:
+                return False
+
+            self.tokens -= 1
+
+            return True
+
+
+class _Paginator(object):
+    """
+    Splits the result of method into pages of page_size items.  on_page is
+    called before every page, since every page is an API call of its own.
+    """
+    def __init__(self, method, result_key, page_size, on_page):
+        self.method = method
+        self.result_key = result_key
+        self.page_size = page_size
+        self.on_page = on_page
+
+    def paginate(self, **kwargs):
+        self.on_page()
+
+        items = self.method(**kwargs)
+
+        for start in range(0, max(len(items), 1), self.page_size):
+            if start:
+                self.on_page()
+
+            yield {self.result_key: items[start:start + self.page_size]}
+
+
+class FakeSSM(object):
+    """
+    SSM client whose commands take registration_latency seconds to show up
+    in get_command_invocation and execution_latency more seconds to succeed.
+    Polls are throttled above throttle_rate calls per second, as SSM does;
+    sends are not, because ssm_acquire does not retry them.
+
+    While a command runs, its output carries @progress markers for a capture
+    of capture_bytes, so the progress reports are exercised as well.
+    """
+    # SSM truncates the output of detailed invocations to this many chars.
+    _DETAILS_LIMIT = 2500
+
+    def __init__(
+        self,
+        registration_latency=0.5,
+        execution_latency=2.0,
+        throttle_rate=None,
+        capture_bytes=1024 ** 3
+    ):
+        self.registration_latency = registration_latency
+        self.execution_latency = execution_latency
+        self.capture_bytes = capture_bytes
+        self.rate_limit = _RateLimit(throttle_rate)
+        self.counter = _CallCounter()
+        self.throttled = 0
+        self.commands = {}
+        self.lock = threading.Lock()
+
+    def _throttle(self, operation):
+        if not self.rate_limit.allow():
+            with self.lock:
+                self.throttled += 1
+            raise _client_error('ThrottlingException', operation, 'Rate exceeded')
+
+    def send_command(self, InstanceIds, DocumentName, Parameters, Comment=''):
+        self.counter.count('ssm.SendCommand')
+
+        command_id = str(uuid.uuid4())
+        sent_at = time.time()
+
+        with self.lock:
+            self.commands[command_id] = {
+                'instance_ids': list(InstanceIds),
+                'sent_at': sent_at,
+                'cancelled': set()
+            }
+
+        return {'Command': {
+            'CommandId': command_id,
+            'InstanceIds': list(InstanceIds),
+            'DocumentName': DocumentName,
+            'Comment': Comment,
+            'Parameters': Parameters
+        }}
+
+    def _get_status(self, command, instance_id, now):
+        """Returns the status and output of an invocation, or None."""
+        elapsed = now - command['sent_at'] - self.registration_latency
+
+        if elapsed < 0:
+            return None
+
+        if instance_id in command['cancelled']:
+            return 'Cancelled', ''
+
+        if elapsed >= self.execution_latency:
+            return 'Success', 'Done.\n'
+
+        return 'InProgress', self._get_progress_output(elapsed)
+
+    def _get_progress_output(self, elapsed):
+        """A marker every 5% of the simulated capture that is done."""
+        steps = int(elapsed / self.execution_latency * 20)
+
+        return ''.join(
+            '@progress dump {} {} {}\n'.format(
+                int(self.execution_latency * step / 20),
+                self.capture_bytes * step // 20,
+                self.capture_bytes
+            )
+            for step in range(1, steps + 1)
+        )
+
+    def get_command_invocation(self, CommandId, InstanceId):
+        self.counter.count('ssm.GetCommandInvocation')
+        self._throttle('GetCommandInvocation')
+
+        command = self.commands.get(CommandId)
+
+        result = None
+
+        if command is not None and InstanceId in command['instance_ids']:
+            result = self._get_status(command, InstanceId, time.time())
+
+        if result is None:
+            raise _client_error(
+                'InvocationDoesNotExist',
+                'GetCommandInvocation'
+            )
+
+        status, output = result
+
+        return {
+            'CommandId': CommandId,
+            'InstanceId': InstanceId,
+            'Status': status,
+            'StandardOutputContent': output,
+            'StandardErrorContent': ''
+        }
+
+    def _list_command_invocations(self, CommandId, Details=False):
+        command = self.commands[CommandId]
+        now = time.time()
+        invocations = []
+
+        for instance_id in command['instance_ids']:
+            result = self._get_status(command, instance_id, now)
+
+            if result is None:
+                continue
+
+            invocation = {
+                'CommandId': CommandId,
+                'InstanceId': instance_id,
+                'Status': result[0]
+            }
+
+            if Details:
+                invocation['CommandPlugins'] = [{
+                    'Name': 'aws:runShellScript',
+                    'Output': result[1][-self._DETAILS_LIMIT:]
+                }]
+
+            invocations.append(invocation)
+
+        return invocations
+
+    def _on_list_page(self):
+        self.counter.count('ssm.ListCommandInvocations')
+        self._throttle('ListCommandInvocations')
+
+    def get_paginator(self, operation_name):
+        if operation_name != 'list_command_invocations':
+            raise NotImplementedError(operation_name)
+
+        # ListCommandInvocations returns at most 50 invocations per call.
+        return _Paginator(
+            self._list_command_invocations,
+            'CommandInvocations',
+            50,
+            self._on_list_page
+        )
+
+    def cancel_command(self, CommandId, InstanceIds=None):
+        self.counter.count('ssm.CancelCommand')
+
+        command = self.commands[CommandId]
+
+        with self.lock:
+            command['cancelled'].update(InstanceIds or command['instance_ids'])
+
+        return {}
+
+
+class _FakeObject(object):
+    def __init__(self, body, etag, metadata=None):
+        self.body = body
+        self.etag = etag
+        self.metadata = dict(metadata or {})
+
+
+class FakeS3(object):
+    """
+    In-memory S3 client.  Every call sleeps latency seconds first.  Objects
+    added with the same body share it, so 500 captures cost the memory of
+    one.
+    """
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.counter = _CallCounter()
+        self.objects = {}
+        self.lock = threading.Lock()
+        self._etags = {}
+
+    def _call(self, operation):
+        self.counter.count('s3.{}'.format(operation))
+
+        if self.latency:
+            time.sleep(self.latency)
+
+    def add_object(self, key, body, metadata=None):
+        """Stores an object without counting a call."""
+        with self.lock:
+            # Hashing a shared body once keeps setup cheap at 500 instances.
+            if id(body) not in self._etags:
+                self._etags[id(body)] = '"{}"'.format(
+                    hashlib.md5(body).hexdigest())
+
+            self.objects[key] = _FakeObject(body, self._etags[id(body)], metadata)
+
+    def _get(self, key, operation, code='NoSuchKey'):
+        try:
+            return self.objects[key]
+        except KeyError:
+            raise _client_error(code, operation)
+
+    def _list_objects_v2(self, Bucket, Prefix=''):
+        return [
+            {
+                'Key': key,
+                'Size': len(self.objects[key].body),
+                'ETag': self.objects[key].etag
+            }
+            for key in sorted(self.objects)
+            if key.startswith(Prefix)
+        ]
+
+    def get_paginator(self, operation_name):
+        if operation_name != 'list_objects_v2':
+            raise NotImplementedError(operation_name)
+
+        return _Paginator(
+            self._list_objects_v2,
+            'Contents',
+            1000,
+            lambda: self._call('ListObjectsV2')
+        )
+
+    def head_object(self, Bucket, Key, PartNumber=None):
+        self._call('HeadObject')
+
+        fake_object = self._get(Key, 'HeadObject', code='404')
+
+        return {
+            'ContentLength': len(fake_object.body),
+            'ETag': fake_object.etag,
+            'Metadata': dict(fake_object.metadata)
+        }
+
+    def get_object(self, Bucket, Key, Range=None, IfMatch=None):
+        self._call('GetObject')
+
+        fake_object = self._get(Key, 'GetObject')
+
+        if IfMatch is not None and IfMatch != fake_object.etag:
+            raise _client_error('PreconditionFailed', 'GetObject')
+
+        body = fake_object.body
+
+        if Range is not None:
+            start, _, end = Range[len('bytes='):].partition('-')
+            body = body[int(start):int(end) + 1]
+
+        return {
+            'Body': io.BytesIO(body),
+            'ContentLength': len(body),
+            'ETag': fake_object.etag
+        }
+
+    def download_file(self, Bucket, Key, Filename):
+        self._call('GetObject')
+
+        fake_object = self._get(Key, 'HeadObject', code='404')
+
+        with open(Filename, 'wb') as f:
+            f.write(fake_object.body)
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, ExtraArgs=None):
+        self._call('PutObject')
+
+        metadata = (ExtraArgs or {}).get('Metadata')
+        self.add_object(Key, Fileobj.read(), metadata)
+
+    def upload_file(self, Filename, Bucket, Key, ExtraArgs=None):
+        with open(Filename, 'rb') as f:
+            self.upload_fileobj(f, Bucket, Key, ExtraArgs)
+
+    def put_object(self, Bucket, Key, Body=b'', Metadata=None):
+        self._call('PutObject')
+
+        if hasattr(Body, 'read'):
+            Body = Body.read()
+
+        self.add_object(Key, Body, Metadata)
+
+        return {'ETag': self.objects[Key].etag}
+
+
+def get_rekall_output(plugin, rows):
+    """Returns rekall's JSON rendering of a plugin with rows rows."""
+    output = [['m', {'plugin_name': plugin, 'tool_name': 'rekall'}]]
+
+    output.extend(
+        ['r', {
+            'pid': pid,
+            'ppid': 1,
+            'name': 'process-{}'.format(pid),
+            'start_time': {'epoch': 1546300800 + pid},
+            'plugin': plugin
+        }]
+        for pid in range(1, rows + 1)
+    )
+
+    return json.dumps(output)
+
+
+class FakeContainer(object):
+    """
+    A rekall container.  wait() sleeps for the latency of the container and
+    then writes what the command would have written to the /files volume.
+    """
+    def __init__(self, docker_client, command, volumes):
+        self.docker_client = docker_client
+        self.command = command
+        self.files_dir = next(
+            (host for host, bind in (volumes or {}).items()
+            if bind['bind'] == '/files'),
+            None
+        )
+        self.started = time.time()
+
+    def _host_path(self, path):
+        return os.path.join(self.files_dir, os.path.relpath(path, '/files'))
+
+    def _write(self, path, data):
+        with open(self._host_path(path), 'w') as f:
+            f.write(data)
+
+    def _run(self):
+        args = shlex.split(self.command)
+        rows = self.docker_client.rows
+
+        if args[:2] == ['rekall', 'convert_profile']:
+            self._write(
+                os.path.join('/files', args[3]),
+                json.dumps({'$METADATA': {'ProfileClass': 'Linux'}})
+            )
+        elif args[:2] == ['rekall', '-f']:
+            output = next(
+                arg[len('--output='):] for arg in args
+                if arg.startswith('--output=')
+            )
+            self._write(output, get_rekall_output(args[5], rows))
+        elif args[1].endswith('rekall_session_runner.py'):
+            output_dir, suffix = args[4], args[5]
+
+            for plugin in args[7:]:
+                self._write(
+                    os.path.join(output_dir, '{}-{}-output.json'.format(
+                        plugin,
+                        suffix
+                    )),
+                    get_rekall_output(plugin, rows)
+                )
+
+    def wait(self, timeout=None):
+        self.docker_client.counter.count('docker.wait')
+
+        left = self.docker_client.latency - (time.time() - self.started)
+
+        if left > 0:
+            time.sleep(left)
+
+        self._run()
+
+        return {'StatusCode': 0}
+
+    def logs(self):
+        return b''
+
+    def remove(self):
+        self.docker_client.counter.count('docker.remove')
+
+
+class _FakeContainers(object):
+    def __init__(self, docker_client):
+        self.docker_client = docker_client
+
+    def run(self, image, command, detach=False, volumes=None, **kwargs):
+        self.docker_client.counter.count('docker.run')
+        return FakeContainer(self.docker_client, command, volumes)
+
+
+class _FakeImages(object):
+    def __init__(self, docker_client):
+        self.docker_client = docker_client
+
+    def pull(self, repository, tag=None):
+        self.docker_client.counter.count('docker.pull')
+
+
+class FakeDocker(object):
+    """
+    docker client whose containers take latency seconds and emit rekall
+    JSON with rows rows per plugin.
+    """
+    def __init__(self, latency=0.5, rows=200):
+        self.latency = latency
+        self.rows = rows
+        self.counter = _CallCounter()
+        self.containers = _FakeContainers(self)
+        self.images = _FakeImages(self)
+
+
+def get_instance_ids(count):
+    """Returns count well-formed, distinct instance ids."""
+    return [
+        'i-{:017x}'.format(0xbe0c4000000000000 + number)
+        for number in range(1, count + 1)
+    ]
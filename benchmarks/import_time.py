@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+"""
+Measures the startup cost of ssm_acquire.
+
+Every ssm_acquire module is imported in a fresh interpreter with
+`python -X importtime`, and `ssm_acquire --help` is timed end to end.  The
+best of --repeat runs is reported, in milliseconds.
+
+Usage:
+    python benchmarks/import_time.py [--repeat N] [--json PATH]
+        [--baseline PATH] [--tolerance FRACTION]
+
+With --baseline, the run fails if any measurement is more than --tolerance
+slower than the baseline and at least 5 ms slower, so a module that starts
+importing boto3 or docker at the top level is caught.  Write a baseline with
+--json.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Changes smaller than this are noise.
+_MIN_REGRESSION_MS = 5.0
+
+
+def _get_modules():
+    sys.path.insert(0, ROOT)
+    import ssm_acquire
+
+    return ['ssm_acquire'] + [
+        'ssm_acquire.{}'.format(name) for name in ssm_acquire.__all__
+    ]
+
+
+def _get_timings(statement):
+    """Returns the cumulative import time in ms of every module imported."""
+    output = subprocess.check_output(
+        [sys.executable, '-X', 'importtime', '-c', statement],
+        cwd=ROOT,
+        stderr=subprocess.STDOUT
+    ).decode('utf-8')
+
+    timings = {}
+
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+
+        _, cumulative, name = line[len('import time:'):].split('|')
+        timings[name.strip()] = int(cumulative) / 1000.0
+
+    return timings
+
+
+def _import_time(module, startup_modules):
+    """
+    Returns the cumulative import time of module in ms, and the three
+    slowest modules it pulled in.
+    """
+    timings = _get_timings('import {}'.format(module))
+
+    slowest = sorted(
+        (
+            name for name in timings
+            if not name.startswith('ssm_acquire') and
+            name not in startup_modules
+        ),
+        key=lambda name: -timings[name]
+    )[:3]
+
+    return timings[module], slowest
+
+
+def _help_time():
+    """Returns the wall clock time of `ssm_acquire --help` in ms."""
+    started = time.time()
+
+    subprocess.check_call(
+        [sys.executable, '-m', 'ssm_acquire.cli', '--help'],
+        cwd=ROOT,
+        stdout=subprocess.DEVNULL
+    )
+
+    return (time.time() - started) * 1000.0
+
+
+def _measure(repeat):
+    results = {}
+    heaviest = {}
+
+    # Imported by the interpreter itself, e.g. site.
+    startup_modules = set(_get_timings('pass'))
+
+    for module in _get_modules():
+        runs = [_import_time(module, startup_modules) for _ in range(repeat)]
+        results[module] = min(ms for ms, _ in runs)
+        heaviest[module] = runs[0][1]
+
+    results['ssm_acquire --help'] = min(_help_time() for _ in range(repeat))
+
+    return results, heaviest
+
+
+def _get_regressions(results, baseline, tolerance):
+    regressions = []
+
+    for name, ms in sorted(results.items()):
+        before = baseline.get(name)
+
+        if before is None:
+            continue
+
+        if ms > before * (1 + tolerance) and ms - before >= _MIN_REGRESSION_MS:
+            regressions.append((name, before, ms))
+
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--json', help='Write the results to this file.')
+    parser.add_argument('--baseline', help='Compare against these results.')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args(argv)
+
+    results, heaviest = _measure(max(1, args.repeat))
+
+    for name, ms in sorted(results.items(), key=lambda item: -item[1]):
+        print('{:>9.1f} ms  {:<32} {}'.format(
+            ms,
+            name,
+            ', '.join(heaviest.get(name, []))
+        ))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = _get_regressions(results, json.load(f), args.tolerance)
+
+        for name, before, after in regressions:
+            print('REGRESSION {}: {:.1f} ms -> {:.1f} ms'.format(
+                name,
+                before,
+                after
+            ))
+
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
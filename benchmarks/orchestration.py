@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+"""
+Measures the orchestration of ssm_acquire against local stand-ins.
+
+SSM, S3 and docker are replaced by the fakes in benchmarks/fakes.py, with
+simulated latencies and throttling, and every scenario is run at 1, 10 and
+500 instances:
+
+    ensure_command        one ensure_command per instance, run concurrently
+                          on one event loop as the scheduler runs them
+    ensure_fleet_command  one fleet command, in batches of 50 instances
+    s3_download           S3Manager lists and downloads every instance's
+                          capture and profile with ranged downloads
+    rekall                RekallManager downloads, converts the profile and
+                          runs the plugins in a fake rekall container for
+                          every instance, on --workers threads
+
+For each run the wall time, the API calls made to the fakes and the peak
+memory allocated by Python (tracemalloc) are reported.
+
+Usage:
+    python benchmarks/orchestration.py [--instances 1,10,500]
+        [--scenarios NAME,...] [--registration_latency S]
+        [--execution_latency S] [--throttle_rate N] [--s3_latency S]
+        [--capture_kb N] [--container_latency S] [--rows N] [--workers N]
+        [--json PATH] [--baseline PATH] [--tolerance FRACTION]
+
+With --baseline, the run fails if a scenario is more than --tolerance slower
+or makes more than --tolerance more API calls than in the baseline.  Write a
+baseline with --json.
+"""
+from __future__ import print_function
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, ROOT)
+
+from benchmarks.fakes import FakeDocker  # noqa: E402
+from benchmarks.fakes import FakeS3  # noqa: E402
+from benchmarks.fakes import FakeSSM  # noqa: E402
+from benchmarks.fakes import get_instance_ids  # noqa: E402
+from ssm_acquire.analyze import RekallManager  # noqa: E402
+from ssm_acquire.analyze import S3Manager  # noqa: E402
+from ssm_acquire.command import ensure_command_async  # noqa: E402
+from ssm_acquire.command import ensure_fleet_command  # noqa: E402
+
+
+SCENARIOS = ('ensure_command', 'ensure_fleet_command', 's3_download', 'rekall')
+
+_PROFILE_PATH = os.path.join(
+    ROOT,
+    'tests',
+    'fixtures',
+    '4.14.72-73.55.amzn2.x86_64.zip'
+)
+
+_CREDENTIALS = {'Credentials': {
+    'AccessKeyId': 'AKIAFAKE',
+    'SecretAccessKey': 'fake',
+    'SessionToken': 'fake'
+}}
+
+_BUCKET = 'ssm-acquire-benchmark'
+
+# Changes smaller than this are noise.
+_MIN_REGRESSION_S = 0.25
+
+
+def _get_fake_ssm(args):
+    return FakeSSM(
+        registration_latency=args.registration_latency,
+        execution_latency=args.execution_latency,
+        throttle_rate=args.throttle_rate
+    )
+
+
+def _run_ensure_command(args, instance_ids):
+    ssm_client = _get_fake_ssm(args)
+
+    async def run_all():
+        return await asyncio.gather(*[
+            ensure_command_async(
+                ssm_client,
+                ['true'],
+                instance_id,
+                expected_duration=args.execution_latency
+            )
+            for instance_id in instance_ids
+        ])
+
+    loop = asyncio.new_event_loop()
+
+    try:
+        asyncio.set_event_loop(loop)
+        invocations = loop.run_until_complete(run_all())
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+    return [ssm_client], [invocation['Status'] for invocation in invocations]
+
+
+def _run_ensure_fleet_command(args, instance_ids):
+    ssm_client = _get_fake_ssm(args)
+
+    statuses = ensure_fleet_command(
+        ssm_client,
+        ['true'],
+        instance_ids,
+        expected_duration=args.execution_latency
+    )
+
+    return [ssm_client], list(statuses.values())
+
+
+def _get_fake_s3(args, instance_ids):
+    """Returns an S3 stand-in holding a capture and a profile per instance."""
+    s3_client = FakeS3(latency=args.s3_latency)
+
+    capture = os.urandom(args.capture_kb * 1024)
+
+    with open(_PROFILE_PATH, 'rb') as f:
+        profile = f.read()
+
+    for instance_id in instance_ids:
+        s3_client.add_object('{}/capture.aff4'.format(instance_id), capture)
+        s3_client.add_object(
+            '{}/{}'.format(instance_id, os.path.basename(_PROFILE_PATH)),
+            profile
+        )
+
+    return s3_client
+
+
+@contextlib.contextmanager
+def _patched_clients(s3_client, docker_client=None):
+    """Hands out the fakes wherever ssm_acquire creates a client."""
+    with mock.patch('boto3.client', return_value=s3_client), \
+            mock.patch('docker.from_env', return_value=docker_client):
+        yield
+
+
+def _run_s3_download(args, instance_ids):
+    s3_client = _get_fake_s3(args, instance_ids)
+
+    with _patched_clients(s3_client):
+        s3_manager = S3Manager(_CREDENTIALS, _BUCKET)
+
+        for instance_id in instance_ids:
+            s3_manager.create_instance_directory(instance_id)
+            s3_manager.get_files(
+                s3_manager.list_objects_for_key('{}/'.format(instance_id))
+            )
+
+    return [s3_client], ['Success'] * len(instance_ids)
+
+
+def _run_rekall(args, instance_ids):
+    s3_client = _get_fake_s3(args, instance_ids)
+    docker_client = FakeDocker(
+        latency=args.container_latency,
+        rows=args.rows
+    )
+
+    def analyze(instance_id):
+        analyzer = RekallManager(instance_id, _CREDENTIALS)
+        analyzer.download_incident_data()
+        analyzer.run_rekall_plugins()
+
+        return 'Success'
+
+    with _patched_clients(s3_client, docker_client), \
+            ThreadPoolExecutor(max_workers=args.workers) as executor:
+        statuses = list(executor.map(analyze, instance_ids))
+
+    return [s3_client, docker_client], statuses
+
+
+_RUNNERS = {
+    'ensure_command': _run_ensure_command,
+    'ensure_fleet_command': _run_ensure_fleet_command,
+    's3_download': _run_s3_download,
+    'rekall': _run_rekall
+}
+
+
+@contextlib.contextmanager
+def _sandbox():
+    """
+    Points the settings of ssm_acquire at a scratch directory, so the
+    profile cache and yara rules of the user are not used, and silences the
+    spinner and progress output.
+    """
+    scratch = tempfile.mkdtemp(prefix='ssm-acquire-benchmark-')
+
+    settings = {
+        'SSM_ACQUIRE_ASSET_BUCKET': _BUCKET,
+        'SSM_ACQUIRE_PROFILE_CACHE_DIR': os.path.join(scratch, 'profiles'),
+        'SSM_ACQUIRE_YARA_FILE_DIR': os.path.join(scratch, 'no-yara-files')
+    }
+
+    try:
+        with mock.patch.dict(os.environ, settings), \
+                open(os.devnull, 'w') as devnull, \
+                contextlib.redirect_stdout(devnull):
+            yield
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def _clean_downloads(instance_ids):
+    for instance_id in instance_ids:
+        shutil.rmtree('/tmp/{}'.format(instance_id), ignore_errors=True)
+
+
+def _measure(scenario, args, count):
+    instance_ids = get_instance_ids(count)
+
+    _clean_downloads(instance_ids)
+
+    tracemalloc.start()
+    started = time.time()
+
+    try:
+        with _sandbox():
+            fakes, statuses = _RUNNERS[scenario](args, instance_ids)
+    finally:
+        wall = time.time() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        _clean_downloads(instance_ids)
+
+    calls = {}
+
+    for fake in fakes:
+        calls.update(fake.counter.calls)
+
+    return {
+        'instances': count,
+        'wall_s': round(wall, 3),
+        'api_calls': sum(
+            number for operation, number in calls.items()
+            if not operation.startswith('docker.')
+        ),
+        'calls': calls,
+        'throttled': sum(getattr(fake, 'throttled', 0) for fake in fakes),
+        'peak_mib': round(peak / 1024.0 / 1024.0, 2),
+        'succeeded': statuses.count('Success')
+    }
+
+
+def _get_regressions(results, baseline, tolerance):
+    regressions = []
+
+    for name, result in sorted(results.items()):
+        before = baseline.get(name)
+
+        if before is None:
+            continue
+
+        if result['wall_s'] > before['wall_s'] * (1 + tolerance) and \
+                result['wall_s'] - before['wall_s'] >= _MIN_REGRESSION_S:
+            regressions.append((name, 'wall_s', before['wall_s'], result['wall_s']))
+
+        if result['api_calls'] > before['api_calls'] * (1 + tolerance):
+            regressions.append(
+                (name, 'api_calls', before['api_calls'], result['api_calls'])
+            )
+
+    return regressions
+
+
+def _split(value):
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--instances', default='1,10,500')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--registration_latency', type=float, default=0.5)
+    parser.add_argument('--execution_latency', type=float, default=2.0)
+    parser.add_argument('--throttle_rate', type=float, default=40.0,
+        help='Polls per second SSM allows before throttling.')
+    parser.add_argument('--s3_latency', type=float, default=0.005)
+    parser.add_argument('--capture_kb', type=int, default=256)
+    parser.add_argument('--container_latency', type=float, default=0.05)
+    parser.add_argument('--rows', type=int, default=200,
+        help='Rows of rekall output per plugin.')
+    parser.add_argument('--workers', type=int, default=8,
+        help='Instances analyzed at once in the rekall scenario.')
+    parser.add_argument('--json', help='Write the results to this file.')
+    parser.add_argument('--baseline', help='Compare against these results.')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args(argv)
+
+    scenarios = _split(args.scenarios)
+    unknown = set(scenarios) - set(SCENARIOS)
+
+    if unknown:
+        parser.error('Unknown scenarios: {}'.format(', '.join(sorted(unknown))))
+
+    results = {}
+
+    print('{:<22} {:>9} {:>9} {:>9} {:>10} {:>10}'.format(
+        'scenario', 'instances', 'wall s', 'api calls', 'throttled', 'peak MiB'
+    ))
+
+    for scenario in scenarios:
+        for count in [int(count) for count in _split(args.instances)]:
+            result = _measure(scenario, args, count)
+            results['{}@{}'.format(scenario, count)] = result
+
+            print('{:<22} {:>9} {:>9.2f} {:>9} {:>10} {:>10.2f}{}'.format(
+                scenario,
+                count,
+                result['wall_s'],
+                result['api_calls'],
+                result['throttled'],
+                result['peak_mib'],
+                '' if result['succeeded'] == count else '  ({} of {} '
+                    'succeeded)'.format(result['succeeded'], count)
+            ))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = _get_regressions(results, json.load(f), args.tolerance)
+
+        for name, metric, before, after in regressions:
+            print('REGRESSION {} {}: {} -> {}'.format(name, metric, before, after))
+
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
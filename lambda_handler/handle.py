@@ -1,3 +1,79 @@
-"""Run the same cli functions within lambda for use in stepFunctions."""
+"""
+Run the phases of ssm_acquire within lambda for use in stepFunctions.
+
+Each invocation is one stateless step of ssm_acquire.steps and returns in
+well under a second, so the dump itself is waited for by the state machine
+rather than by a billed Lambda.  The event names the step:
+
+    {"step": "submit", "phase": "dump", "instance_id": "i-...",
+     "region": "us-west-2", "facts": {...}}
+
+returns the state of the submitted command, and
+
+    {"step": "check", "region": "us-west-2", ...state}
+
+reads it once and returns the state again.  A state machine loops over a
+Wait state with "SecondsPath": "$.wait_seconds", the check task and a Choice
+on "$.done".  Run the 'facts' phase first and pass its "facts" on to the
+other phases so that they get the plan for the instance's distro.
+"""
+import logging
+import os
+
+import boto3
+
+from ssm_acquire import steps
+from ssm_acquire import tracing
+from ssm_acquire.credential import get_credentials
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Only /tmp is writable in Lambda.  It outlives an invocation while the
+# container stays warm, so credentials and compiled plans are reused.
+os.environ.setdefault(
+    'SSM_ACQUIRE_CREDENTIAL_CACHE_FILE',
+    '/tmp/ssm_acquire/credentials.json'
+)
+os.environ.setdefault('SSM_ACQUIRE_PLAN_CACHE_DIR', '/tmp/ssm_acquire/plans')
+
+
+def _get_ssm_client(credentials, region):
+    return tracing.instrument(boto3.client(
+        'ssm',
+        aws_access_key_id=credentials['Credentials']['AccessKeyId'],
+        aws_secret_access_key=credentials['Credentials']['SecretAccessKey'],
+        aws_session_token=credentials['Credentials']['SessionToken'],
+        region_name=region
+    ))
+
+
 def handle(event, context):
-    return 200
+    event = dict(event)
+
+    step = event.pop('step', None)
+    region = event.pop('region')
+    instance_id = event['instance_id']
+
+    credentials = get_credentials(region, instance_id)
+    ssm_client = _get_ssm_client(credentials, region)
+
+    if step == 'submit':
+        state = steps.submit(
+            ssm_client,
+            credentials,
+            event['phase'],
+            instance_id,
+            facts=event.get('facts')
+        )
+    elif step == 'check':
+        state = steps.check(ssm_client, event, credentials)
+    else:
+        raise steps.StepError('Unknown step {}.  Choose submit or '
+            'check.'.format(step))
+
+    # The next step needs the region as well.
+    state['region'] = region
+
+    return state
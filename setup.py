@@ -17,6 +17,9 @@ setup_requirements = ['pytest-runner']
 
 test_requirements = ['pytest', 'pytest-watch', 'pytest-cov', 'moto']
 
+# Optional: the native analysis backend (--analyze_backend native).
+extras_requirements = {'native': ['volatility3']}
+
 setup(
     author="Andrew J Krug",
     author_email='andrewkrug@gmail.com',
@@ -25,7 +28,6 @@ setup(
         'Intended Audience :: Developers',
         "License :: OSI Approved :: Mozilla Public License 2.0 (MPL 2.0)",
         'Natural Language :: English',
-        'Programming Language :: Python :: 3.6',
         'Programming Language :: Python :: 3.7',
     ],
     description="A python module for orchestrating content acquisitions and light analysis via amazon ssm.",
@@ -35,8 +37,10 @@ setup(
         ],
     },
     install_requires=requirements,
+    extras_require=extras_requirements,
     license="MIT license",
     long_description=readme + '\n\n' + history,
+    python_requires='>=3.7',
     include_package_data=True,
     keywords='ssm_acquire',
     name='ssm_acquire',
@@ -1,31 +1,56 @@
 # -*- coding: utf-8 -*-
 
-"""Top-level package for ssm_acquire."""
+"""
+Top-level package for ssm_acquire.
+
+Submodules are imported the first time they are used, e.g.
+ssm_acquire.cli, so that importing the package does not pull in boto3,
+docker or jinja2 or read any configuration.
+"""
 
 __author__ = """Andrew J Krug"""
 __email__ = 'andrewkrug@gmail.com'
 __version__ = '0.1.0.5'
 
-from ssm_acquire import acquire
-from ssm_acquire import analyze
-from ssm_acquire import build
-from ssm_acquire import cli
-from ssm_acquire import command
-from ssm_acquire import config
-from ssm_acquire import credential
-from ssm_acquire import interrogate
-from ssm_acquire import jinja2_io
-from ssm_acquire import policy
+import importlib
 
 __all__ = [
-    acquire, 
-    analyze, 
-    build, 
-    cli, 
-    command, 
-    config, 
-    credential, 
-    interrogate, 
-    jinja2_io, 
-    policy
+    'acquire',
+    'analyze',
+    'artifacts',
+    'baseline',
+    'build',
+    'cli',
+    'command',
+    'compression',
+    'config',
+    'credential',
+    'credential_cache',
+    'download',
+    'facts',
+    'fleet',
+    'interrogate',
+    'jinja2_io',
+    'local_build',
+    'policy',
+    'profile_cache',
+    'profile_registry',
+    'progress',
+    'query_pack',
+    'results',
+    'scheduler',
+    'steps',
+    'tracing',
+    'worker'
 ]
+
+
+def __getattr__(name):
+    if name in __all__:
+        return importlib.import_module('{}.{}'.format(__name__, name))
+
+    raise AttributeError('module {} has no attribute {}'.format(__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
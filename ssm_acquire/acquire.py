@@ -1,97 +1,308 @@
+import asyncio
 import logging
-import os.path
-import yaml
 
-from ssm_acquire.command import ensure_command
-from ssm_acquire.jinja2_io import get_jinja2_plan
+from ssm_acquire import tracing
+from ssm_acquire.command import ensure_command_async
+from ssm_acquire.facts import capture_fits
+from ssm_acquire.facts import get_distro
+from ssm_acquire.facts import get_fleet_facts
+from ssm_acquire.facts import get_instance_facts_async
+from ssm_acquire.facts import run_fleet_plan
+from ssm_acquire.facts import select_plan
+from ssm_acquire.jinja2_io import FLEET_INSTANCE_ID
+from ssm_acquire.jinja2_io import get_plans
 
 
 logger = logging.getLogger(__name__)
 
 
-def _get_acquire_plans():
-    dirname = os.path.dirname(__file__)
+def _get_memdump_plans(credentials, instance_id):
+    """
+    Loads the j2-formatted plans to dump the volatile memory of the instance.
+    """
+    j2_file = "acquire-plans/linpmem.yml.j2"
 
-    path = os.path.join(dirname, "acquire-plans/linpmem.yml")
+    return get_plans(credentials, instance_id, j2_file)
 
-    return yaml.safe_load(open(path))
 
+def _get_memdump_plan(instance_id, credentials, distro):
+    """
+    Gets the plan, i.e. the commands and their timeouts, to dump the volatile 
+    memory of the EC2 instance.  The plan is selected for the distro of the 
+    instance; see get_distro.
+    """
+    return select_plan(_get_memdump_plans(credentials, instance_id), distro)
 
-acquire_plans = _get_acquire_plans()
 
+def _get_transfer_plans(credentials, instance_id):
+    """
+    Loads the j2-formatted plans to transfer the memory dump to the asset 
+    bucket.
+    """
+    j2_file = "transfer-plans/linpmem.yml.j2"
 
-def _get_memdump_commands():
+    return get_plans(credentials, instance_id, j2_file)
+
+
+def _get_transfer_plan(instance_id, credentials, distro):
     """
-    TODO: Only supports amzn2 for now.  Add support for other distros.
-    
-    Gets commands to dump the volatile memory of the EC2 instance.
+    Gets the plan to transfer the dumped memory of the EC2 instance to the 
+    asset bucket.
     """
-    return acquire_plans['distros']['amzn2']['commands']
+    return select_plan(_get_transfer_plans(credentials, instance_id), distro)
 
 
-def _dump_EC2_mem(ssm_client, instance_id):
+def _get_stream_plans(credentials, instance_id):
     """
-    Dumps the volatile memory of an EC2 instance to its home directory. 
-    Uses linpmem.
+    Loads the j2-formatted plans to stream the memory dump straight into the 
+    asset bucket.
     """
-    memdump_commands = _get_memdump_commands()
+    j2_file = "acquire-plans/linpmem-stream.yml.j2"
 
-    logger.info('Memory dump in progress for instance: {}.  Please wait.'.\
-        format(instance_id))
-    
-    ensure_command(ssm_client, memdump_commands, instance_id)
+    return get_plans(credentials, instance_id, j2_file)
 
-    logger.info('Memory dump complete.')
 
+def _get_stream_plan(instance_id, credentials, distro):
+    """
+    Gets the plan to dump the volatile memory of the EC2 instance and upload 
+    it to the asset bucket as it is produced.
+    """
+    return select_plan(_get_stream_plans(credentials, instance_id), distro)
 
-def _get_transfer_plans(credentials, instance_id):
+
+def dump_and_transfer(ssm_client, instance_id, credentials, stream=False):
     """
-    Loads the j2-formatted plans to transfer the memory dump to the asset 
-    bucket.
+    Dump and transfer the volatile memory of an EC2 instance to the asset 
+    bucket.  Uses linpmem.  Runs dump_and_transfer_async to completion.
+
+    Returns the final status of the acquisition.
     """
-    j2_file = "transfer-plans/linpmem.yml.j2"
+    return asyncio.run(dump_and_transfer_async(
+        ssm_client, 
+        instance_id, 
+        credentials, 
+        stream=stream
+    ))
 
-    transfer_plan = get_jinja2_plan(credentials, instance_id, j2_file)
 
-    return yaml.safe_load(transfer_plan)
+def _log_insufficient_disk(instance_id, facts):
+    logger.error('Instance {} has {} MiB free in its home directory but {} '
+        'MiB of memory.  Not dumping; retry with --stream.'.format(
+            instance_id,
+            facts['home_free_bytes'] // 2 ** 20,
+            facts['mem_total_bytes'] // 2 ** 20
+        ))
 
 
-def _get_transfer_commands(instance_id, credentials):
+def _combine_plans(*plans):
     """
-    TODO: Only supports amzn2 for now.  Add support for other distros.
-    
-    Gets commands to transfer the dumped memory of the EC2 instance to the 
-    asset bucket.
+    Combines plans into one that runs their commands in order.  The timeouts 
+    and expected durations add up.
     """
-    return _get_transfer_plans(
-        credentials, 
-        instance_id
-    )['distros']['amzn2']['commands']
+    return {
+        'commands': [c for plan in plans for c in plan['commands']],
+        'timeout': sum(plan.get('timeout', 0) for plan in plans) or None,
+        'expected_duration': sum(
+            plan.get('expected_duration', 0) for plan in plans
+        ) or None
+    }
+
+
+@tracing.traced('acquire.fleet')
+def dump_and_transfer_fleet(
+    ssm_client, 
+    instance_ids, 
+    credentials, 
+    stream=False
+):
+    """
+    Dump and transfer the volatile memory of many EC2 instances to the asset 
+    bucket.  Uses linpmem.
+
+    Each instance dumps and transfers in a single SSM step, so a slow dump on 
+    one instance does not hold back the transfer of the others.  Instances 
+    whose home directory cannot hold the dump get the status 
+    'InsufficientDisk' unless stream is set, and instances on a distro 
+    without a plan get 'Unsupported'.
+
+    Returns the final status of the acquisition for each instance id.
+    """
+    print('Acquire mode active for {} instances.  Please give about a '
+        'minute.'.format(len(instance_ids)))
+
+    fleet_facts = get_fleet_facts(ssm_client, instance_ids)
+    statuses = {}
 
+    if stream:
+        def get_acquire_plan(distro):
+            return _get_stream_plan(FLEET_INSTANCE_ID, credentials, distro)
+    else:
+        def get_acquire_plan(distro):
+            return _combine_plans(
+                _get_memdump_plan(FLEET_INSTANCE_ID, credentials, distro), 
+                _get_transfer_plan(FLEET_INSTANCE_ID, credentials, distro)
+            )
 
-def _transfer_mem_to_asset_bucket(ssm_client, instance_id, credentials):
+        for instance_id in instance_ids:
+            if not capture_fits(fleet_facts[instance_id]):
+                _log_insufficient_disk(instance_id, fleet_facts[instance_id])
+                statuses[instance_id] = 'InsufficientDisk'
+
+    statuses.update(run_fleet_plan(
+        ssm_client, 
+        get_acquire_plan, 
+        [i for i in instance_ids if i not in statuses], 
+        fleet_facts
+    ))
+
+    print('Acquire complete for the fleet.')
+
+    return statuses
+
+
+@tracing.traced('acquire.dump')
+async def _dump_EC2_mem_async(ssm_client, instance_id, credentials, distro):
+    """
+    Dumps the volatile memory of an EC2 instance to its home directory.  
+    Uses linpmem.  Returns the final status of the dump.
+    """
+    memdump_plan = _get_memdump_plan(instance_id, credentials, distro)
+
+    logger.info('Memory dump in progress for instance: {}.  Please wait.'.\
+        format(instance_id))
+
+    invocation = await ensure_command_async(
+        ssm_client, 
+        memdump_plan['commands'], 
+        instance_id, 
+        timeout=memdump_plan.get('timeout'), 
+        expected_duration=memdump_plan.get('expected_duration')
+    )
+
+    logger.info('Memory dump complete.')
+
+    return invocation['Status']
+
+
+@tracing.traced('acquire.transfer')
+async def _transfer_mem_to_asset_bucket_async(
+    ssm_client, 
+    instance_id, 
+    credentials, 
+    distro
+):
     """
     Transfers the dumped memory of an EC2 instance from its home directory to 
-    the asset bucket.
+    the asset bucket.  Returns the final status of the transfer.
     """
-    transfer_commands = _get_transfer_commands(instance_id, credentials)
+    transfer_plan = _get_transfer_plan(instance_id, credentials, distro)
 
     logger.info('Transfering memory dump to s3 bucket...')
 
-    ensure_command(ssm_client, transfer_commands, instance_id)
+    invocation = await ensure_command_async(
+        ssm_client, 
+        transfer_plan['commands'], 
+        instance_id, 
+        timeout=transfer_plan.get('timeout'), 
+        expected_duration=transfer_plan.get('expected_duration')
+    )
 
     logger.info('Transfer to s3 bucket complete.')
 
+    return invocation['Status']
+
 
-def dump_and_transfer(ssm_client, instance_id, credentials):
+@tracing.traced('acquire.stream')
+async def _stream_EC2_mem_to_asset_bucket_async(
+    ssm_client, 
+    instance_id, 
+    credentials, 
+    distro
+):
+    """
+    Pipes the volatile memory of an EC2 instance into a multipart upload to 
+    the asset bucket.  Nothing is written to the instance's disk.  Uses 
+    linpmem.  Returns the final status of the acquisition.
+    """
+    stream_plan = _get_stream_plan(instance_id, credentials, distro)
+
+    logger.info('Streaming memory dump of instance: {} to s3 bucket.  '
+        'Please wait.'.format(instance_id))
+
+    invocation = await ensure_command_async(
+        ssm_client, 
+        stream_plan['commands'], 
+        instance_id, 
+        timeout=stream_plan.get('timeout'), 
+        expected_duration=stream_plan.get('expected_duration')
+    )
+
+    logger.info('Memory dump streamed to s3 bucket.')
+
+    return invocation['Status']
+
+
+@tracing.traced('acquire')
+async def dump_and_transfer_async(
+    ssm_client, 
+    instance_id, 
+    credentials, 
+    stream=False
+):
     """
     Dump and transfer the volatile memory of an EC2 instance to the asset 
     bucket.  Uses linpmem.
+
+    If stream is set, the dump is uploaded while it is produced instead of 
+    being written to the instance's home directory first.  Otherwise nothing 
+    is dumped if the home directory cannot hold the dump, and the transfer 
+    is skipped if the dump did not succeed.
+
+    Returns the final status of the acquisition.
     """
     print('Acquire mode active.  Please give about a minute.')
 
-    _dump_EC2_mem(ssm_client, instance_id)
+    facts = await get_instance_facts_async(ssm_client, instance_id)
+
+    # Every step uses the distro of this probe.  The cached facts may expire 
+    # during a dump that runs for hours.
+    distro = get_distro(facts)
+
+    if stream:
+        status = await _stream_EC2_mem_to_asset_bucket_async(
+            ssm_client, 
+            instance_id, 
+            credentials, 
+            distro
+        )
+
+        print('Acquire complete.  Memory streamed to s3 bucket.')
+
+        return status
+
+    if not capture_fits(facts):
+        _log_insufficient_disk(instance_id, facts)
+        return 'InsufficientDisk'
+
+    status = await _dump_EC2_mem_async(
+        ssm_client, 
+        instance_id, 
+        credentials, 
+        distro
+    )
+
+    if status != 'Success':
+        logger.warning('Memory dump ended with status {}.  Skipping the '
+            'transfer.'.format(status))
+        return status
+
+    status = await _transfer_mem_to_asset_bucket_async(
+        ssm_client, 
+        instance_id, 
+        credentials, 
+        distro
+    )
 
-    _transfer_mem_to_asset_bucket(ssm_client, instance_id, credentials)
+    print('Acquire complete.  Memory dumped and transfered to s3 bucket.')
 
-    print('Acquire complete.  Memory dumped and transfered to s3 bucket.')
\ No newline at end of file
+    return status
@@ -0,0 +1,117 @@
+"""
+Runs several rekall plugins against one memory image in a single session.
+
+This script runs inside the threatresponse/rekall container, under the
+container's python 2 virtualenv.  The plugins run in `parallelism` worker
+processes.  Each worker opens the image, loads the profile and builds the
+kernel address space once, then runs its share of the plugins in that
+session.  Workers do not share a session: a session inherited across a fork
+shares the image's file offset, so concurrent reads would race.  With a
+parallelism of 1 the plugins run one after another in this process.
+
+Usage:
+    rekall_session_runner.py IMAGE PROFILE OUTPUT_DIR SUFFIX PARALLELISM
+        PLUGIN [PLUGIN ...]
+
+Each plugin writes OUTPUT_DIR/<plugin>-<SUFFIX>-output.json.
+"""
+from __future__ import print_function
+
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+
+from rekall import plugins  # noqa: F401 registers the plugins
+from rekall import session as rekall_session
+
+
+# The session of this process, opened by _init_worker.
+SESSION = None
+
+
+def _build_session(image, profile):
+    """Opens the image and does the expensive bootstrap once."""
+    s = rekall_session.Session(filename=image, profile=profile)
+
+    started = time.time()
+
+    # Touching these loads the profile and builds the address spaces.
+    s.profile
+    s.kernel_address_space
+
+    print('Session ready in {:.1f}s.'.format(time.time() - started))
+
+    return s
+
+
+def _init_worker(image, profile):
+    global SESSION
+
+    SESSION = _build_session(image, profile)
+
+
+def _run_plugin(args):
+    plugin, output_path = args
+
+    started = time.time()
+
+    try:
+        SESSION.RunPlugin(plugin, format='json', output=output_path)
+    except Exception:
+        return plugin, False, traceback.format_exc(), time.time() - started
+
+    return plugin, True, None, time.time() - started
+
+
+def main(argv):
+    if len(argv) < 7:
+        print(__doc__)
+        return 2
+
+    image, profile, output_dir, suffix, parallelism = argv[1:6]
+    requested_plugins = argv[6:]
+
+    work = [
+        (
+            plugin,
+            os.path.join(output_dir, '{}-{}-output.json'.format(plugin, suffix))
+        )
+        for plugin in requested_plugins
+    ]
+
+    processes = min(max(1, int(parallelism)), len(work))
+
+    pool = None
+
+    if processes == 1:
+        _init_worker(image, profile)
+        results = (_run_plugin(args) for args in work)
+    else:
+        pool = multiprocessing.Pool(
+            processes=processes,
+            initializer=_init_worker,
+            initargs=(image, profile)
+        )
+        results = pool.imap_unordered(_run_plugin, work)
+
+    failed = 0
+
+    try:
+        for plugin, ok, error, elapsed in results:
+            if ok:
+                print('Plugin {} finished in {:.1f}s.'.format(plugin, elapsed))
+            else:
+                failed += 1
+                print('Plugin {} failed:\n{}'.format(plugin, error))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
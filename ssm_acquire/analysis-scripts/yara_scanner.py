@@ -0,0 +1,164 @@
+"""
+Scans a memory image with a combined yara ruleset in one pass.
+
+This script runs inside the threatresponse/rekall container, under the
+container's python 2 virtualenv.  Every rule file is compiled into a single
+ruleset, namespaced by file name, and the compiled rules are cached by the
+hash of the rule files.  The physical address ranges of the image are split
+into chunks that forked workers scan in parallel; the matches are merged
+into one JSON document.  Each worker opens the image itself, since an image
+opened before the fork would share one file offset between the workers.
+
+Usage:
+    yara_scanner.py IMAGE RULES_DIR CACHE_DIR RULES_HASH OUTPUT WORKERS
+"""
+from __future__ import print_function
+
+import binascii
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import yara
+
+from rekall import plugins  # noqa: F401 registers the address spaces
+from rekall import session as rekall_session
+
+
+# Size of the ranges handed to workers, and how far each one reads past its
+# end so that a match that straddles two ranges is still found.
+CHUNK_SIZE = 64 * 1024 * 1024
+OVERLAP = 64 * 1024
+
+# The compiled rules are set before the workers fork so that they share
+# them.  The address space is opened in each worker by _init_worker.
+RULES = None
+ADDRESS_SPACE = None
+
+
+def _open_address_space(image):
+    return rekall_session.Session(filename=image).physical_address_space
+
+
+def _init_worker(image):
+    global ADDRESS_SPACE
+
+    ADDRESS_SPACE = _open_address_space(image)
+
+
+def _load_rules(rules_dir, cache_dir, rules_hash):
+    """Loads the compiled ruleset from the cache, compiling it on a miss."""
+    cached_path = os.path.join(cache_dir, '{}.yarc'.format(rules_hash))
+
+    if os.path.isfile(cached_path):
+        print('Using cached rules {}.'.format(cached_path))
+        return yara.load(cached_path)
+
+    filepaths = dict(
+        (file_name, os.path.join(rules_dir, file_name))
+        for file_name in sorted(os.listdir(rules_dir))
+        if not file_name.startswith('.')
+        if os.path.isfile(os.path.join(rules_dir, file_name))
+    )
+
+    rules = yara.compile(filepaths=filepaths)
+    rules.save(cached_path)
+
+    print('Compiled {} rule files into {}.'.format(len(filepaths), cached_path))
+
+    return rules
+
+
+def _get_work(address_space):
+    """Splits the mapped physical ranges into (start, length) chunks."""
+    work = []
+
+    for run in address_space.get_mappings():
+        for start in range(run.start, run.end, CHUNK_SIZE):
+            length = min(CHUNK_SIZE + OVERLAP, run.end - start)
+            work.append((start, length))
+
+    return work
+
+
+def _scan(chunk):
+    start, length = chunk
+
+    data = ADDRESS_SPACE.read(start, length)
+
+    results = []
+
+    for match in RULES.match(data=data):
+        for offset, identifier, value in match.strings:
+            results.append({
+                'rule': match.rule,
+                'namespace': match.namespace,
+                'tags': list(match.tags),
+                'meta': match.meta,
+                'physical_offset': start + offset,
+                'string': identifier,
+                'data': binascii.hexlify(value[:64]).decode('ascii')
+            })
+
+    return results
+
+
+def main(argv):
+    global RULES
+
+    if len(argv) != 7:
+        print(__doc__)
+        return 2
+
+    image, rules_dir, cache_dir, rules_hash, output, workers = argv[1:7]
+
+    RULES = _load_rules(rules_dir, cache_dir, rules_hash)
+
+    work = _get_work(_open_address_space(image))
+
+    started = time.time()
+
+    pool = multiprocessing.Pool(
+        processes=max(1, int(workers)),
+        initializer=_init_worker,
+        initargs=(image,)
+    )
+
+    # Overlapping reads can report a match twice.
+    seen = set()
+    matches = []
+
+    try:
+        for results in pool.imap_unordered(_scan, work):
+            for result in results:
+                key = (
+                    result['namespace'],
+                    result['rule'],
+                    result['string'],
+                    result['physical_offset']
+                )
+                if key not in seen:
+                    seen.add(key)
+                    matches.append(result)
+    finally:
+        pool.close()
+        pool.join()
+
+    matches.sort(key=lambda m: m['physical_offset'])
+
+    with open(output, 'w') as f:
+        json.dump(matches, f)
+
+    print('Scanned {} chunks in {:.1f}s with {} matches.'.format(
+        len(work),
+        time.time() - started,
+        len(matches)
+    ))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -1,17 +1,53 @@
 """Runs a docker container and more to perform automated analysis of memory dumps."""
 import boto3
-import docker
+import hashlib
+import json
+import multiprocessing
 import os
 
 from builtins import FileExistsError
 from logging import getLogger
 
+from ssm_acquire import tracing
+from ssm_acquire.compression import decompress
 from ssm_acquire.config import config_manager
+from ssm_acquire.download import RangedDownloader
+from ssm_acquire.profile_cache import ProfileCache
 
 
 config = config_manager
 logger = getLogger(__name__)
 
+# Scripts that run inside the rekall container are mounted here.
+_SCRIPTS_DIR = os.path.join(os.path.dirname(__file__), 'analysis-scripts')
+
+# Plugins run on every capture, by their rekall names.
+REKALL_PLUGINS = [
+    'psaux',
+    'pstree',
+    'netstat',
+    'ifconfig',
+    'pidhashtable'
+]
+
+# The volatility3 plugin that produces the output of each rekall plugin.
+_VOLATILITY_PLUGINS = {
+    'psaux': 'linux.psaux.PsAux',
+    'pstree': 'linux.pstree.PsTree',
+    'netstat': 'linux.sockstat.Sockstat',
+    'ifconfig': 'linux.ip.Addr',
+    'pidhashtable': 'linux.pidhashtable.PIDHashTable'
+}
+
+
+class AnalysisBackendError(Exception):
+    """Raised when an analysis backend cannot run, e.g. for lack of a library."""
+
+
+def _get_bool_setting(key, default):
+    value = config(key, namespace='ssm_acquire', default=default)
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
 
 class S3Manager(object):
     def __init__(self, credentials, bucket_name):
@@ -28,14 +64,22 @@ class S3Manager(object):
                 aws_secret_access_key=self.credentials['Credentials']['SecretAccessKey'],
                 aws_session_token=self.credentials['Credentials']['SessionToken']
             )
+            tracing.instrument(self.s3_client)
+
+    def get_client(self):
+        self._connect()
+        return self.s3_client
 
     def list_objects_for_key(self, object_key):
         self._connect()
-        response = self.s3_client.list_objects(
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        objects = []
+        for page in paginator.paginate(
             Bucket=self.bucket_name,
             Prefix=object_key
-        )
-        return response.get('Contents')
+        ):
+            objects.extend(page.get('Contents', []))
+        return objects
 
     def create_instance_directory(self, instance_id):
         try:
@@ -44,109 +88,324 @@ class S3Manager(object):
             pass
 
     def get_files(self, object_keys):
+        """
+        Downloads the objects to /tmp/<key>.  Objects that are already on 
+        disk with the same ETag are skipped.  Returns the local paths.
+        """
         self._connect()
+        downloader = RangedDownloader(self.s3_client, self.bucket_name)
+        file_paths = []
         for object_key in object_keys:
-            logger.info('Attempting download of: {}'.format(object_key))
-            response = self.s3_client.get_object(
-                Bucket=self.bucket_name,
-                Key=object_key.get('Key')
-            )
-            fh = open('/tmp/{}'.format(object_key.get('Key')), 'wb')
-            fh.write(response['Body'].read())
-            fh.close()
-            logger.info('File retrieval complete for: {}'.format(object_key))
+            if object_key.get('Key').endswith('/'):
+                continue
+            file_path = '/tmp/{}'.format(object_key.get('Key'))
+            if not os.path.isdir(os.path.dirname(file_path)):
+                os.makedirs(os.path.dirname(file_path))
+            logger.info('Attempting download of: {}'.format(object_key.get('Key')))
+            downloader.download(object_key, file_path)
+            file_paths.append(file_path)
+            logger.info('File retrieval complete for: {}'.format(object_key.get('Key')))
+        return file_paths
+
+    def get_metadata(self, object_key):
+        """Returns the user metadata of an object."""
+        self._connect()
+        return self.s3_client.head_object(
+            Bucket=self.bucket_name,
+            Key=object_key
+        ).get('Metadata', {})
 
     def put_file(self, file_path, instance_id):
         self._connect()
         logger.info('Uploading result: {} from file_path: {}'.format(file_path.split('/')[3], file_path))
         object_key = '{}/{}'.format(instance_id, file_path.split('/')[3])
-        with open(file_path, 'rb') as data:
-            self.s3_client.upload_fileobj(data, self.bucket_name, object_key)
+        with tracing.span('s3.upload', key=object_key) as span:
+            span.add_bytes(os.path.getsize(file_path))
+            with open(file_path, 'rb') as data:
+                self.s3_client.upload_fileobj(data, self.bucket_name, object_key)
 
 
-class RekallManager(object):
+class _Analyzer(object):
+    """
+    Downloads the incident data of an instance and uploads the output of the 
+    plugins, as <plugin>-<instance_id>-output.json, for every backend.
+    """
     def __init__(self, instance_id, credentials):
         self.credentials = credentials
         self.instance_id = instance_id
         self.bucket_name = config('asset_bucket', namespace='ssm_acquire')
+        self.rekall_plugins = list(REKALL_PLUGINS)
 
-        self.client = docker.from_env()
-        self.docker_image = 'threatresponse/rekall:latest'
-        self.rekall_plugins = [
-            'psaux',
-            'pstree',
-            'netstat',
-            'ifconfig',
-            'pidhashtable'
-        ]
-
+    @tracing.traced('analyze.download')
     def download_incident_data(self):
-        temp_dir = '/tmp/{}'.format(self.instance_id)
-        if os.path.isdir(temp_dir) and len(os.listdir(temp_dir)) != 0:
-            logger.info('Temp directory already exists.  Skipping re: fetch.')
-            result = os.listdir(temp_dir)
-        else:
-            logger.info('Attempting to download incident data.')
-            s3_manager = S3Manager(self.credentials, self.bucket_name)
-            s3_manager.create_instance_directory(self.instance_id)
-            keys = s3_manager.list_objects_for_key(self.instance_id)
-            result = s3_manager.get_files(keys)
-        return result
+        """
+        Downloads everything in the asset bucket for the instance.  Captures 
+        that were compressed on the instance are decompressed next to the 
+        download, as recorded in their metadata.
+        """
+        logger.info('Attempting to download incident data.')
+        s3_manager = S3Manager(self.credentials, self.bucket_name)
+        s3_manager.create_instance_directory(self.instance_id)
+        keys = s3_manager.list_objects_for_key('{}/'.format(self.instance_id))
+        file_paths = s3_manager.get_files(keys)
+        for file_path in list(file_paths):
+            if not os.path.basename(file_path).startswith('capture.'):
+                continue
+            object_key = file_path[len('/tmp/'):]
+            with tracing.span('analyze.decompress', key=object_key):
+                uncompressed_path = decompress(
+                    file_path,
+                    s3_manager.get_metadata(object_key)
+                )
+            if uncompressed_path is not None:
+                file_paths.append(uncompressed_path)
+        return file_paths
 
     def _get_rekall_profile_name(self):
         for file_name in os.listdir('/tmp/{}'.format(self.instance_id)):
             if file_name.endswith('.zip'):
                 return file_name
 
+    def _get_capture_name(self):
+        """
+        Returns the name of the memory capture: capture.aff4 for a dump that 
+        was written to disk first, capture.elf for a streamed or compressed 
+        one.  When both are on disk, the newer one is the capture that was
+        just downloaded; the other is left over from an earlier acquisition.
+        """
+        instance_dir = '/tmp/{}'.format(self.instance_id)
+        file_names = os.listdir(instance_dir)
+        capture_names = [
+            capture_name for capture_name in ['capture.aff4', 'capture.elf']
+            if capture_name in file_names
+        ]
+
+        if not capture_names:
+            return None
+        return max(
+            capture_names,
+            key=lambda capture_name: os.path.getmtime(
+                os.path.join(instance_dir, capture_name)
+            )
+        )
+
+    def _get_output_path(self, plugin):
+        return '/tmp/{}/{}-{}-output.json'.format(self.instance_id, plugin, self.instance_id)
+
+    def _upload_plugin_outputs(self):
+        s3_manager = S3Manager(self.credentials, self.bucket_name)
+
+        for plugin in self.rekall_plugins:
+            logger.info('Uploading results for plugin: {}'.format(plugin))
+            s3_manager.put_file(self._get_output_path(plugin), self.instance_id)
+
+
+class RekallManager(_Analyzer):
+    """Runs the plugins with rekall in the threatresponse/rekall container."""
+    def __init__(self, instance_id, credentials, isolated_plugins=None):
+        super(RekallManager, self).__init__(instance_id, credentials)
+
+        # docker is only imported by this backend.
+        import docker
+
+        self.client = docker.from_env()
+        self.docker_image = 'threatresponse/rekall:latest'
+
+        # How many plugins may run at once, in session workers or as 
+        # separate containers.
+        self.plugin_parallelism = int(config(
+            'rekall_plugin_parallelism', 
+            namespace='ssm_acquire', 
+            default='2'
+        ))
+
+        # Separate containers re-open the image and re-load the profile for 
+        # every plugin, so they are only used when asked for.
+        if isolated_plugins is None:
+            isolated_plugins = _get_bool_setting(
+                'rekall_isolated_plugins', 
+                'false'
+            )
+        self.isolated_plugins = isolated_plugins
+
+        # Optional resource limits for every rekall container, e.g. 
+        # rekall_container_cpus=2 and rekall_container_mem_limit=8g.
+        self.container_cpus = config(
+            'rekall_container_cpus', 
+            namespace='ssm_acquire', 
+            default=''
+        )
+        self.container_mem_limit = config(
+            'rekall_container_mem_limit', 
+            namespace='ssm_acquire', 
+            default=''
+        )
+
     def _run_a_container(
         self,
         command,
         volumes
     ):
+        limits = {}
+        if self.container_cpus:
+            limits['nano_cpus'] = int(float(self.container_cpus) * 1e9)
+        if self.container_mem_limit:
+            limits['mem_limit'] = self.container_mem_limit
         return self.client.containers.run(
             image=self.docker_image,
             command=command,
             detach=True,
-            volumes=volumes
+            volumes=volumes,
+            **limits
         )
 
     def pull_rekall_image(self):
         return self.client.images.pull(self.docker_image)
 
+    def _get_yara_files(self, yara_file_dir):
+        return sorted(
+            file_name for file_name in os.listdir(yara_file_dir)
+            if not file_name.startswith('.')
+            if os.path.isfile(os.path.join(yara_file_dir, file_name))
+        )
+
+    def _hash_yara_files(self, yara_file_dir, yara_files):
+        """
+        Hashes the names and contents of the rule files.  The compiled 
+        ruleset is cached under this hash.
+        """
+        digest = hashlib.sha256()
+        for yara_file in yara_files:
+            digest.update(yara_file.encode('utf-8') + b'\0')
+            with open(os.path.join(yara_file_dir, yara_file), 'rb') as f:
+                digest.update(hashlib.sha256(f.read()).digest())
+        return digest.hexdigest()
+
+    @tracing.traced('analyze.yara_scan')
     def run_yara_scan(self):
-        yara_file_dir = config('yara_file_dir', namespace='ssm_acquire', default='~/.yarafiles')
-        rekall_profile_name = self._get_rekall_profile_name()
-        if os.path.isdir(yara_file_dir) and len(os.listdir(yara_file_dir)) != 0:
-            for yara_file in os.listdir(yara_file_dir):
-                plugin = 'yarascan'
-                additional_arg = '--yara_file /opt/yarascan/{}'.format(yara_file)
-                command = 'rekall -f /files/capture.aff4 --profile /files/{}json {} {} \
+        """
+        Compiles every rule file in yara_file_dir into one ruleset and scans 
+        the capture with it in a single pass, split by address range across 
+        yara_scan_workers processes.  The merged matches are uploaded to the 
+        asset bucket as yara-scan-<instance_id>-output.json.
+        """
+        yara_file_dir = os.path.expanduser(config('yara_file_dir', namespace='ssm_acquire', default='~/.yarafiles'))
+        if not os.path.isdir(yara_file_dir) or not self._get_yara_files(yara_file_dir):
+            logger.info('No yara files found.  Skipping yarascan.')
+            return
+
+        yara_files = self._get_yara_files(yara_file_dir)
+        rules_hash = self._hash_yara_files(yara_file_dir, yara_files)
+        yara_cache_dir = os.path.expanduser(config(
+            'yara_cache_dir',
+            namespace='ssm_acquire',
+            default='~/.cache/ssm_acquire/yara'
+        ))
+        if not os.path.isdir(yara_cache_dir):
+            os.makedirs(yara_cache_dir)
+        workers = int(config(
+            'yara_scan_workers',
+            namespace='ssm_acquire',
+            default=str(multiprocessing.cpu_count())
+        ))
+
+        output_name = 'yara-scan-{}-output.json'.format(self.instance_id)
+        logger.info('Scanning with {} yara rule files: {}'.format(len(yara_files), yara_files))
+        command = 'python /opt/ssm_acquire/yara_scanner.py /files/{} /opt/yarascan /opt/yaracache {} /files/{} {}'.format(
+            self._get_capture_name(),
+            rules_hash,
+            output_name,
+            workers
+        )
+        container = self._run_a_container(
+            command,
+            {
+                '/tmp/{}'.format(self.instance_id): {'bind': '/files', 'mode': 'rw'},
+                yara_file_dir: {'bind': '/opt/yarascan', 'mode': 'ro'},
+                yara_cache_dir: {'bind': '/opt/yaracache', 'mode': 'rw'},
+                _SCRIPTS_DIR: {'bind': '/opt/ssm_acquire', 'mode': 'ro'}
+            }
+        )
+
+        logger.info('Waiting for yarascan to exit.')
+        container.wait(timeout=3600)
+        print(container.logs())
+        container.remove()
+
+        s3_manager = S3Manager(self.credentials, self.bucket_name)
+        s3_manager.put_file(
+            '/tmp/{}/{}'.format(self.instance_id, output_name), self.instance_id
+        )
+
+    @tracing.traced('analyze.rekall_session')
+    def _run_plugins_in_session(self, rekall_profile_name):
+        """
+        Runs every plugin in one container, in plugin_parallelism rekall 
+        sessions, so the image is parsed and the profile loaded once per 
+        session rather than once per plugin.
+        """
+        capture_name = self._get_capture_name()
+        logger.info('Running plugins: {} on {} in a shared session.'.format(self.rekall_plugins, capture_name))
+        command = 'python /opt/ssm_acquire/rekall_session_runner.py /files/{} /files/{}json /files {} {} {}'.format(
+            capture_name,
+            rekall_profile_name.split('zip')[0],
+            self.instance_id,
+            self.plugin_parallelism,
+            ' '.join(self.rekall_plugins)
+        )
+        volumes = {
+            '/tmp/{}'.format(self.instance_id): {'bind': '/files', 'mode': 'rw'},
+            _SCRIPTS_DIR: {'bind': '/opt/ssm_acquire', 'mode': 'ro'}
+        }
+        container = self._run_a_container(command, volumes)
+        logger.info('Waiting for analysis to complete.')
+        container.wait(timeout=600 * len(self.rekall_plugins))
+        logs = [container.logs()]
+        container.remove()
+        return logs
+
+    @tracing.traced('analyze.rekall_containers')
+    def _run_plugins_in_containers(self, rekall_profile_name):
+        """
+        Runs every plugin in its own container, at most plugin_parallelism 
+        at a time.
+        """
+        capture_name = self._get_capture_name()
+        logs = []
+        for start in range(0, len(self.rekall_plugins), self.plugin_parallelism):
+            plugin_containers = []
+            for plugin in self.rekall_plugins[start:start + self.plugin_parallelism]:
+                logger.info('Running the following plugin: {} on {}.'.format(plugin, capture_name))
+                command = 'rekall -f /files/{} --profile /files/{}json {} \
                         --format=json --output=/files/{}-{}-output.json'.format(
+                    capture_name,
                     rekall_profile_name.split('zip')[0],
                     plugin,
-                    additional_arg,
-                    'yara-scan-{}'.format(yara_file),
+                    plugin,
                     self.instance_id
                 )
-            container = self._run_a_container(
-                command,
-                {
-                    '/tmp/{}'.format(self.instance_id): {'bind': '/files'.format(self.instance_id), 'mode': 'rw'},
-                    '{}'.format(yara_file_dir): {'bind': '/opt/yarascan', 'mode': 'rw'},
+                volumes = {
+                    '/tmp/{}'.format(self.instance_id): {'bind': '/files', 'mode': 'rw'}
                 }
-            )
-
-            logger.info('Waiting for yarascan to exit.')
-            container.wait(timeout=600)
-            print(container.logs())
-            container.remove()
-        else:
-            logger.info('No yara files found.  Skipping yarascan.')
+                container = self._run_a_container(command, volumes)
+                plugin_containers.append(
+                    {
+                        'plugin': plugin,
+                        'container': container
+                    }
+                )
 
-    def run_rekall_plugins(self):
-        # Build the json version of the rekall profile first
-        rekall_profile_name = self._get_rekall_profile_name()
+            for container in plugin_containers:
+                # For some reason .status is an object property
+                logger.info('Waiting for analysis to complete on: {}'.format(container['plugin']))
+                with tracing.span('rekall.plugin', plugin=container['plugin']):
+                    container['container'].wait(timeout=600)
+                logs.append(container['container'].logs())
+                container['container'].remove()
+        return logs
 
+    @tracing.traced('analyze.convert_profile')
+    def _convert_rekall_profile(self, rekall_profile_name):
         logger.info('Attempting to convert the zip of the rekall profile to json'.format(rekall_profile_name))
         command = 'rekall convert_profile {} {}json'.format(
             rekall_profile_name,
@@ -157,47 +416,42 @@ class RekallManager(object):
                 {'bind': '/files', 'mode': 'rw'}
         }
         container = self._run_a_container(command, volumes)
-        container.stop()
+        container.wait(timeout=600)
         container.remove()
         logger.info('The rekall profile was converted from a zip file to a json file.')
-        logger.info('Begin analysis of the memory sample for the following plugins: {}'.format(self.rekall_plugins))
-
-        plugin_containers = []
-        for plugin in self.rekall_plugins:
-            logger.info('Running the following plugin: {} on capture.aff4.'.format(plugin))
-            command = 'rekall -f /files/capture.aff4 --profile /files/{}json {} \
-                    --format=json --output=/files/{}-{}-output.json'.format(
-                rekall_profile_name.split('zip')[0],
-                plugin,
-                plugin,
-                self.instance_id
-            )
-            volumes = {
-                '/tmp/{}'.format(self.instance_id): {'bind': '/files', 'mode': 'rw'}
-            }
-            container = self._run_a_container(command, volumes)
-            plugin_containers.append(
-                {
-                    'plugin': plugin,
-                    'container': container
-                }
-            )
 
-        logs = []
+    def _ensure_json_profile(self, rekall_profile_name):
+        """
+        Gets the json version of the rekall profile from the profile cache, 
+        converting the zip and caching the result on a miss.
+        """
+        zip_path = '/tmp/{}/{}'.format(self.instance_id, rekall_profile_name)
+        json_path = '/tmp/{}/{}json'.format(self.instance_id, rekall_profile_name.split('zip')[0])
         s3_manager = S3Manager(self.credentials, self.bucket_name)
+        profile_cache = ProfileCache(s3_manager.get_client(), self.bucket_name)
 
-        for container in plugin_containers:
-            # For some reason .status is an object property
-            logger.info('Waiting for analysis to complete on: {}'.format(container['plugin']))
-            container['container'].wait(timeout=600)
-            logs.append(container['container'].logs())
-            container['container'].remove()
+        if profile_cache.get(zip_path, json_path):
+            logger.info('Using the cached json version of the rekall profile.')
+            tracing.current_span().set(profile_cached=True)
+            return
 
-        for plugin in self.rekall_plugins:
-            logger.info('Uploading results for plugin: {}'.format(plugin))
-            s3_manager.put_file(
-                '/tmp/{}/{}-{}-output.json'.format(self.instance_id, plugin, self.instance_id), self.instance_id
-            )
+        self._convert_rekall_profile(rekall_profile_name)
+        profile_cache.put(zip_path, json_path)
+
+    @tracing.traced('analyze.rekall')
+    def run_rekall_plugins(self):
+        # Build the json version of the rekall profile first
+        rekall_profile_name = self._get_rekall_profile_name()
+        self._ensure_json_profile(rekall_profile_name)
+
+        logger.info('Begin analysis of the memory sample for the following plugins: {}'.format(self.rekall_plugins))
+
+        if self.isolated_plugins:
+            logs = self._run_plugins_in_containers(rekall_profile_name)
+        else:
+            logs = self._run_plugins_in_session(rekall_profile_name)
+
+        self._upload_plugin_outputs()
 
         self.run_yara_scan()
 
@@ -205,6 +459,183 @@ class RekallManager(object):
         return logs
 
 
-class NativeRekall(object):
-    def __init__(self, object_key):
-        self.object_key = object_key
+def _to_json_value(value):
+    """Converts a value of a volatility3 TreeGrid to a JSON value."""
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    if isinstance(value, bytes):
+        return value.hex()
+    # NotApplicableValue, UnreadableValue and the like.
+    if any(cls.__name__ == 'BaseAbsentValue' for cls in type(value).__mro__):
+        return None
+    return str(value)
+
+
+def _get_rekall_rows(plugin, tree_grid):
+    """
+    Returns the rows of a TreeGrid as rekall's JSON rendering does: a 
+    metadata entry, then one ['r', row] entry per row.  Rows of a tree carry 
+    their depth, as pstree does.
+    """
+    columns = [column.name for column in tree_grid.columns]
+    rows = [['m', {'plugin_name': plugin, 'tool_name': 'volatility3'}]]
+
+    def visit(node, accumulator):
+        row = dict(zip(columns, (_to_json_value(v) for v in node.values)))
+        row['depth'] = node.path_depth - 1
+        accumulator.append(['r', row])
+        return accumulator
+
+    tree_grid.populate(visit, rows)
+
+    return rows
+
+
+class NativeRekall(_Analyzer):
+    """
+    Runs the plugins in this process with volatility3, the maintained 
+    successor of rekall, so no docker daemon, image or container is needed. 
+    The output is uploaded under the same names as the output of 
+    RekallManager.
+
+    volatility3 is an optional dependency, and it reads kernel symbols in 
+    its ISF format rather than rekall profiles.  ISF files built with 
+    dwarf2json for the instance's kernel are looked up in 
+    volatility_symbols_dir as well as in volatility3's own symbols.
+    """
+    def __init__(self, instance_id, credentials):
+        super(NativeRekall, self).__init__(instance_id, credentials)
+
+        self.symbols_dir = os.path.expanduser(config(
+            'volatility_symbols_dir', 
+            namespace='ssm_acquire', 
+            default='~/.cache/ssm_acquire/symbols'
+        ))
+
+    def _load_volatility(self):
+        """Imports volatility3 and its plugins, and adds the symbols dir."""
+        try:
+            import volatility3.framework
+            import volatility3.plugins
+            import volatility3.symbols
+        except ImportError:
+            raise AnalysisBackendError('The native analysis backend needs '
+                'volatility3: pip install volatility3')
+
+        volatility3.framework.require_interface_version(2, 0, 0)
+
+        if self.symbols_dir not in volatility3.symbols.__path__:
+            volatility3.symbols.__path__.insert(0, self.symbols_dir)
+
+        volatility3.framework.import_files(volatility3.plugins, True)
+
+        return volatility3.framework.list_plugins()
+
+    def _run_plugin(self, context, plugin_class, capture_path):
+        from volatility3.framework import automagic
+        from volatility3.framework import plugins
+
+        context.config['automagic.LayerStacker.single_location'] = \
+            'file://' + capture_path
+
+        automagics = automagic.choose_automagic(
+            automagic.available(context), 
+            plugin_class
+        )
+
+        constructed = plugins.construct_plugin(
+            context, 
+            automagics, 
+            plugin_class, 
+            'plugins', 
+            None, 
+            None
+        )
+
+        return constructed.run()
+
+    @tracing.traced('analyze.native')
+    def run_rekall_plugins(self):
+        """
+        Runs every plugin against the capture in one volatility3 context, 
+        one after the other.  A plugin that fails 
+        or is missing from the installed volatility3 gets an output with the 
+        error instead of rows.
+
+        Returns the error of every plugin that failed.
+        """
+        available = self._load_volatility()
+
+        from volatility3.framework import contexts
+
+        capture_path = '/tmp/{}/{}'.format(
+            self.instance_id, 
+            self._get_capture_name()
+        )
+        context = contexts.Context()
+        errors = {}
+
+        logger.info('Running plugins: {} on {} with volatility3.'.format(
+            self.rekall_plugins, 
+            capture_path
+        ))
+
+        for plugin in self.rekall_plugins:
+            with tracing.span('native.plugin', plugin=plugin):
+                try:
+                    plugin_class = available[_VOLATILITY_PLUGINS[plugin]]
+                    rows = _get_rekall_rows(
+                        plugin, 
+                        self._run_plugin(context, plugin_class, capture_path)
+                    )
+                except Exception as e:
+                    logger.warning('Plugin {} failed: {}'.format(plugin, e))
+                    errors[plugin] = '{}: {}'.format(type(e).__name__, e)
+                    rows = [['m', {'plugin_name': plugin, 'tool_name': 
+                        'volatility3'}], ['e', {'error': errors[plugin]}]]
+
+            with open(self._get_output_path(plugin), 'w') as f:
+                json.dump(rows, f)
+
+        self._upload_plugin_outputs()
+
+        logger.info('Native plugin run complete.  Yara scans need the docker '
+            'backend and were skipped.')
+        return errors
+
+
+def get_analyzer(instance_id, credentials, backend):
+    """Returns the analyzer of the backend, docker or native."""
+    if backend == 'native':
+        return NativeRekall(instance_id, credentials)
+
+    return RekallManager(instance_id, credentials)
+
+
+# TODO: throws error on valid instance; investigate analyze.py
+@tracing.traced('analyze')
+def analyze_capture(instance_id, credentials, backend='docker'):
+    """
+    Downloads the capture of the instance and analyzes it with the backend: 
+    rekall in docker, or volatility3 in this process ('native').
+    """
+    print('Analysis mode active.')
+    
+    analyzer = get_analyzer(instance_id, credentials, backend)
+    
+    analyzer.download_incident_data()
+    analyzer.run_rekall_plugins()
+
+    # The output is parsed where it was written, with the interrogation 
+    # log if it was downloaded with the capture.
+    from ssm_acquire.results import build_results
+
+    S3Manager(credentials, analyzer.bucket_name).put_file(
+        build_results(instance_id), 
+        instance_id
+    )
+
+    print('Analysis complete.  The rekall-json dumps and their results '
+        'database have been added to the asset store.')
@@ -0,0 +1,266 @@
+"""
+Tool binaries staged in the asset bucket, with pinned checksums.
+
+Plans used to download linpmem and osquery from the internet on every run.
+Staging mirrors every tool in tool-artifacts/tools.yml into the asset bucket
+once, under artifacts/<sha256>/<file name>, and records the checksums in
+artifacts/manifest.json.  Plans keep a copy in INSTANCE_CACHE_DIR on the
+instance, reuse it while its checksum matches, and pull it from the bucket
+otherwise.  Tools that were never staged are still downloaded from their
+url, so a fresh bucket keeps working.
+"""
+import boto3
+import hashlib
+import json
+import logging
+import os.path
+import shutil
+import tempfile
+import yaml
+
+from botocore.exceptions import ClientError
+from urllib.request import urlopen
+
+from ssm_acquire import tracing
+
+
+logger = logging.getLogger(__name__)
+
+# Prefix of the asset bucket shared by all instances; see policy.py.
+ARTIFACTS_PREFIX = 'artifacts'
+
+# Where plans keep the tools between runs on the instance.
+INSTANCE_CACHE_DIR = '/var/cache/ssm_acquire'
+
+_MANIFEST_KEY = '{}/manifest.json'.format(ARTIFACTS_PREFIX)
+
+# Manifests already read by this process, by bucket name.
+_manifests = {}
+
+_tools = None
+
+
+class ArtifactChecksumError(Exception):
+    """
+    Raised when a tool is not pinned, or a download or staged copy does not 
+    match its pinned checksum.
+    """
+
+
+def get_tools():
+    """Returns the tools listed in tool-artifacts/tools.yml."""
+    global _tools
+
+    if _tools is None:
+        dirname = os.path.dirname(__file__)
+
+        path = os.path.join(dirname, 'tool-artifacts/tools.yml')
+
+        _tools = yaml.safe_load(open(path))['tools']
+
+    return _tools
+
+
+def _get_key(tool, sha256):
+    return '{}/{}/{}'.format(ARTIFACTS_PREFIX, sha256, tool['file_name'])
+
+
+def _is_staged(entry, tool):
+    """Checks if a manifest entry is the staged copy of the pinned tool."""
+    return bool(entry) and entry['file_name'] == tool['file_name'] and \
+        tool.get('sha256') == entry['sha256']
+
+
+def _download(url, path):
+    """Downloads url to path.  Returns the sha256 of the download."""
+    digest = hashlib.sha256()
+
+    with open(path, 'wb') as f:
+        response = urlopen(url)
+
+        for data in iter(lambda: response.read(1024 * 1024), b''):
+            f.write(data)
+            digest.update(data)
+
+    return digest.hexdigest()
+
+
+class ArtifactStore(object):
+    def __init__(self, credentials, bucket_name):
+        self.credentials = credentials
+        self.bucket_name = bucket_name
+        self.s3_client = None
+
+    def _connect(self):
+        if self.s3_client is None:
+            logger.info('Initializing an S3 Client.')
+
+            self.s3_client = boto3.client(
+                's3',
+                aws_access_key_id=self.credentials['Credentials']['AccessKeyId'],
+                aws_secret_access_key=self.credentials['Credentials']['SecretAccessKey'],
+                aws_session_token=self.credentials['Credentials']['SessionToken']
+            )
+
+            tracing.instrument(self.s3_client)
+
+    def _load_manifest(self):
+        """
+        Reads the manifest.  A missing manifest is empty; any other error, 
+        e.g. access denied, is raised rather than taken for an empty 
+        manifest, which would send instances to the unpinned urls.
+        """
+        if self.bucket_name not in _manifests:
+            self._connect()
+
+            try:
+                response = self.s3_client.get_object(
+                    Bucket=self.bucket_name,
+                    Key=_MANIFEST_KEY
+                )
+
+                _manifests[self.bucket_name] = json.loads(
+                    response['Body'].read().decode('utf-8')
+                )
+            except ClientError as e:
+                if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                    raise
+
+                logger.info('No staged artifacts in the asset bucket.')
+
+                _manifests[self.bucket_name] = {}
+
+        return _manifests[self.bucket_name]
+
+    def _fetch_tool(self, name, tool, staging_dir):
+        """
+        Downloads the tool and checks it against its pin.  Returns its 
+        manifest entry and the path of the download.
+        """
+        path = os.path.join(staging_dir, tool['file_name'])
+
+        logger.info('Downloading {} from {}.'.format(name, tool['url']))
+
+        sha256 = _download(tool['url'], path)
+
+        if tool['sha256'] != sha256:
+            raise ArtifactChecksumError(
+                'Download of {} has sha256 {}, expected {}.'.format(
+                    name,
+                    sha256,
+                    tool['sha256']
+                )
+            )
+
+        entry = {
+            'file_name': tool['file_name'],
+            'sha256': sha256,
+            'key': _get_key(tool, sha256),
+            'url': tool['url']
+        }
+
+        return entry, path
+
+    def stage(self):
+        """
+        Mirrors every tool that is not staged yet, or whose pin changed, into
+        the asset bucket and updates the manifest.
+
+        Every pin is checked and every download verified before anything is 
+        uploaded, so a bad pin or download leaves the bucket as it was.
+
+        Returns the names of the tools that were staged.
+        """
+        self._connect()
+
+        _manifests.pop(self.bucket_name, None)
+
+        manifest = self._load_manifest()
+
+        tools = dict(
+            (name, tool) for name, tool in get_tools().items()
+            if not _is_staged(manifest.get(name), tool)
+        )
+
+        unpinned = sorted(name for name, tool in tools.items()
+            if not tool.get('sha256'))
+
+        if unpinned:
+            raise ArtifactChecksumError(
+                '{} have no sha256 in tool-artifacts/tools.yml.  Pin them to '
+                'the checksums of their verified releases before staging '
+                'them.'.format(', '.join(unpinned))
+            )
+
+        for name in sorted(set(get_tools()) - set(tools)):
+            logger.info('{} is already staged.'.format(name))
+
+        staging_dir = tempfile.mkdtemp()
+
+        try:
+            fetched = dict(
+                (name, self._fetch_tool(name, tool, staging_dir))
+                for name, tool in tools.items()
+            )
+
+            for name, (entry, path) in fetched.items():
+                self.s3_client.upload_file(path, self.bucket_name, entry['key'])
+
+                logger.info('Staged {} as {}.'.format(name, entry['key']))
+
+                manifest[name] = entry
+        finally:
+            shutil.rmtree(staging_dir)
+
+        if tools:
+            self.s3_client.put_object(
+                Bucket=self.bucket_name,
+                Key=_MANIFEST_KEY,
+                Body=json.dumps(manifest, indent=2, sort_keys=True).encode(
+                    'utf-8'
+                ),
+                ContentType='application/json'
+            )
+
+        return sorted(tools)
+
+    def get_plan_variables(self):
+        """
+        Returns the template variables that plans fetch their tools with:
+        ssm_acquire_artifacts maps each tool to its file name, url and, once
+        staged, its sha256 and key.
+
+        Raises ArtifactChecksumError if a staged tool's sha256 in the 
+        manifest differs from its pin, so a tampered manifest cannot send 
+        another binary to the instance.
+        """
+        manifest = self._load_manifest()
+
+        artifacts = {}
+
+        for name, tool in get_tools().items():
+            entry = manifest.get(name)
+
+            if entry and entry['file_name'] == tool['file_name']:
+                if entry['sha256'] != tool.get('sha256'):
+                    raise ArtifactChecksumError(
+                        'Staged {} has sha256 {}, expected {}.'.format(
+                            name,
+                            entry['sha256'],
+                            tool.get('sha256')
+                        )
+                    )
+
+                artifacts[name] = entry
+            else:
+                artifacts[name] = {
+                    'file_name': tool['file_name'],
+                    'sha256': None,
+                    'key': None,
+                    'url': tool['url']
+                }
+
+        return {
+            'ssm_acquire_artifacts': artifacts,
+            'ssm_acquire_cache_dir': INSTANCE_CACHE_DIR
+        }
@@ -0,0 +1,190 @@
+"""
+Baselines of the results of a fleet, and the rows of each host that are rare
+among its peers.
+
+Hosts of the same role mostly run the same processes, listen on the same
+ports and load the same kernel modules, so what stands out is what only a
+few of them have.  The results database of every host, see
+ssm_acquire.results, is reduced to features that are comparable between
+hosts, without pids, addresses or times:
+
+    process          name
+    deleted_binary   name, path
+    listening_port   process, local_port
+    remote_port      process, remote_port
+    kernel_module    name
+    interface        name
+    yara_rule        namespace, rule
+
+Each distinct feature row of a host is hashed to 64 bits.  The baseline of a
+group, the hosts with the same value of a tag, counts how many hosts have
+each hash.  A second pass over the hosts reports the rows that at most
+outlier_max_fraction of their group have.  The baselines hold one count per
+distinct row, and the hosts are read one at a time, so memory grows with the
+number of distinct rows rather than with hosts times rows.
+"""
+import hashlib
+import json
+import logging
+
+from ssm_acquire.config import config_manager
+from ssm_acquire.results import open_results
+
+
+config = config_manager
+logger = logging.getLogger(__name__)
+
+# The group of hosts without the tag that groups them.
+UNGROUPED = '(none)'
+
+# The query of every feature, returning distinct rows.
+FEATURES = {
+    'process':
+        'SELECT DISTINCT name FROM processes WHERE name IS NOT NULL',
+    'deleted_binary':
+        'SELECT DISTINCT name, path FROM processes WHERE on_disk = 0',
+    'listening_port':
+        'SELECT DISTINCT process, local_port FROM sockets '
+        'WHERE state = \'LISTEN\' AND local_port IS NOT NULL',
+    'remote_port':
+        'SELECT DISTINCT process, remote_port FROM sockets '
+        'WHERE state IS NOT \'LISTEN\' AND remote_port IS NOT NULL',
+    'kernel_module':
+        'SELECT DISTINCT name FROM kernel_modules WHERE name IS NOT NULL',
+    'interface':
+        'SELECT DISTINCT name FROM interfaces WHERE name IS NOT NULL',
+    'yara_rule':
+        'SELECT DISTINCT namespace, rule FROM yara_hits'
+}
+
+
+def _get_float_setting(key, default):
+    return float(config(key, namespace='ssm_acquire', default=str(default)))
+
+
+def _get_int_setting(key, default):
+    return int(config(key, namespace='ssm_acquire', default=str(default)))
+
+
+def hash_row(feature, row):
+    """Returns the 64-bit hash of a feature row."""
+    digest = hashlib.blake2b(
+        json.dumps([feature] + list(row)).encode('utf-8'),
+        digest_size=8
+    ).digest()
+
+    return int.from_bytes(digest, 'big')
+
+
+def iter_feature_rows(path):
+    """Yields the feature, row and hash of every feature row of a host."""
+    connection = open_results(path)
+
+    try:
+        for feature, query in sorted(FEATURES.items()):
+            for row in connection.execute(query):
+                yield feature, row, hash_row(feature, row)
+    finally:
+        connection.close()
+
+
+class Baseline(object):
+    """How many hosts of a group have each feature row, by hash."""
+    def __init__(self, group):
+        self.group = group
+        self.hosts = 0
+        self.counts = {}
+
+    def add_host(self, hashes):
+        self.hosts += 1
+
+        for row_hash in hashes:
+            self.counts[row_hash] = self.counts.get(row_hash, 0) + 1
+
+    def count(self, row_hash):
+        return self.counts.get(row_hash, 0)
+
+    def get_rare_limit(self, max_fraction):
+        """Returns the most hosts a row can be on and still be rare."""
+        return max(1, int(self.hosts * max_fraction))
+
+
+def build_baselines(paths, groups):
+    """
+    Returns the baseline of every group from the results databases of its
+    hosts.  paths are (instance_id, path) pairs and groups the group of each
+    instance id.
+    """
+    baselines = {}
+
+    for instance_id, path in paths:
+        group = groups.get(instance_id, UNGROUPED)
+
+        if group not in baselines:
+            baselines[group] = Baseline(group)
+
+        baselines[group].add_host(
+            row_hash for _, _, row_hash in iter_feature_rows(path)
+        )
+
+    return baselines
+
+
+def find_outliers(
+    paths,
+    groups,
+    max_fraction=None,
+    min_group=None
+):
+    """
+    Yields the rare rows of every host, rarest first within a host, as
+    dicts of instance_id, group, feature, row, hosts (how many hosts of the
+    group have the row) and group_hosts.  Hosts in groups of fewer than
+    min_group hosts have no herd to be compared with and are skipped.
+
+    paths are (instance_id, path) pairs and are read twice, so they are a
+    list rather than a generator.
+    """
+    if max_fraction is None:
+        max_fraction = _get_float_setting('outlier_max_fraction', 0.05)
+
+    if min_group is None:
+        min_group = _get_int_setting('outlier_min_group', 3)
+
+    baselines = build_baselines(paths, groups)
+
+    for baseline in sorted(baselines.values(), key=lambda b: b.group):
+        logger.info('Baseline of group {}: {} hosts, {} distinct rows.'.format(
+            baseline.group,
+            baseline.hosts,
+            len(baseline.counts)
+        ))
+
+        if baseline.hosts < min_group:
+            logger.warning('Not comparing the {} hosts of group {}, which has '
+                'fewer than {}.'.format(baseline.hosts, baseline.group,
+                min_group))
+
+    for instance_id, path in paths:
+        baseline = baselines[groups.get(instance_id, UNGROUPED)]
+
+        if baseline.hosts < min_group:
+            continue
+
+        limit = baseline.get_rare_limit(max_fraction)
+
+        rare = [
+            (baseline.count(row_hash), feature, row)
+            for feature, row, row_hash in iter_feature_rows(path)
+            if baseline.count(row_hash) <= limit
+        ]
+
+        for count, feature, row in sorted(rare, key=lambda r: r[:2]):
+            yield {
+                'instance_id': instance_id,
+                'group': baseline.group,
+                'feature': feature,
+                'row': list(row),
+                'hosts': count,
+                'group_hosts': baseline.hosts
+            }
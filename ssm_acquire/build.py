@@ -1,63 +1,388 @@
+import asyncio
 import logging
-import yaml
 
-from ssm_acquire.command import ensure_command
-from ssm_acquire.jinja2_io import get_jinja2_plan
+from botocore.exceptions import ClientError
+
+from ssm_acquire import tracing
+from ssm_acquire.command import ensure_command_async
+from ssm_acquire.config import get_asset_bucket
+from ssm_acquire.facts import UnsupportedInstanceError
+from ssm_acquire.facts import get_distro
+from ssm_acquire.facts import get_fleet_facts
+from ssm_acquire.facts import get_instance_facts_async
+from ssm_acquire.facts import run_fleet_plan
+from ssm_acquire.facts import select_plan
+from ssm_acquire.jinja2_io import FLEET_INSTANCE_ID
+from ssm_acquire.jinja2_io import get_plans
+from ssm_acquire.profile_registry import ProfileRegistry
 
 
 logger = logging.getLogger(__name__)
 
 
-def _get_build_plans(credentials, instance_id):
+def _get_build_plans(credentials, instance_id, **variables):
     """
     Loads the j2-formatted plans to build a rekall profile for the instance.
     """
     j2_file = "build-plans/linpmem.yml.j2"
 
-    build_plan = get_jinja2_plan(credentials, instance_id, j2_file)
+    return get_plans(credentials, instance_id, j2_file, **variables)
+
 
-    return yaml.safe_load(build_plan)
+def _get_build_plan(credentials, instance_id, distro, **variables):
+    """
+    Gets the plan to build a rekall profile for the instance, selected for 
+    its distro; see get_distro.
+    """
+    return select_plan(
+        _get_build_plans(credentials, instance_id, **variables),
+        distro
+    )
 
 
-def _get_build_commands(credentials, instance_id):
+def _get_local_build_plan(credentials, instance_id, kernel_release, distro):
     """
-    TODO: Only supports amzn2 for now.  Add support for other distros.
-    
-    Gets commands to build a rekall profile for the instance.
+    Gets the toolchain steps of the build plan for a local container, 
+    without the upload.
     """
-    return _get_build_plans(
+    from ssm_acquire.local_build import BUILD_DIR
+
+    return _get_build_plan(
         credentials, 
+        instance_id, 
+        distro, 
+        ssm_acquire_kernel_release=kernel_release, 
+        ssm_acquire_build_dir=BUILD_DIR, 
+        ssm_acquire_local_build=True
+    )
+
+
+def _get_local_builder(credentials):
+    """
+    Returns a builder for the 'local' backend.  docker is only imported when 
+    that backend is used.
+    """
+    from ssm_acquire.local_build import LocalProfileBuilder
+
+    return LocalProfileBuilder(credentials, get_asset_bucket())
+
+
+@tracing.traced('build.local')
+def _build_profile_locally(credentials, instance_id, facts):
+    """
+    Builds the profile for the kernel release in the facts of the instance 
+    in a local container.  Returns the final status of the build.
+    """
+    kernel_release = facts.get('kernel_release')
+
+    if kernel_release is None:
+        logger.warning('The kernel release of instance {} is unknown.  '
+            'Cannot build its profile locally.'.format(instance_id))
+        return 'Failed'
+
+    builder = _get_local_builder(credentials)
+
+    return builder.build(
+        _get_local_build_plan(
+            credentials, 
+            instance_id, 
+            kernel_release, 
+            get_distro(facts)
+        ), 
+        kernel_release, 
         instance_id
-    )['distros']['amzn2']['commands']
+    )
 
 
-def _build_profile_helper(ssm_client, instance_id, credentials):
+@tracing.traced('build.install_prebuilt')
+def _install_prebuilt_profile(registry, kernel_release, instance_id):
     """
-    Loads and runs the commands to build a rekall profile for the instance.
+    Installs a prebuilt profile for the kernel release from the registry.  
+    Returns False on a miss.
     """
-    build_commands = _get_build_commands(credentials, instance_id)
+    if kernel_release is None:
+        return False
+
+    if not registry.install(kernel_release, instance_id):
+        logger.info('No prebuilt profile for kernel {}.'.format(
+            kernel_release))
+        return False
+
+    print('Installed a prebuilt rekall profile for kernel {}.'.format(
+        kernel_release))
+
+    return True
+
+
+@tracing.traced('build.publish')
+def _publish_profile(registry, kernel_release, instance_id, status):
+    """Publishes a successful build to the registry."""
+    if kernel_release is not None and status == 'Success':
+        registry.publish(kernel_release, instance_id)
+
+
+def _install_fleet_profile(registry, kernel_release, instance_id):
+    """
+    Installs the profile for the kernel release on a fleet member that did 
+    not build it.  Returns 'Failed' if the registry has no profile for the 
+    release, e.g. because publishing the build failed, or the copy fails.
+    """
+    try:
+        installed = registry.install(kernel_release, instance_id)
+    except ClientError as e:
+        logger.error('Failed to install the profile for kernel {} for '
+            'instance {}: {}'.format(kernel_release, instance_id, e))
+        return 'Failed'
+
+    if not installed:
+        logger.error('No profile for kernel {} to install for instance '
+            '{}.'.format(kernel_release, instance_id))
+        return 'Failed'
+
+    return 'Success'
+
+
+def build_profile(ssm_client, instance_id, credentials, backend='instance'):
+    """
+    Builds a rekall profile for the specified EC2 instance and uploads it to 
+    the asset bucket as a .zip file.  Runs build_profile_async to 
+    completion.
+
+    Returns the final status of the build.
+    """
+    return asyncio.run(build_profile_async(
+        ssm_client, 
+        instance_id, 
+        credentials, 
+        backend=backend
+    ))
+
+
+def _group_by_kernel_release(kernel_releases, instance_ids):
+    """
+    Groups the instances by kernel release.  Instances whose release is 
+    unknown are returned separately.
+    """
+    groups = {}
+    unknown = []
+
+    for instance_id in instance_ids:
+        kernel_release = kernel_releases.get(instance_id)
+
+        if kernel_release is None:
+            unknown.append(instance_id)
+        else:
+            groups.setdefault(kernel_release, []).append(instance_id)
+
+    return groups, unknown
+
+
+@tracing.traced('build.fleet')
+def build_profile_fleet(ssm_client, instance_ids, credentials, 
+        backend='instance'):
+    """
+    Builds a rekall profile on each of the specified EC2 instances and 
+    uploads them to the asset bucket as .zip files.
+
+    Each kernel release is built at most once: instances with a release in 
+    the profile registry get the prebuilt profile, and for every other 
+    release one instance builds the profile, which is then published and 
+    installed for the rest.  With the 'local' backend, those builds run in 
+    local containers instead.
+
+    Returns the final status of the build for each instance id.
+    """
+    print('Build mode active for {} instances.'.format(len(instance_ids)))
+
+    registry = ProfileRegistry(credentials, get_asset_bucket())
+
+    fleet_facts = get_fleet_facts(ssm_client, instance_ids)
+
+    kernel_releases = dict(
+        (instance_id, facts.get('kernel_release'))
+        for instance_id, facts in fleet_facts.items()
+    )
+
+    groups, unknown = _group_by_kernel_release(kernel_releases, instance_ids)
+
+    statuses = {}
+    to_build = list(unknown)
+
+    for kernel_release, members in groups.items():
+        if registry.lookup(kernel_release) is None:
+            to_build.append(members[0])
+
+    logger.info('Building profiles on {} of {} instances.'.format(
+        len(to_build), 
+        len(instance_ids)
+    ))
+
+    if to_build and backend == 'local':
+        statuses.update(
+            (instance_id, _build_profile_locally(
+                credentials, 
+                instance_id, 
+                fleet_facts[instance_id]
+            ))
+            for instance_id in unknown
+        )
+
+        builds = []
+
+        for instance_id in to_build:
+            if instance_id in unknown:
+                continue
+
+            try:
+                build_plan = _get_local_build_plan(
+                    credentials, 
+                    instance_id, 
+                    kernel_releases[instance_id], 
+                    get_distro(fleet_facts[instance_id])
+                )
+            except UnsupportedInstanceError as e:
+                logger.warning('Skipping instance {}: {}'.format(
+                    instance_id, e))
+                statuses[instance_id] = 'Unsupported'
+                continue
+
+            builds.append(
+                (build_plan, kernel_releases[instance_id], instance_id)
+            )
+
+        statuses.update(_get_local_builder(credentials).build_many(builds))
+    elif to_build:
+        statuses.update(run_fleet_plan(
+            ssm_client, 
+            lambda distro: _get_build_plan(
+                credentials, 
+                FLEET_INSTANCE_ID, 
+                distro
+            ), 
+            to_build, 
+            fleet_facts
+        ))
+
+    for kernel_release, members in groups.items():
+        builder = members[0]
+
+        if builder in statuses:
+            _publish_profile(
+                registry, 
+                kernel_release, 
+                builder, 
+                statuses[builder]
+            )
+
+            if statuses[builder] != 'Success':
+                statuses.update(
+                    (instance_id, statuses[builder]) for instance_id in members
+                )
+                continue
+
+        for instance_id in members:
+            if instance_id not in statuses:
+                statuses[instance_id] = _install_fleet_profile(
+                    registry, 
+                    kernel_release, 
+                    instance_id
+                )
+
+    print('Build complete for the fleet.')
+
+    return statuses
+
+
+@tracing.traced('build.instance')
+async def _build_profile_helper_async(
+    ssm_client, 
+    instance_id, 
+    credentials, 
+    distro
+):
+    """
+    Loads and runs the commands to build a rekall profile for the instance.  
+    Returns the final status of the build.
+    """
+    build_plan = _get_build_plan(credentials, instance_id, distro)
 
     logger.info('Attempting to build a rekall profile for instance: {}.'\
         .format(instance_id))
-    
-    ensure_command(ssm_client, build_commands, instance_id)
+
+    invocation = await ensure_command_async(
+        ssm_client, 
+        build_plan['commands'], 
+        instance_id, 
+        timeout=build_plan.get('timeout'), 
+        expected_duration=build_plan.get('expected_duration')
+    )
 
     logger.info('Rekall profile build complete.')
 
-    logger.info(
-        'A .zip has been added to the asset store for instance: {}'.format(
-            instance_id
-        )
-    )
+    return invocation['Status']
 
 
-def build_profile(ssm_client, instance_id, credentials):
+@tracing.traced('build')
+async def build_profile_async(ssm_client, instance_id, credentials, 
+        backend='instance'):
     """
     Builds a rekall profile for the specified EC2 instance and uploads it to 
     the asset bucket as a .zip file.
+
+    The kernel release is taken from the facts of the instance.  If the 
+    profile registry already has a profile for it, that profile is used and 
+    nothing is built on the instance.  New builds are published to the 
+    registry.  With the 'local' backend, the profile is built in a local 
+    container instead of on the instance.
+
+    Returns the final status of the build.
     """
     print('Build mode active.')
 
-    _build_profile_helper(ssm_client, instance_id, credentials)
+    loop = asyncio.get_event_loop()
+    registry = ProfileRegistry(credentials, get_asset_bucket())
+
+    facts = await get_instance_facts_async(ssm_client, instance_id)
+    kernel_release = facts.get('kernel_release')
+
+    installed = await loop.run_in_executor(
+        None, 
+        tracing.bind(_install_prebuilt_profile), 
+        registry, 
+        kernel_release, 
+        instance_id
+    )
+
+    if installed:
+        return 'Success'
+
+    if backend == 'local':
+        status = await loop.run_in_executor(
+            None, 
+            tracing.bind(_build_profile_locally), 
+            credentials, 
+            instance_id, 
+            facts
+        )
+    else:
+        # The distro is taken from the facts in hand rather than the cache, 
+        # whose entry may have expired by now.
+        status = await _build_profile_helper_async(
+            ssm_client, 
+            instance_id, 
+            credentials, 
+            get_distro(facts)
+        )
+
+    await loop.run_in_executor(
+        None, 
+        tracing.bind(_publish_profile), 
+        registry, 
+        kernel_release, 
+        instance_id, 
+        status
+    )
+
+    print('Build completed with status: {}.'.format(status))
 
-    print('Build completed successfully.')
\ No newline at end of file
+    return status
@@ -1,41 +1,28 @@
 # -*- coding: utf-8 -*-
 
-"""Console script for ssm_acquire."""
-import boto3
+"""
+Console script for ssm_acquire.
+
+Only click and the light ssm_acquire modules are imported up front, so 
+--help and usage errors return right away.  boto3, docker, jinja2 and 
+prompt_toolkit are imported by the modes that need them.
+"""
 import sys
 import click
 import logging
 import ssm_acquire
 
-from ssm_acquire import analyze as da
+from contextlib import contextmanager
 
-from ssm_acquire.command import ensure_command
-from ssm_acquire.credential import get_credentials
+from ssm_acquire import fleet
 
-from ssm_acquire.acquire import dump_and_transfer
-from ssm_acquire.build import build_profile
-from ssm_acquire.interrogate import interrogate_instance
+from ssm_acquire.config import analyze_backends
+from ssm_acquire.config import build_backends
 
 
 logger = logging.getLogger(__name__)
 
 
-# TODO: throws error on valid instance; investigate analyze.py
-def analyze_capture(instance_id, credentials):
-    print('Analysis mode active.')
-    
-    analyzer = da.RekallManager(
-        instance_id,
-        credentials
-    )
-    
-    analyzer.download_incident_data()
-    analyzer.run_rekall_plugins()
-
-    print('Analysis complete.  The rekall-json dumps have been added to '
-        'the asset store.')
-
-
 def _set_logging_level(verbosity):
     """Sets the logging level based on the verbosity value."""
     if verbosity == 1:
@@ -44,14 +31,15 @@ def _set_logging_level(verbosity):
         logging.basicConfig(level=logging.DEBUG)
 
 
-def _valid_input(instance_id, region, analyze, acquire, build, interrogate):
+def _valid_input(instance_ids, tags, region, analyze, acquire, build, 
+        interrogate):
     """
     Checks if the input is valid.
     
-    Input is considered valid if the instance_id and region are provided, and 
-    at least one of the flags is specified.
+    Input is considered valid if at least one instance or tag filter and the 
+    region are provided, and at least one of the flags is specified.
     """
-    if instance_id is None:
+    if not (instance_ids or tags):
         logger.warning('No EC2 instance specified.  Run \'ssm_acquire '
             '--help\' for usage details.')
         return False
@@ -71,13 +59,17 @@ def _valid_input(instance_id, region, analyze, acquire, build, interrogate):
 
 def _get_ssm_client(credentials, region):
     """Gets SSM client that can send commands to the EC2 instance."""
-    return boto3.client(
+    import boto3
+
+    from ssm_acquire import tracing
+
+    return tracing.instrument(boto3.client(
         'ssm',
         aws_access_key_id=credentials['Credentials']['AccessKeyId'],
         aws_secret_access_key=credentials['Credentials']['SecretAccessKey'],
         aws_session_token=credentials['Credentials']['SessionToken'],
         region_name=region
-    )
+    ))
 
 
 def _resolve_flags(
@@ -87,27 +79,261 @@ def _resolve_flags(
     interrogate, 
     ssm_client, 
     instance_id, 
-    credentials
+    credentials, 
+    stream=False, 
+    build_backend='instance', 
+    analyze_backend='docker'
 ):
-    """Performs actions based on the flags set."""
-    if analyze:
-        analyze_capture(instance_id, credentials)
+    """
+    Performs actions based on the flags set.  Independent modes run 
+    concurrently; see ssm_acquire.scheduler.
+    """
+    from ssm_acquire.scheduler import run_phases
+
+    statuses = run_phases(
+        ssm_client, 
+        instance_id, 
+        credentials, 
+        analyze=analyze, 
+        acquire=acquire, 
+        build=build, 
+        interrogate=interrogate, 
+        stream=stream, 
+        build_backend=build_backend, 
+        analyze_backend=analyze_backend
+    )
+
+    for mode, status in statuses.items():
+        logger.info('{} finished with status: {}'.format(mode, status))
+
+
+def _get_ec2_client(credentials, region):
+    """Gets EC2 client that can look up instances by tag."""
+    import boto3
+
+    from ssm_acquire import tracing
+
+    return tracing.instrument(boto3.client(
+        'ec2',
+        aws_access_key_id=credentials['Credentials']['AccessKeyId'],
+        aws_secret_access_key=credentials['Credentials']['SecretAccessKey'],
+        aws_session_token=credentials['Credentials']['SessionToken'],
+        region_name=region
+    ))
+
+
+def _analyze_fleet(instance_ids, credentials, backend='docker'):
+    """
+    Analyzes the capture of each instance in turn.  A failed analysis does 
+    not stop the analysis of the remaining instances.
+    """
+    from ssm_acquire.analyze import analyze_capture
+
+    statuses = {}
+
+    for instance_id in instance_ids:
+        try:
+            analyze_capture(instance_id, credentials, backend)
+            statuses[instance_id] = 'Success'
+        except Exception as e:
+            logger.warning('Analysis failed for instance {}: {}'.format(
+                instance_id, 
+                e
+            ))
+            statuses[instance_id] = 'Failed'
+    
+    return statuses
+
+
+def _stage_artifacts(region):
+    """
+    Mirrors the tool binaries that plans run into the asset bucket.  See 
+    ssm_acquire.artifacts.
+    """
+    from ssm_acquire.artifacts import ArtifactStore
+    from ssm_acquire.config import get_asset_bucket
+    from ssm_acquire.credential import get_credentials
+
+    logger.info('Staging tool artifacts in the asset bucket.')
+
+    credentials = get_credentials(region, None)
+
+    staged = ArtifactStore(credentials, get_asset_bucket()).stage()
+
+    print('Staged {} tool artifacts: {}'.format(len(staged), staged))
+
+
+def _query_main_helper(query, instance_ids, region):
+    """
+    Runs the SQL query against the results database of each instance, or of 
+    every instance in the asset bucket, and prints the rows tab-separated 
+    with the instance id first.  See ssm_acquire.results.
+    """
+    from ssm_acquire.credential import get_credentials
+    from ssm_acquire.results import query_results
+
+    credentials = get_credentials(region, None)
+
+    header = None
+    count = 0
+
+    for instance_id, columns, row in query_results(
+        credentials, 
+        query, 
+        instance_ids
+    ):
+        if header is None:
+            header = ['instance_id'] + columns
+            print('\t'.join(header))
+
+        print('\t'.join(
+            [instance_id] + ['' if value is None else str(value) 
+                for value in row]
+        ))
+        count += 1
+
+    logger.info('The query returned {} rows.'.format(count))
+
+
+def _outliers_main_helper(instance_ids, tags, region, group_by):
+    """
+    Compares the results of the instances, or of every instance in the 
+    asset bucket, with the other instances of their group and prints the 
+    rows that are rare in the group.  See ssm_acquire.baseline.
+    """
+    from ssm_acquire.baseline import find_outliers
+    from ssm_acquire.credential import get_credentials
+    from ssm_acquire.results import download_results
+
+    credentials = get_credentials(region, None)
 
-    if acquire:
-        dump_and_transfer(ssm_client, instance_id, credentials)
+    if tags or group_by:
+        ec2_client = _get_ec2_client(credentials, region)
 
-    if build:
-        build_profile(ssm_client, instance_id, credentials)
+    if tags:
+        instance_ids = fleet.merge_instance_ids(
+            instance_ids, 
+            fleet.get_instance_ids_by_tags(ec2_client, tags)
+        )
 
-    if interrogate:
-        interrogate_instance(ssm_client, instance_id, credentials)
+        if not instance_ids:
+            logger.warning('No EC2 instances matched the tag filters.')
+            return
 
+    paths = list(download_results(credentials, instance_ids))
 
-def _main_helper(instance_id, region, build, acquire, interrogate, analyze):
+    groups = {}
+
+    if group_by:
+        groups = fleet.get_instance_tag_values(
+            ec2_client, 
+            [instance_id for instance_id, _ in paths], 
+            group_by
+        )
+
+    print('\t'.join(['instance_id', 'group', 'feature', 'row', 'hosts']))
+
+    for outlier in find_outliers(paths, groups):
+        print('\t'.join([
+            outlier['instance_id'], 
+            outlier['group'], 
+            outlier['feature'], 
+            ' '.join(str(value) for value in outlier['row']), 
+            '{}/{}'.format(outlier['hosts'], outlier['group_hosts'])
+        ]))
+
+
+@contextmanager
+def _traced_run(metrics_out, **attributes):
+    """
+    Records the spans of the body of the with statement in metrics_out, if 
+    given.  The root span ends with the error that stopped the run, if any.  
+    See ssm_acquire.tracing.
+    """
+    if not metrics_out:
+        yield
+        return
+
+    from ssm_acquire import tracing
+
+    tracing.enable(metrics_out, **attributes)
+
+    try:
+        yield
+    except BaseException as e:
+        tracing.finish(e)
+        raise
+    else:
+        tracing.finish()
+
+
+def _fleet_main_helper(instance_ids, tags, region, build, acquire, 
+        interrogate, analyze, stream=False, build_backend='instance', 
+        analyze_backend='docker'):
+    """
+    Gets the tools needed to send commands to a fleet of EC2 instances and 
+    runs commands based on the set flags.  Prints a per-instance report at 
+    the end.
+    """
+    from ssm_acquire.credential import get_credentials
+
+    logger.info('Initializing ssm_acquire in fleet mode.')
+
+    # Credentials are scoped to the whole asset bucket rather than a single 
+    # instance's prefix.
+    credentials = get_credentials(region, None)
+
+    if tags:
+        instance_ids = fleet.merge_instance_ids(
+            instance_ids, 
+            fleet.get_instance_ids_by_tags(
+                _get_ec2_client(credentials, region), 
+                tags
+            )
+        )
+
+    if not instance_ids:
+        logger.warning('No EC2 instances matched the tag filters.')
+        return
+
+    from ssm_acquire import tracing
+
+    tracing.current_span().set(instances=len(instance_ids))
+
+    ssm_client = _get_ssm_client(credentials, region)
+
+    results = fleet.run_fleet(
+        ssm_client, 
+        instance_ids, 
+        credentials, 
+        acquire, 
+        build, 
+        interrogate, 
+        stream=stream, 
+        build_backend=build_backend
+    )
+
+    if analyze:
+        results['analyze'] = _analyze_fleet(
+            instance_ids, 
+            credentials, 
+            analyze_backend
+        )
+
+    fleet.print_report(instance_ids, results)
+
+    logger.info('ssm_acquire has completed for the fleet.')
+
+
+def _main_helper(instance_id, region, build, acquire, interrogate, analyze, 
+        stream=False, build_backend='instance', 
+        analyze_backend='docker'):
     """
     Gets the tools needed to send commands to the EC2 instance and runs 
     commands based on the set flags.
     """
+    from ssm_acquire.credential import get_credentials
+
     logger.info('Initializing ssm_acquire.')
 
     credentials = get_credentials(region, instance_id)
@@ -121,58 +347,268 @@ def _main_helper(instance_id, region, build, acquire, interrogate, analyze):
         interrogate, 
         ssm_client, 
         instance_id, 
-        credentials
+        credentials, 
+        stream=stream, 
+        build_backend=build_backend, 
+        analyze_backend=analyze_backend
     )
     
     logger.info('ssm_acquire has completed successfully.')
 
 
+def _get_queue(queue, region):
+    """
+    Returns the SQS queue at an https:// url, or else the local queue in the 
+    file at that path.
+    """
+    from ssm_acquire import worker
+
+    if not queue.startswith('https://'):
+        return worker.LocalQueue(queue)
+
+    import boto3
+
+    from ssm_acquire import tracing
+
+    # The queue is read with the worker's own credentials.
+    return worker.SQSQueue(
+        tracing.instrument(boto3.client('sqs', region_name=region)), 
+        queue
+    )
+
+
+def _worker_main_helper(queue, region, build, acquire, interrogate, analyze, 
+        stream=False, build_backend='instance', 
+        analyze_backend='docker'):
+    """
+    Runs the flagged modes for every instance named on the queue.  See 
+    ssm_acquire.worker.
+    """
+    from ssm_acquire import worker
+    from ssm_acquire.credential import get_credentials
+    from ssm_acquire.scheduler import run_phases
+
+    logger.info('Initializing ssm_acquire in worker mode.')
+
+    def run_job(job):
+        credentials = get_credentials(job.region, job.instance_id)
+
+        return run_phases(
+            _get_ssm_client(credentials, job.region), 
+            job.instance_id, 
+            credentials, 
+            analyze=analyze, 
+            acquire=acquire, 
+            build=build, 
+            interrogate=interrogate, 
+            stream=stream, 
+            build_backend=build_backend, 
+            analyze_backend=analyze_backend
+        )
+
+    queue = _get_queue(queue, region)
+
+    results = worker.Worker(queue, run_job, region).run(
+        # A local queue is a stand-in for testing and stops once drained.
+        exit_when_idle=isinstance(queue, worker.LocalQueue)
+    )
+
+    logger.info('ssm_acquire worker handled {} instances.'.format(
+        len(results)))
+
+
 @click.command()
 @click.option('--instance_id', help='The EC2 instance you would like to '
     'operate on.')
+@click.option('--instance_ids', help='Comma-separated EC2 instances you '
+    'would like to operate on as a fleet.')
+@click.option('--instance_file', type=click.Path(exists=True), help='File '
+    'with one EC2 instance id per line to operate on as a fleet.')
+@click.option('--tag', multiple=True, help='Operate on every running EC2 '
+    'instance with this tag, as Key=Value.  May be given more than once; '
+    'instances must match all tags.')
 @click.option('--region', help='The AWS region where the instance can be '
     'found.  Example: us-east-1')
 @click.option('--build', is_flag=True, help='Specify if you would like to '
     'build a rekall profile with this capture.')
+@click.option('--build_backend', type=click.Choice(build_backends), 
+    default='instance', help='Where to build the rekall profile: on the '
+    'instance, or in a local container for the instance\'s kernel release '
+    'so that no compilers are installed on the instance.')
 @click.option('--acquire', is_flag=True, help='Use linpmem to acquire a '
     'memory sample from the system in question.')
+@click.option('--stream', is_flag=True, help='With --acquire, upload the '
+    'memory sample while it is being dumped instead of writing it to the '
+    'instance\'s disk first.')
 @click.option('--interrogate', is_flag=True, help='Use OSQuery binary to '
     'preserve top 10 type queries for rapid forensics.')
 @click.option('--analyze', is_flag=True, help='Use docker and rekall to '
     'autoanalyze the memory capture.')
+@click.option('--analyze_backend', type=click.Choice(analyze_backends), 
+    default='docker', help='How to analyze the memory capture: rekall in '
+    'the threatresponse/rekall container, or volatility3 in this process, '
+    'which needs neither docker nor a container image.')
+@click.option('--stage_artifacts', is_flag=True, help='Mirror the tool '
+    'binaries that plans run into the asset bucket, so that instances do not '
+    'download them from the internet.')
+@click.option('--queue', help='Run as a worker that handles the instances '
+    'named on this queue, an SQS queue url or a local file with one message '
+    'per line, with the flagged modes.  Messages are instance ids or '
+    'GuardDuty findings.')
+@click.option('--query', help='Run this SQL query against the results '
+    'database of the given instances, or of every instance in the asset '
+    'bucket, e.g. "SELECT * FROM sockets WHERE local_port = 4444".  Tables: '
+    'processes, sockets, interfaces, kernel_modules and yara_hits.')
+@click.option('--outliers', is_flag=True, help='Compare the results of '
+    'the given instances, or of every instance in the asset bucket, with '
+    'the rest of their group and print the processes, ports, kernel modules '
+    'and other rows that few of them have.')
+@click.option('--group_by', help='With --outliers, group the instances by '
+    'the value of this tag, e.g. Role.  By default they are one group.')
 @click.option('--deploy', is_flag=True, help='Create a lambda function with '
     'a handler to take events from AWS GuardDuty.\nNOTE: not implemented')
+@click.option('--metrics_out', type=click.Path(dir_okay=False), help='Write '
+    'the timing, bytes moved and AWS API calls of every phase of the run to '
+    'this file, as JSON lines, or as a JSON list if it ends in .json.')
 @click.option('--verbosity', default=0, help='Sets verbosity level. '
     'Default=0=WARNING; 1=INFO; 2=DEBUG. See '
     'https://docs.python.org/3/howto/logging.html for more details on the '
     'logging levels.')
 def main(
     instance_id, 
+    instance_ids, 
+    instance_file, 
+    tag, 
     region, 
     build, 
+    build_backend, 
     acquire, 
+    stream, 
     interrogate, 
     analyze, 
+    analyze_backend, 
+    stage_artifacts, 
+    queue, 
+    query, 
+    outliers, 
+    group_by, 
     deploy, 
+    metrics_out, 
     verbosity
 ):
     """ssm_acquire: a rapid evidence preservation tool for Amazon EC2."""
 
     _set_logging_level(verbosity)
 
-    if not _valid_input(
-        instance_id, 
-        region, 
-        analyze, 
-        acquire, 
-        build, 
-        interrogate
+    with _traced_run(
+        metrics_out, 
+        region=region, 
+        modes=[
+            mode for mode, enabled in (
+                ('acquire', acquire), 
+                ('build', build), 
+                ('interrogate', interrogate), 
+                ('analyze', analyze), 
+                ('stage_artifacts', stage_artifacts), 
+                ('query', query), 
+                ('outliers', outliers)
+            )
+            if enabled
+        ], 
+        stream=stream, 
+        build_backend=build_backend, 
+        analyze_backend=analyze_backend
     ):
-        return 1
+        if stage_artifacts:
+            _stage_artifacts(region)
+
+            if not (instance_id or instance_ids or instance_file or tag):
+                return 0
+
+        explicit_instance_ids = fleet.get_explicit_instance_ids(
+            instance_id, 
+            instance_ids, 
+            instance_file
+        )
+
+        if query:
+            if region is None:
+                logger.warning('No AWS region specified.  Run \'ssm_acquire '
+                    '--help\' for usage details.')
+                return 1
+
+            _query_main_helper(query, explicit_instance_ids, region)
+
+            return 0
+
+        if outliers:
+            if region is None:
+                logger.warning('No AWS region specified.  Run \'ssm_acquire '
+                    '--help\' for usage details.')
+                return 1
+
+            _outliers_main_helper(explicit_instance_ids, tag, region, group_by)
+
+            return 0
+
+        if queue:
+            if region is None or not (analyze or acquire or build or interrogate):
+                logger.warning('A worker needs a region and at least one flag.  '
+                    'Run \'ssm_acquire --help\' for usage details.')
+                return 1
+
+            _worker_main_helper(
+                queue, 
+                region, 
+                build, 
+                acquire, 
+                interrogate, 
+                analyze, 
+                stream=stream, 
+                build_backend=build_backend, 
+                analyze_backend=analyze_backend
+            )
+
+            return 0
+
+        if not _valid_input(
+            explicit_instance_ids, 
+            tag, 
+            region, 
+            analyze, 
+            acquire, 
+            build, 
+            interrogate
+        ):
+            return 1
     
-    _main_helper(instance_id, region, build, acquire, interrogate, analyze)
+        if len(explicit_instance_ids) > 1 or tag:
+            _fleet_main_helper(
+                explicit_instance_ids, 
+                tag, 
+                region, 
+                build, 
+                acquire, 
+                interrogate, 
+                analyze, 
+                stream=stream, 
+                build_backend=build_backend, 
+                analyze_backend=analyze_backend
+            )
+        else:
+            _main_helper(
+                explicit_instance_ids[0], 
+                region, 
+                build, 
+                acquire, 
+                interrogate, 
+                analyze, 
+                stream=stream, 
+                build_backend=build_backend, 
+                analyze_backend=analyze_backend
+            )
     
-    return 0
+        return 0
 
 
 if __name__ == '__main__':
@@ -1,26 +1,122 @@
+import asyncio
 import itertools
 import logging
+import random
 import sys
 import time
 
 from botocore.exceptions import ClientError
 
+from ssm_acquire import tracing
+from ssm_acquire.progress import ProgressReport
+
 
 logger = logging.getLogger(__name__)
 
 spinner = itertools.cycle(['-', '/', '|', '\\'])
 
+# SendCommand accepts at most 50 instance ids per call.
+MAX_INSTANCES_PER_COMMAND = 50
+
+# Statuses after which an invocation does not change any more.
+FINAL_STATUSES = ('Success', 'Cancelled', 'TimedOut', 'Failed')
+
+# Bounds on the delay between two polls of the same command, in seconds.
+_MIN_POLL_DELAY = 0.2
+_MAX_POLL_DELAY = 30.0
+
+# Deadline of a fleet command whose plan has no timeout, in seconds.  SSM
+# stops a command on the instance after an hour by default; the rest allows
+# for delivering it to every batch.
+_DEFAULT_FLEET_TIMEOUT = 3600 + 600
+
+# How long a fleet waiter waits for SSM to report a cancellation, in seconds.
+_CANCEL_GRACE_PERIOD = 300
+
+# Highest power of two of the backoff; see Backoff.next_delay.
+_MAX_BACKOFF_EXPONENT = 32
+
+# Error codes that mean "ask again later" rather than "something is wrong".
+_RETRYABLE_ERROR_CODES = (
+    'InvocationDoesNotExist',
+    'ThrottlingException',
+    'Throttling'
+)
+
+
+class Backoff(object):
+    """
+    Exponential backoff with jitter for polling an SSM command.
+
+    The delay starts at min_delay and doubles on every poll.  It is capped at
+    a tenth of the step's expected duration, so a quick step is noticed soon
+    after it finishes and a step that takes minutes is polled a few times a
+    minute instead of twice a second.
+    """
+    def __init__(
+        self,
+        expected_duration=None,
+        min_delay=_MIN_POLL_DELAY,
+        max_delay=_MAX_POLL_DELAY
+    ):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+
+        if expected_duration:
+            self.max_delay = min(
+                max_delay,
+                max(min_delay, expected_duration / 10.0)
+            )
+
+        self.attempt = 0
+
+    def next_delay(self):
+        """Returns the time to wait before the next poll."""
+        # The exponent is capped so that a long wait cannot overflow it; 
+        # max_delay is reached long before.
+        delay = min(
+            self.max_delay,
+            self.min_delay * 2 ** min(self.attempt, _MAX_BACKOFF_EXPONENT)
+        )
+
+        self.attempt += 1
+
+        # Jitter keeps concurrent responders from polling in lockstep.
+        return random.uniform(delay / 2, delay)
+
+    def throttled(self):
+        """Skips ahead in the schedule after SSM throttled a poll."""
+        self.attempt += 2
+
+    def reset(self):
+        """Starts the schedule again from min_delay."""
+        self.attempt = 0
+
+
+def _get_parameters(commands, timeout):
+    """
+    Gets the AWS-RunShellScript parameters.  The on-host execution timeout
+    defaults to one hour, so it is raised to the plan's timeout if one is
+    set.
+    """
+    parameters = {
+        "commands": commands
+    }
+
+    if timeout:
+        parameters['executionTimeout'] = [str(int(timeout))]
+
+    return parameters
 
-def _run_command(ssm_client, commands, instance_id):
+
+def _run_command(ssm_client, commands, instance_id, timeout=None):
     """Runs an SSM command and returns the boto3 response."""
     # XXX TBD add a test to see if another invocation is pending and raise if waiting.
     response = ssm_client.send_command(
         InstanceIds=[instance_id],
         DocumentName='AWS-RunShellScript',
         Comment='Incident response step execution for: {}'.format(instance_id),
-        Parameters={
-            "commands": commands
-        }
+        Parameters=_get_parameters(commands, timeout)
     )
 
     return response
@@ -33,49 +129,6 @@ def _show_next_cycle_frame():
     sys.stdout.write('\b')
 
 
-def _is_invocation_registered(ssm_client, response, instance_id):
-    """Polls the ssm_client to see if the SSM command has been received."""
-
-    invocation_registered = False
-    
-    try:
-        ssm_client.get_command_invocation(
-            CommandId=response['Command']['CommandId'],
-            InstanceId=instance_id
-        )
-
-        logger.debug('Invocation registered.  Please wait...')
-
-        invocation_registered = True
-    except ClientError as e:
-        logger.debug('Invocation not yet registered with error code: {}.  '
-            'Please wait...'.format(e.response['Error']['Code']))
-    
-    return invocation_registered
-
-
-def _ensure_invocation_registered(ssm_client, response, instance_id):
-    """Ensures that the ssm_client has received commands before the function 
-    returns."""
-
-    invocation_registered = _is_invocation_registered(
-        ssm_client, 
-        response, 
-        instance_id
-    )
-
-    while not invocation_registered:
-        _show_next_cycle_frame()
-
-        time.sleep(0.5)
-
-        invocation_registered = _is_invocation_registered(
-            ssm_client, 
-            response, 
-            instance_id
-        )
-
-
 def _evaluate_status(status):
     """Evaluates completion status str and returns its bool equivalent."""
 
@@ -95,45 +148,602 @@ def _evaluate_status(status):
     elif status == 'Failed':
         finished = True
         print('SSM command failed.')
-    
+
     return finished
 
 
-def _is_command_finished(ssm_client, response, instance_id):
-    """Polls the ssm_client to see if the SSM command has completed."""
+def cancel_command(ssm_client, command_id, instance_ids=None):
+    """
+    Cancels an SSM command, for all of its instances unless instance_ids is
+    given.
+    """
+    kwargs = {'CommandId': command_id}
 
-    status = ssm_client.get_command_invocation(
-        CommandId=response['Command']['CommandId'],
-        InstanceId=instance_id
-    )['Status']
+    if instance_ids:
+        kwargs['InstanceIds'] = instance_ids
 
-    finished = _evaluate_status(status)
+    try:
+        ssm_client.cancel_command(**kwargs)
+    except ClientError as e:
+        logger.warning('Could not cancel command {}: {}'.format(
+            command_id,
+            e.response['Error']['Code']
+        ))
+
+
+class _Deadline(object):
+    """Tracks a timeout in seconds from now.  A timeout of None never ends."""
+    def __init__(self, timeout):
+        self.expires_at = None
+
+        if timeout:
+            self.expires_at = time.time() + timeout
+
+    def expired(self):
+        return self.expires_at is not None and time.time() >= self.expires_at
+
+    def clamp(self, delay):
+        """Shortens the delay so that it does not overshoot the deadline."""
+        if self.expires_at is None:
+            return delay
+
+        return max(0, min(delay, self.expires_at - time.time()))
+
+
+class CommandWaiter(object):
+    """
+    Waits for an SSM command to finish on one instance.
+
+    A single poll loop covers both the "not yet registered" and the "in
+    progress" phases.  If the timeout is hit the command is cancelled and
+    the waiter keeps polling until SSM reports the cancellation.  Progress
+    markers in the output of the running command are printed as they
+    change; see ssm_acquire.progress.
+    """
+    def __init__(
+        self,
+        ssm_client,
+        command_id,
+        instance_id,
+        timeout=None,
+        expected_duration=None
+    ):
+        self.ssm_client = ssm_client
+        self.command_id = command_id
+        self.instance_id = instance_id
+        self.timeout = timeout
+        self.deadline = _Deadline(timeout)
+        self.backoff = Backoff(expected_duration)
+        self.cancelled = False
+        self.progress = ProgressReport()
+
+    def _get_invocation(self):
+        """
+        Returns the command invocation, or None if it is not registered yet
+        or SSM throttled the call.
+        """
+        try:
+            return self.ssm_client.get_command_invocation(
+                CommandId=self.command_id,
+                InstanceId=self.instance_id
+            )
+        except ClientError as e:
+            code = e.response['Error']['Code']
+
+            if code not in _RETRYABLE_ERROR_CODES:
+                raise
+
+            if code != 'InvocationDoesNotExist':
+                self.backoff.throttled()
+
+            logger.debug('Invocation not yet available with error code: '
+                '{}.  Please wait...'.format(code))
+
+            return None
+
+    def _cancel(self):
+        logger.warning('SSM command {} exceeded its timeout of {} seconds on '
+            'instance {}.  Cancelling.'.format(
+                self.command_id,
+                self.timeout,
+                self.instance_id
+            ))
+
+        cancel_command(self.ssm_client, self.command_id, [self.instance_id])
+
+        self.cancelled = True
+        self.backoff.reset()
+
+    def poll(self):
+        """
+        Polls the command once.  Returns the final invocation if the command
+        has finished, otherwise None.
+        """
+        invocation = self._get_invocation()
+
+        if invocation is not None:
+            logger.debug('Invocation status: {}'.format(invocation['Status']))
+
+            progress = self.progress.update(
+                self.instance_id,
+                invocation.get('StandardOutputContent')
+            )
+
+            if _evaluate_status(invocation['Status']):
+                self.progress.finish(self.instance_id, invocation['Status'])
+                return invocation
+
+            if progress is not None:
+                print('{} {}'.format(self.instance_id, progress))
+
+        if not self.cancelled and self.deadline.expired():
+            self._cancel()
+
+        return None
+
+    def next_delay(self):
+        """Returns the time to wait before the next poll."""
+        delay = self.backoff.next_delay()
+
+        # Past the deadline the backoff restarted at the cancel, so the 
+        # cancellation is seen soon without polling at min_delay for good.
+        if self.cancelled:
+            return delay
+
+        return self.deadline.clamp(delay)
+
+
+def submit_command(ssm_client, commands, instance_id, timeout=None):
+    """
+    Sends an SSM command without waiting for it.  Returns the command id to
+    read the invocation with, see check_command.
+    """
+    with tracing.span('ssm.send_command', instance_id=instance_id):
+        response = _run_command(ssm_client, commands, instance_id, timeout)
+
+    return response['Command']['CommandId']
+
+
+def check_command(ssm_client, command_id, instance_id):
+    """
+    Reads the invocation of an SSM command once, without waiting.  Returns
+    None if it is not registered yet or SSM throttled the call.
+    """
+    try:
+        return ssm_client.get_command_invocation(
+            CommandId=command_id,
+            InstanceId=instance_id
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] not in _RETRYABLE_ERROR_CODES:
+            raise
+
+        return None
+
+
+def ensure_command(
+    ssm_client,
+    commands,
+    instance_id,
+    timeout=None,
+    expected_duration=None
+):
+    """
+    Runs an SSM command and ensures that it completes before the function
+    returns.
+
+    The command is cancelled if it runs longer than timeout seconds.
+    expected_duration is a hint, in seconds, that sets how often the command
+    is polled.
+
+    Returns the final command invocation.
+    """
+
+    with tracing.span('ssm.command', instance_id=instance_id):
+        # will throw an error citing "invalid instance id" when ec2
+        # instance can't be seen by the program
+        with tracing.span('ssm.send_command'):
+            response = _run_command(ssm_client, commands, instance_id, timeout)
+
+        waiter = CommandWaiter(
+            ssm_client,
+            response['Command']['CommandId'],
+            instance_id,
+            timeout=timeout,
+            expected_duration=expected_duration
+        )
 
-    return finished
+        with tracing.span('ssm.execution') as span:
+            invocation = waiter.poll()
+
+            while invocation is None:
+                _show_next_cycle_frame()
+
+                time.sleep(waiter.next_delay())
+
+                invocation = waiter.poll()
+
+            span.set(status=invocation['Status'])
+
+    return invocation
+
+
+async def ensure_command_async(
+    ssm_client,
+    commands,
+    instance_id,
+    timeout=None,
+    expected_duration=None
+):
+    """
+    Coroutine version of ensure_command.  The blocking SSM calls run in the
+    event loop's default executor so that other steps can make progress
+    while this one waits.
+
+    Returns the final command invocation.
+    """
+    loop = asyncio.get_event_loop()
+
+    with tracing.span('ssm.command', instance_id=instance_id):
+        with tracing.span('ssm.send_command'):
+            response = await loop.run_in_executor(
+                None,
+                tracing.bind(_run_command),
+                ssm_client,
+                commands,
+                instance_id,
+                timeout
+            )
+
+        waiter = CommandWaiter(
+            ssm_client,
+            response['Command']['CommandId'],
+            instance_id,
+            timeout=timeout,
+            expected_duration=expected_duration
+        )
+
+        with tracing.span('ssm.execution') as span:
+            poll = tracing.bind(waiter.poll)
 
+            invocation = await loop.run_in_executor(None, poll)
 
-def _ensure_command_finished(ssm_client, response, instance_id):
-    """Ensures that the registered commands are completed before the function 
-    returns."""
+            while invocation is None:
+                await asyncio.sleep(waiter.next_delay())
 
-    finished = _is_command_finished(ssm_client, response, instance_id)
+                invocation = await loop.run_in_executor(None, poll)
 
-    while not finished:
-        _show_next_cycle_frame()
+            span.set(status=invocation['Status'])
 
-        time.sleep(0.5)
+    return invocation
 
-        finished = _is_command_finished(ssm_client, response, instance_id)
 
+def _get_batches(instance_ids, batch_size=MAX_INSTANCES_PER_COMMAND):
+    """Splits the instance ids into lists of at most batch_size ids."""
+    return [
+        instance_ids[i:i + batch_size]
+        for i in range(0, len(instance_ids), batch_size)
+    ]
 
-def ensure_command(ssm_client, commands, instance_id):
-    """Runs an SSM command and ensures that it completes before the function 
-    returns."""
 
-    # will throw an error citing "invalid instance id" when ec2 
-    # instance can't be seen by the program
-    response = _run_command(ssm_client, commands, instance_id)
+def _run_fleet_command(ssm_client, commands, batch, timeout=None):
+    """
+    Runs an SSM command on a batch of instances.  Returns the command id of 
+    every part of the batch it was sent to, and the instance ids it could 
+    not be sent to.
 
-    _ensure_invocation_registered(ssm_client, response, instance_id)
+    SSM refuses the whole batch if one of its instances is not managed by 
+    SSM, so a batch refused with InvalidInstanceId is split in halves until 
+    the command reaches every other instance.
+    """
+    try:
+        response = ssm_client.send_command(
+            InstanceIds=batch,
+            DocumentName='AWS-RunShellScript',
+            Comment='Incident response step execution for {} '
+                    'instances.'.format(len(batch)),
+            Parameters=_get_parameters(commands, timeout)
+        )
+    except ClientError as e:
+        code = e.response['Error']['Code']
+
+        if code == 'InvalidInstanceId' and len(batch) > 1:
+            middle = len(batch) // 2
+            sent, failed = _run_fleet_command(
+                ssm_client,
+                commands,
+                batch[:middle],
+                timeout
+            )
+            more_sent, more_failed = _run_fleet_command(
+                ssm_client,
+                commands,
+                batch[middle:],
+                timeout
+            )
+
+            sent.update(more_sent)
+
+            return sent, failed + more_failed
+
+        logger.warning('Could not send command to {}: {}'.format(batch, code))
+
+        return {}, list(batch)
+
+    return {response['Command']['CommandId']: batch}, []
+
+
+def _list_invocations(ssm_client, command_id, details=False):
+    """
+    Returns every registered invocation of an SSM command, keyed by instance
+    id.  With details, the invocations carry the output of their plugins,
+    which SSM truncates to 2500 characters.
+    """
+    invocations = {}
+
+    paginator = ssm_client.get_paginator('list_command_invocations')
+
+    for page in paginator.paginate(CommandId=command_id, Details=details):
+        for invocation in page['CommandInvocations']:
+            invocations[invocation['InstanceId']] = invocation
+
+    return invocations
+
+
+def _get_output(invocation):
+    """Returns the output of a detailed invocation."""
+    return ''.join(
+        plugin.get('Output', '')
+        for plugin in invocation.get('CommandPlugins', [])
+    )
+
+
+def _is_batch_finished(batch, statuses):
+    """Checks if every instance of the batch has reached a final status."""
+    return all(
+        statuses.get(instance_id) in FINAL_STATUSES
+        for instance_id in batch
+    )
 
-    _ensure_command_finished(ssm_client, response, instance_id)
\ No newline at end of file
+
+class FleetCommandWaiter(object):
+    """
+    Waits for SSM commands sent to batches of instances to finish.
+
+    Every pending batch is polled with one list_command_invocations call per
+    poll, using the same backoff and timeout rules as CommandWaiter.  With
+    track_progress, the call includes the output of the invocations and a
+    summary of their progress markers is printed as it changes.
+
+    Without a timeout, the commands are cancelled after 
+    _DEFAULT_FLEET_TIMEOUT seconds.  Instances whose cancellation SSM has 
+    not reported _CANCEL_GRACE_PERIOD seconds later are given up as 
+    TimedOut, so the waiter always ends.
+    """
+    def __init__(
+        self,
+        ssm_client,
+        pending,
+        timeout=None,
+        expected_duration=None,
+        collect_output=False,
+        track_progress=False
+    ):
+        self.ssm_client = ssm_client
+        self.pending = dict(pending)
+        self.timeout = timeout or _DEFAULT_FLEET_TIMEOUT
+        self.deadline = _Deadline(self.timeout)
+        self.backoff = Backoff(expected_duration)
+        self.cancelled = False
+        self.statuses = {}
+        self.collect_output = collect_output
+        self.outputs = {}
+        self.progress = ProgressReport() if track_progress else None
+
+    def _poll_batch(self, command_id, batch):
+        """Polls a batch once.  Returns True if any progress was made."""
+        details = self.collect_output or self.progress is not None
+
+        try:
+            invocations = _list_invocations(
+                self.ssm_client,
+                command_id,
+                details=details
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] not in _RETRYABLE_ERROR_CODES:
+                raise
+
+            self.backoff.throttled()
+            return False
+
+        progressed = False
+
+        for instance_id, invocation in invocations.items():
+            self.statuses[instance_id] = invocation['Status']
+
+            if self.progress is None:
+                continue
+
+            if invocation['Status'] in FINAL_STATUSES:
+                self.progress.finish(instance_id, invocation['Status'])
+                continue
+
+            progress = self.progress.update(
+                instance_id,
+                _get_output(invocation)
+            )
+
+            if progress is not None:
+                logger.info('{} {}'.format(instance_id, progress))
+                progressed = True
+
+        if _is_batch_finished(batch, self.statuses):
+            logger.debug('Command {} finished on all {} instances.'.format(
+                command_id,
+                len(batch)
+            ))
+
+            if self.collect_output:
+                self.outputs.update(
+                    (instance_id, _get_output(invocation))
+                    for instance_id, invocation in invocations.items()
+                )
+
+            del self.pending[command_id]
+
+        return progressed
+
+    def _cancel(self):
+        logger.warning('SSM commands exceeded their timeout of {} seconds on '
+            '{} batches.  Cancelling.'.format(self.timeout, len(self.pending)))
+
+        for command_id in self.pending:
+            cancel_command(self.ssm_client, command_id)
+
+        self.cancelled = True
+        self.deadline = _Deadline(_CANCEL_GRACE_PERIOD)
+        self.backoff.reset()
+
+    def _give_up(self):
+        logger.warning('SSM did not report the cancellation of {} batches.  '
+            'Giving up on them.'.format(len(self.pending)))
+
+        for batch in self.pending.values():
+            self.statuses.update(
+                (instance_id, 'TimedOut') for instance_id in batch
+                if self.statuses.get(instance_id) not in FINAL_STATUSES
+            )
+
+        self.pending.clear()
+
+    def poll(self):
+        """
+        Polls every pending batch once.  Returns True once all batches have
+        finished.
+        """
+        progressed = False
+
+        for command_id, batch in list(self.pending.items()):
+            progressed = self._poll_batch(command_id, batch) or progressed
+
+        if progressed:
+            print(self.progress.summary())
+
+        if self.pending and self.deadline.expired():
+            if self.cancelled:
+                self._give_up()
+            else:
+                self._cancel()
+
+        return not self.pending
+
+    def next_delay(self):
+        """Returns the time to wait before the next poll."""
+        delay = self.backoff.next_delay()
+
+        # Past the deadline the backoff restarted at the cancel, so the 
+        # cancellation is seen soon without polling at min_delay for good.
+        if self.cancelled:
+            return delay
+
+        return self.deadline.clamp(delay)
+
+
+def _count_statuses(statuses):
+    """Returns how many instances ended with each status."""
+    counts = {}
+
+    for status in statuses.values():
+        counts[status] = counts.get(status, 0) + 1
+
+    return counts
+
+
+def ensure_fleet_command(
+    ssm_client,
+    commands,
+    instance_ids,
+    timeout=None,
+    expected_duration=None
+):
+    """
+    Runs an SSM command on many instances and ensures that it completes on
+    all of them before the function returns.
+
+    One command is sent per batch of MAX_INSTANCES_PER_COMMAND instances, and
+    all batches are polled together with one list_command_invocations call
+    per batch.  A failure on one instance does not stop the others.
+
+    Returns the final status of the command for each instance id.
+    """
+    statuses = {}
+    pending = {}
+
+    with tracing.span('ssm.fleet_command', instances=len(instance_ids)):
+        with tracing.span('ssm.send_command'):
+            for batch in _get_batches(instance_ids):
+                sent, failed = _run_fleet_command(
+                    ssm_client,
+                    commands,
+                    batch,
+                    timeout
+                )
+
+                pending.update(sent)
+                statuses.update((instance_id, 'SendFailed')
+                    for instance_id in failed)
+
+        waiter = FleetCommandWaiter(
+            ssm_client,
+            pending,
+            timeout=timeout,
+            expected_duration=expected_duration,
+            track_progress=True
+        )
+
+        with tracing.span('ssm.execution') as span:
+            while not waiter.poll():
+                _show_next_cycle_frame()
+
+                time.sleep(waiter.next_delay())
+
+            statuses.update(waiter.statuses)
+
+            span.set(statuses=_count_statuses(statuses))
+
+    return statuses
+
+
+def run_fleet_probe(ssm_client, commands, instance_ids, timeout=None):
+    """
+    Runs a short SSM command on many instances and returns its output for
+    each instance where it succeeded.  The output is truncated to 2500
+    characters, so probes should print little.
+    """
+    pending = {}
+
+    with tracing.span('ssm.send_command'):
+        for batch in _get_batches(instance_ids):
+            sent, _ = _run_fleet_command(ssm_client, commands, batch, timeout)
+
+            pending.update(sent)
+
+    waiter = FleetCommandWaiter(
+        ssm_client,
+        pending,
+        timeout=timeout,
+        collect_output=True
+    )
+
+    with tracing.span('ssm.execution') as span:
+        while not waiter.poll():
+            time.sleep(waiter.next_delay())
+
+        span.set(statuses=_count_statuses(waiter.statuses))
+
+    return dict(
+        (instance_id, output)
+        for instance_id, output in waiter.outputs.items()
+        if waiter.statuses.get(instance_id) == 'Success'
+    )
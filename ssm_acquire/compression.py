@@ -0,0 +1,160 @@
+"""
+Compression of memory captures on the instance.
+
+With capture_compression set to gzip or zstd, the acquire plans pipe an ELF
+capture through a parallel compressor (pigz or zstd -T0) instead of writing
+capture.aff4, and the upload records the codec in the object's metadata.
+When incident data is downloaded, compressed captures are expanded back to
+capture.elf next to the download.
+"""
+import gzip
+import logging
+import os
+import shutil
+import subprocess
+
+from ssm_acquire.config import config_manager
+
+
+config = config_manager
+logger = logging.getLogger(__name__)
+
+# The name of a capture once it is decompressed.
+UNCOMPRESSED_NAME = 'capture.elf'
+
+# User metadata of compressed captures.  S3 returns the keys without the
+# x-amz-meta- prefix.
+CODEC_METADATA_KEY = 'ssm-acquire-codec'
+LEVEL_METADATA_KEY = 'ssm-acquire-level'
+NAME_METADATA_KEY = 'ssm-acquire-uncompressed-name'
+
+# Levels each codec accepts and its default.
+CODECS = {
+    'none': None,
+    'gzip': {'extension': '.gz', 'levels': (1, 9), 'default_level': 6},
+    'zstd': {'extension': '.zst', 'levels': (1, 19), 'default_level': 3}
+}
+
+_READ_SIZE = 1024 * 1024
+
+
+class CompressionError(Exception):
+    """Raised for an unknown codec or level, or a failed decompression."""
+
+
+def get_compression(codec=None, level=None):
+    """
+    Returns the compression of captures: codec, level and the name the
+    acquire plans give the capture on the instance.  The codec and level
+    default to capture_compression and capture_compression_level.
+    """
+    codec = (codec or config(
+        'capture_compression',
+        namespace='ssm_acquire',
+        default='none'
+    )).lower()
+
+    if codec not in CODECS:
+        raise CompressionError('Unknown capture_compression {}.  Choose one '
+            'of: {}'.format(codec, ', '.join(sorted(CODECS))))
+
+    if CODECS[codec] is None:
+        return {'codec': 'none', 'level': None, 'capture_name': 'capture.aff4'}
+
+    level = int(level or config(
+        'capture_compression_level',
+        namespace='ssm_acquire',
+        default=str(CODECS[codec]['default_level'])
+    ))
+
+    lowest, highest = CODECS[codec]['levels']
+
+    if not lowest <= level <= highest:
+        raise CompressionError('{} levels are {} to {}, not {}.'.format(
+            codec, lowest, highest, level))
+
+    return {
+        'codec': codec,
+        'level': level,
+        'capture_name': UNCOMPRESSED_NAME + CODECS[codec]['extension']
+    }
+
+
+def _run_decompressor(command, path, destination):
+    with open(path, 'rb') as source, open(destination, 'wb') as target:
+        subprocess.check_call(command, stdin=source, stdout=target)
+
+
+def _decompress_zstd(path, destination):
+    try:
+        import zstandard
+    except ImportError:
+        zstandard = None
+
+    if zstandard is not None:
+        with open(path, 'rb') as source, open(destination, 'wb') as target:
+            zstandard.ZstdDecompressor().copy_stream(source, target)
+    elif shutil.which('zstd'):
+        _run_decompressor(['zstd', '-d', '-q', '-c'], path, destination)
+    else:
+        raise CompressionError('Decompressing {} needs the zstandard package '
+            'or the zstd command.'.format(path))
+
+
+def _decompress_gzip(path, destination):
+    if shutil.which('pigz'):
+        _run_decompressor(['pigz', '-d', '-c'], path, destination)
+        return
+
+    with gzip.open(path, 'rb') as source, open(destination, 'wb') as target:
+        shutil.copyfileobj(source, target, _READ_SIZE)
+
+
+_DECOMPRESSORS = {
+    'gzip': _decompress_gzip,
+    'zstd': _decompress_zstd
+}
+
+
+def decompress(path, metadata):
+    """
+    Expands the capture at path if its metadata names a codec.  The result
+    is written next to it, under the name in the metadata, and kept until
+    the compressed file changes.
+
+    Returns the path of the uncompressed capture, or None if the object was
+    not compressed.
+    """
+    codec = metadata.get(CODEC_METADATA_KEY)
+
+    if not codec or codec == 'none':
+        return None
+
+    if codec not in _DECOMPRESSORS:
+        raise CompressionError('{} was compressed with an unknown codec: '
+            '{}.'.format(path, codec))
+
+    destination = os.path.join(
+        os.path.dirname(path),
+        os.path.basename(metadata.get(NAME_METADATA_KEY, UNCOMPRESSED_NAME))
+    )
+
+    if os.path.isfile(destination) and \
+            os.path.getmtime(destination) >= os.path.getmtime(path):
+        logger.info('{} is already decompressed.'.format(path))
+        return destination
+
+    logger.info('Decompressing {} with {}.'.format(path, codec))
+
+    part_path = destination + '.part'
+
+    try:
+        _DECOMPRESSORS[codec](path, part_path)
+    except (EOFError, IOError, OSError, subprocess.CalledProcessError) as e:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise CompressionError('Could not decompress {}: {}'.format(path, e))
+
+    os.rename(part_path, destination)
+
+    return destination
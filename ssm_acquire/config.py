@@ -1,9 +1,19 @@
-import everett.ext.inifile
-import everett.manager
 import os
 
 
+# Where profiles can be built; see ssm_acquire.build.
+build_backends = ('instance', 'local')
+
+# How captures are analyzed; see ssm_acquire.analyze.
+analyze_backends = ('docker', 'native')
+
+_config_manager = None
+
+
 def _get_config_manager():
+    import everett.ext.inifile
+    import everett.manager
+
     config_file = everett.ext.inifile.ConfigIniEnv([
         os.environ.get('THREATRESPONSE_INI'),
         '~/.threatresponse.ini',
@@ -16,11 +26,47 @@ def _get_config_manager():
     ])
 
 
-config_manager = _get_config_manager()
+def config_manager(key, **kwargs):
+    """
+    Looks up a setting.  The config files are only read the first time a 
+    setting is needed, so importing ssm_acquire stays cheap.
+    """
+    global _config_manager
+
+    if _config_manager is None:
+        _config_manager = _get_config_manager()
+
+    return _config_manager(key, **kwargs)
+
+
+def get_asset_bucket():
+    """
+    Returns the name of the asset bucket.
+
+    Throws ConfigurationMissingError if .threatresponse.ini can't be found.
+    """
+    return config_manager('asset_bucket', namespace='ssm_acquire')
+
+
+def __getattr__(name):
+    # config.asset_bucket is resolved when it is used, not at import.
+    if name == 'asset_bucket':
+        return get_asset_bucket()
+
+    raise AttributeError('module {} has no attribute {}'.format(__name__, name))
+
+
+# Prefixes of the asset bucket that hold assets shared by all instances 
+# rather than evidence from one instance.  The responder reads and writes 
+# them.
+shared_prefixes = ['profiles', 'artifacts']
+
+# The shared prefixes that plans read on the instance.  Credentials sent to 
+# an instance may only read these.
+instance_read_prefixes = ['artifacts']
 
-# will throw ConfigurationMissingError later in the chain if 
-# .threatresponse.ini can't be found
-asset_bucket = config_manager('asset_bucket', namespace='ssm_acquire')
+# The evidence prefixes of every instance, for credentials sent to a fleet.
+fleet_instance_prefix = 'i-*'
 
 
 def get_s3_arn(instance_id=None):
@@ -29,7 +75,7 @@ def get_s3_arn(instance_id=None):
     
     Appends the EC2 instance id to the S3 arn if it is provided.
     """
-    s3_arn = 'arn:aws:s3:::{}'.format(asset_bucket)
+    s3_arn = 'arn:aws:s3:::{}'.format(get_asset_bucket())
 
     if instance_id:
         s3_arn += '/{}'.format(instance_id)
@@ -52,4 +98,4 @@ def get_ec2_arn(region, instance_id):
 
     ACCOUNT_ID is unnecessary in the context of this program.
     """
-    return 'arn:aws:ec2:{}::instance/{}'.format(region, instance_id)
\ No newline at end of file
+    return 'arn:aws:ec2:{}::instance/{}'.format(region, instance_id)
@@ -1,65 +1,139 @@
 # -*- coding: utf-8 -*-
 import boto3.session
+import hashlib
 import logging
+import os
+import threading
 
-from prompt_toolkit import prompt
-
+from ssm_acquire import tracing
 from ssm_acquire.config import config_manager
+from ssm_acquire.credential_cache import CredentialCache
 from ssm_acquire.policy import get_json_policy
 
 
 logger = logging.getLogger(__name__)
 
-_role_arn = config_manager('ssm_acquire_role_arn', namespace='ssm_acquire')
 
-_mfa_config = config_manager(
-    'mfa_serial_number', 
-    namespace='ssm_acquire', 
-    default=''
-)
+def _get_role_arn():
+    return config_manager('ssm_acquire_role_arn', namespace='ssm_acquire')
+
 
-_session_duration = int(
-    config_manager(
-        'assume_role_session_duration', 
-        namespace='ssm_acquire',
-        default='3600'
+def _get_mfa_config():
+    return config_manager(
+        'mfa_serial_number', 
+        namespace='ssm_acquire', 
+        default=''
     )
-)
 
 
-def _get_mfa_token():
-    mfa_token = None
+def _get_session_duration():
+    return int(
+        config_manager(
+            'assume_role_session_duration', 
+            namespace='ssm_acquire',
+            default='3600'
+        )
+    )
 
-    if _mfa_config:
-        mfa_token = prompt('Please enter your MFA Token: ')
-    
-    return mfa_token
+
+def _get_mfa_session_duration():
+    return int(
+        config_manager(
+            'mfa_session_duration', 
+            namespace='ssm_acquire',
+            default='43200'
+        )
+    )
+
+
+_cache = None
+
+# Only one thread prompts for an MFA token; the others wait for its session.
+_mfa_lock = threading.Lock()
+
+
+def _get_cache():
+    global _cache
+
+    if _cache is None:
+        _cache = CredentialCache()
+
+    return _cache
 
 
-_mfa_token = _get_mfa_token()
+def _get_mfa_token():
+    """Prompts for an MFA token.  Only called when STS needs a new one."""
+    from prompt_toolkit import prompt
 
+    return prompt('Please enter your MFA Token: ')
 
-def _get_sts_client(region):
-    """Returns an sts client for the given region."""
 
-    boto_session = boto3.session.Session(region_name=region)
+def _hash_policy(json_policy):
+    return hashlib.sha256(json_policy.encode('utf-8')).hexdigest()
 
-    sts_client = boto_session.client('sts')
+
+def _get_sts_client(region, credentials=None):
+    """
+    Returns an sts client for the given region, signed with credentials if 
+    they are provided.
+    """
+    if credentials:
+        boto_session = boto3.session.Session(
+            aws_access_key_id=credentials['Credentials']['AccessKeyId'],
+            aws_secret_access_key=credentials['Credentials']['SecretAccessKey'],
+            aws_session_token=credentials['Credentials']['SessionToken'],
+            region_name=region
+        )
+    else:
+        boto_session = boto3.session.Session(region_name=region)
+
+    sts_client = tracing.instrument(boto_session.client('sts'))
 
     return sts_client
 
 
-def _assume_role_with_mfa(json_policy, sts_client):
-    """Returns the credentials for assuming a role with mfa."""
+def _get_mfa_session(sts_client):
+    """
+    Returns an MFA-backed session token.  It is cached for 
+    mfa_session_duration, so the MFA token is only asked for once in that 
+    time, however many runs and instances it is used for.
+    """
+    key = 'mfa-session:{}'.format(_get_mfa_config())
+
+    credentials = _get_cache().get(key)
+
+    if credentials is not None:
+        return credentials
+
+    with _mfa_lock:
+        # Another thread may have prompted while this one waited.
+        credentials = _get_cache().get(key)
+
+        if credentials is None:
+            logger.info('Getting session token with MFA.')
+
+            credentials = _get_cache().put(key, sts_client.get_session_token(
+                DurationSeconds=_get_mfa_session_duration(),
+                SerialNumber=_get_mfa_config(),
+                TokenCode=_get_mfa_token()
+            ))
+
+    return credentials
+
+
+def _assume_role_with_mfa(json_policy, sts_client, region):
+    """
+    Returns the credentials for assuming a role from the MFA-backed session.
+    """
 
     logger.info('Assuming role with MFA.')
 
-    credentials = sts_client.assume_role(
-        RoleArn=_role_arn,
+    mfa_sts_client = _get_sts_client(region, _get_mfa_session(sts_client))
+
+    credentials = mfa_sts_client.assume_role(
+        RoleArn=_get_role_arn(),
         RoleSessionName='ssm-acquire',
-        DurationSeconds=_session_duration,
-        SerialNumber=_mfa_config,
-        TokenCode=_mfa_token,
+        DurationSeconds=_get_session_duration(),
         Policy=json_policy
     )
 
@@ -72,56 +146,71 @@ def _assume_role_without_mfa(json_policy, sts_client):
     logger.info('Assuming role without MFA.')
 
     credentials = sts_client.assume_role(
-        RoleArn=_role_arn,
+        RoleArn=_get_role_arn(),
         RoleSessionName='ssm-acquire',
-        DurationSeconds=_session_duration,
+        DurationSeconds=_get_session_duration(),
         Policy=json_policy
     )
 
     return credentials
 
 
-def _assume_role(region, instance_id, sts_client):
-    """Returns the credentials for assuming a role with optional mfa."""
+def _assume_role(region, instance_id, sts_client, for_instance=False):
+    """
+    Returns the credentials for assuming a role with optional mfa.  They are 
+    cached by role arn and session policy.
+    """
+
+    json_policy = get_json_policy(region, instance_id, for_instance)
+
+    key = 'assume-role:{}:{}'.format(
+        _get_role_arn(), 
+        _hash_policy(json_policy)
+    )
+
+    credentials = _get_cache().get(key)
+
+    tracing.current_span().set(cached=credentials is not None)
 
-    json_policy = get_json_policy(region, instance_id)
+    if credentials is not None:
+        return credentials
     
-    if _mfa_config:
-        return _assume_role_with_mfa(json_policy, sts_client)
-    else:
-        return _assume_role_without_mfa(json_policy, sts_client)
+    with tracing.span('sts.assume_role', mfa=bool(_get_mfa_config())):
+        if _get_mfa_config():
+            credentials = _assume_role_with_mfa(json_policy, sts_client, region)
+        else:
+            credentials = _assume_role_without_mfa(json_policy, sts_client)
+
+    return _get_cache().put(key, credentials)
 
 
 def _get_session_token_with_mfa(sts_client):
     """Returns a session token from the sts client with mfa."""
 
-    logger.info('Getting session token with MFA.')
-
-    session_token = sts_client.get_session_token(
-        DurationSeconds=_session_duration,
-        SerialNumber=_mfa_config,
-        TokenCode=_mfa_token
-    )
-
-    return session_token
+    return _get_mfa_session(sts_client)
 
 
 def _get_session_token_without_mfa(sts_client):
     """Returns a session token from the sts client without mfa."""
 
-    logger.info('Getting session token without MFA.')
+    key = 'session-token:{}'.format(os.environ.get('AWS_PROFILE', 'default'))
 
-    session_token = sts_client.get_session_token(
-        DurationSeconds=_session_duration
-    )
+    credentials = _get_cache().get(key)
 
-    return session_token
+    if credentials is None:
+        logger.info('Getting session token without MFA.')
+
+        credentials = _get_cache().put(key, sts_client.get_session_token(
+            DurationSeconds=_get_session_duration()
+        ))
+
+    return credentials
 
 
 def _get_session_token(sts_client):
     """Returns a session token from the sts client with optional mfa."""
 
-    if _mfa_config:
+    if _get_mfa_config():
         return _get_session_token_with_mfa(sts_client)
     else:
         return _get_session_token_without_mfa(sts_client)
@@ -129,22 +218,46 @@ def _get_session_token(sts_client):
 
 def _get_credentials_helper(region, instance_id, sts_client):
     """
-    Returns the credentials for assuming a role if a role arn is provided.
+    Returns the credentials for assuming a role if a role arn is provided, 
+    along with the narrower credentials that plans carry to the instance 
+    under InstanceCredentials.
     
     Otherwise, returns a session token from the sts client.
     """
-    if _role_arn:
-        return _assume_role(region, instance_id, sts_client)
+    if _get_role_arn():
+        credentials = _assume_role(region, instance_id, sts_client)
+        instance_credentials = _assume_role(
+            region, 
+            instance_id, 
+            sts_client, 
+            for_instance=True
+        )
+
+        return dict(
+            credentials, 
+            InstanceCredentials=instance_credentials['Credentials']
+        )
     else:
+        logger.warning('No ssm_acquire_role_arn is set, so plans carry the '
+            'session token of the responder to the instance.')
+
         return _get_session_token(sts_client)
 
 
+def get_instance_credentials(credentials):
+    """Returns the Credentials that plans may carry to the instance."""
+    return credentials.get('InstanceCredentials', credentials['Credentials'])
+
+
+@tracing.traced('credentials')
 def get_credentials(region, instance_id):
     """
-    Obtains the credentials required to run commands on the EC2 instance.
+    Obtains the credentials required to run commands on the EC2 instance.  
+    Credentials from earlier runs are reused until shortly before they 
+    expire; see ssm_acquire.credential_cache.
     """
     sts_client = _get_sts_client(region)
 
     credentials = _get_credentials_helper(region, instance_id, sts_client)
 
-    return credentials
\ No newline at end of file
+    return credentials
@@ -0,0 +1,139 @@
+"""
+Cache of STS credentials, in memory and on disk, reused until they expire.
+
+Entries are keyed by what the credentials were issued for, e.g. the role
+arn and the hash of the session policy, so credentials scoped to one
+instance are never handed out for another.  The cache file is only readable
+by its owner.  Credentials are considered expired REFRESH_MARGIN seconds
+before their Expiration so that a long command does not outlive them.
+"""
+import calendar
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from ssm_acquire.config import config_manager
+
+
+config = config_manager
+logger = logging.getLogger(__name__)
+
+# Seconds before Expiration at which credentials are refreshed.
+REFRESH_MARGIN = 300
+
+# Entries already read or issued in this process, by key.
+_memory = {}
+
+# Serialises the read-modify-write of the cache file between threads.
+_file_lock = threading.Lock()
+
+
+def _get_expires_at(credentials):
+    """Returns the Expiration of STS credentials as seconds since the epoch."""
+    expiration = credentials['Credentials']['Expiration']
+
+    if hasattr(expiration, 'utctimetuple'):
+        return calendar.timegm(expiration.utctimetuple())
+
+    return calendar.timegm(time.strptime(expiration, '%Y-%m-%dT%H:%M:%SZ'))
+
+
+def _serialize(credentials):
+    """Keeps the parts of an STS response that are needed later."""
+    return {
+        'Credentials': {
+            'AccessKeyId': credentials['Credentials']['AccessKeyId'],
+            'SecretAccessKey': credentials['Credentials']['SecretAccessKey'],
+            'SessionToken': credentials['Credentials']['SessionToken'],
+            'Expiration': time.strftime(
+                '%Y-%m-%dT%H:%M:%SZ',
+                time.gmtime(_get_expires_at(credentials))
+            )
+        }
+    }
+
+
+def _is_fresh(credentials):
+    return _get_expires_at(credentials) - REFRESH_MARGIN > time.time()
+
+
+class CredentialCache(object):
+    def __init__(self, path=None):
+        self.path = os.path.expanduser(path or config(
+            'credential_cache_file',
+            namespace='ssm_acquire',
+            default='~/.cache/ssm_acquire/credentials.json'
+        ))
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _save(self, entries):
+        """Replaces the cache file atomically, readable by its owner only."""
+        directory = os.path.dirname(self.path)
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+
+        # mkstemp creates the file readable by its owner only, under a name
+        # no other thread or process is using.
+        fd, tmp_path = tempfile.mkstemp(
+            dir=directory,
+            prefix=os.path.basename(self.path),
+            suffix='.tmp'
+        )
+
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entries, f)
+
+            os.rename(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def get(self, key):
+        """Returns the cached credentials for key, or None if stale."""
+        credentials = _memory.get(key)
+
+        if credentials is None:
+            credentials = self._load().get(key)
+
+        if credentials is None or not _is_fresh(credentials):
+            return None
+
+        logger.info('Reusing cached credentials for {}.'.format(key))
+
+        _memory[key] = credentials
+
+        return credentials
+
+    def put(self, key, credentials):
+        """
+        Caches credentials for key.  Expired entries are dropped from the
+        file at the same time.
+        """
+        credentials = _serialize(credentials)
+
+        _memory[key] = credentials
+
+        with _file_lock:
+            entries = dict(
+                (k, v) for k, v in self._load().items() if _is_fresh(v)
+            )
+            entries[key] = credentials
+
+            try:
+                self._save(entries)
+            except (IOError, OSError) as e:
+                logger.warning('Could not write the credential cache {}: '
+                    '{}'.format(self.path, e))
+
+        return credentials
@@ -0,0 +1,312 @@
+"""
+Ranged, multi-threaded downloads from the asset bucket.
+
+Objects are fetched in fixed-size ranges by a pool of threads and streamed
+to disk as they arrive, so a 64 GB capture never has to fit in memory.
+Progress is journaled next to the partial file so an interrupted download
+resumes where it stopped, and the result is checked against the object's
+ETag before it replaces the destination.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from ssm_acquire import tracing
+from ssm_acquire.config import config_manager
+
+
+config = config_manager
+logger = logging.getLogger(__name__)
+
+_MB = 1024 * 1024
+
+# Size of the reads from the response body; each worker buffers one.
+_READ_SIZE = _MB
+
+# Name of the file that remembers which ETag each downloaded file has.
+_MANIFEST_NAME = '.ssm_acquire_downloads.json'
+
+
+class DownloadVerificationError(Exception):
+    """Raised when a downloaded file does not match the object's ETag."""
+
+
+def _get_int_setting(key, default):
+    return int(config(key, namespace='ssm_acquire', default=str(default)))
+
+
+def _parse_etag(etag):
+    """
+    Splits an ETag into its md5 hex digest and part count.  The part count
+    is 0 for objects that were not uploaded in parts.
+    """
+    etag = etag.strip('"')
+
+    digest, _, parts = etag.partition('-')
+
+    return digest, int(parts) if parts else 0
+
+
+class _Manifest(object):
+    """Records the ETag of every completed download in a directory."""
+    def __init__(self, directory):
+        self.path = os.path.join(directory, _MANIFEST_NAME)
+        self.lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def get(self, file_name):
+        with self.lock:
+            return self._load().get(file_name)
+
+    def set(self, file_name, etag):
+        with self.lock:
+            entries = self._load()
+            entries[file_name] = etag
+
+            with open(self.path, 'w') as f:
+                json.dump(entries, f)
+
+
+class _Journal(object):
+    """
+    Append-only log of the chunks of a partial download that are on disk,
+    with the md5 of each.  The first line records the ETag and chunk size
+    the download was started with; a journal for another version of the
+    object is discarded.
+    """
+    def __init__(self, path, etag, chunk_size):
+        self.path = path
+        self.header = {'etag': etag, 'chunk_size': chunk_size}
+        self.lock = threading.Lock()
+        self.done = {}
+
+    def load(self):
+        """
+        Loads the chunks completed by a previous attempt.  Returns False if
+        there is no compatible journal.
+        """
+        try:
+            with open(self.path) as f:
+                lines = f.read().splitlines()
+        except (IOError, OSError):
+            return False
+
+        if not lines or json.loads(lines[0]) != self.header:
+            return False
+
+        for line in lines[1:]:
+            index, _, md5 = line.partition(' ')
+
+            # A torn last line from an interrupted write is skipped.
+            if len(md5) == 32:
+                self.done[int(index)] = md5
+
+        return True
+
+    def reset(self):
+        """Starts a new journal with no completed chunks."""
+        self.done.clear()
+
+        with open(self.path, 'w') as f:
+            f.write(json.dumps(self.header) + '\n')
+
+    def record(self, index, md5):
+        with self.lock:
+            self.done[index] = md5
+
+            with open(self.path, 'a') as f:
+                f.write('{} {}\n'.format(index, md5))
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class RangedDownloader(object):
+    """
+    Downloads objects in ranges with a pool of threads.
+
+    Every worker streams its range to disk through one _READ_SIZE buffer, so
+    the number of workers is bounded by memory_ceiling / _READ_SIZE as well
+    as by max_concurrency.  For objects uploaded in parts, the chunk size is
+    the part size so that the md5 of each chunk can be checked against the
+    multipart ETag without reading the file back.
+    """
+    def __init__(
+        self,
+        s3_client,
+        bucket_name,
+        chunk_size=None,
+        max_concurrency=None,
+        memory_ceiling=None
+    ):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.chunk_size = chunk_size or \
+            _get_int_setting('download_chunk_size_mb', 8) * _MB
+        max_concurrency = max_concurrency or \
+            _get_int_setting('download_max_concurrency', 10)
+        memory_ceiling = memory_ceiling or \
+            _get_int_setting('download_memory_ceiling_mb', 64) * _MB
+
+        self.workers = max(1, min(max_concurrency, memory_ceiling // _READ_SIZE))
+
+    def _get_chunk_size(self, key, size, parts):
+        """
+        Returns the size of the ranges to download: the part size of
+        multipart objects, the configured chunk size otherwise.
+        """
+        if parts:
+            return self.s3_client.head_object(
+                Bucket=self.bucket_name,
+                Key=key,
+                PartNumber=1
+            )['ContentLength']
+
+        return min(self.chunk_size, max(size, 1))
+
+    def _fetch_chunk(self, key, etag, part_path, index, chunk_size, size,
+            journal):
+        start = index * chunk_size
+        end = min(start + chunk_size, size) - 1
+
+        response = self.s3_client.get_object(
+            Bucket=self.bucket_name,
+            Key=key,
+            Range='bytes={}-{}'.format(start, end),
+            IfMatch=etag
+        )
+
+        md5 = hashlib.md5()
+
+        with open(part_path, 'r+b') as fh:
+            fh.seek(start)
+
+            for data in iter(lambda: response['Body'].read(_READ_SIZE), b''):
+                fh.write(data)
+                md5.update(data)
+                tracing.add_bytes(len(data))
+
+        journal.record(index, md5.hexdigest())
+
+    def _verify(self, key, etag, part_path, parts, journal):
+        """
+        Checks the downloaded file against the ETag.  ETags that are not an
+        md5, e.g. for objects encrypted with SSE-KMS, cannot be checked.
+        """
+        digest, _ = _parse_etag(etag)
+
+        if len(digest) != 32:
+            logger.debug('ETag of {} is not an md5.  Skipping '
+                'verification.'.format(key))
+            return
+
+        if parts:
+            combined = hashlib.md5()
+
+            for index in sorted(journal.done):
+                combined.update(bytes.fromhex(journal.done[index]))
+
+            actual = combined.hexdigest()
+        else:
+            md5 = hashlib.md5()
+
+            with open(part_path, 'rb') as fh:
+                for data in iter(lambda: fh.read(_READ_SIZE), b''):
+                    md5.update(data)
+
+            actual = md5.hexdigest()
+
+        if actual != digest:
+            os.remove(part_path)
+            journal.remove()
+
+            raise DownloadVerificationError(
+                'Download of {} does not match its ETag {}.'.format(key, etag)
+            )
+
+    def download(self, s3_object, destination):
+        """
+        Downloads an object, as returned by list_objects, to destination.
+
+        Returns False if destination already holds this version of the
+        object, True otherwise.
+        """
+        key = s3_object['Key']
+        etag = s3_object['ETag']
+        size = s3_object['Size']
+
+        directory, file_name = os.path.split(destination)
+        manifest = _Manifest(directory)
+
+        if os.path.isfile(destination) and \
+                os.path.getsize(destination) == size and \
+                manifest.get(file_name) == etag:
+            logger.info('{} is up to date.  Skipping download.'.format(key))
+            return False
+
+        _, parts = _parse_etag(etag)
+        chunk_size = self._get_chunk_size(key, size, parts)
+        chunk_count = -(-size // chunk_size)
+
+        part_path = destination + '.part'
+        journal = _Journal(destination + '.part.log', etag, chunk_size)
+
+        if journal.load() and os.path.isfile(part_path):
+            logger.info('Resuming download of {}.'.format(key))
+        else:
+            journal.reset()
+            with open(part_path, 'wb') as fh:
+                fh.truncate(size)
+
+        remaining = [i for i in range(chunk_count) if i not in journal.done]
+
+        logger.info('Downloading {}: {} of {} chunks of {} bytes with {} '
+            'workers.'.format(
+                key,
+                len(remaining),
+                chunk_count,
+                chunk_size,
+                self.workers
+            ))
+
+        with tracing.span('s3.download', key=key, size=size, 
+                chunks=len(remaining)), \
+                ThreadPoolExecutor(max_workers=self.workers) as executor:
+            fetch_chunk = tracing.bind(self._fetch_chunk)
+            futures = [
+                executor.submit(
+                    fetch_chunk,
+                    key,
+                    etag,
+                    part_path,
+                    index,
+                    chunk_size,
+                    size,
+                    journal
+                )
+                for index in remaining
+            ]
+
+            # Re-raises the first failed range; completed ranges stay
+            # journaled for the next attempt.
+            for future in futures:
+                future.result()
+
+        self._verify(key, etag, part_path, parts, journal)
+
+        os.rename(part_path, destination)
+        journal.remove()
+        manifest.set(file_name, etag)
+
+        return True
@@ -0,0 +1,282 @@
+"""
+Facts about an instance, collected by one cheap SSM probe.
+
+The probe reports the distro, kernel release, architecture, memory size and
+the free space of the home directory the capture is written to.  Facts are
+cached per instance for the rest of the process, so every mode shares one
+probe.  They pick the per-distro plan, tell build whether the registry has a
+profile for the kernel, and tell acquire whether the capture fits on disk
+before a dump that can run for hours is started.
+
+Cached facts expire after facts_ttl seconds, since a long-running worker
+would otherwise keep the free space or kernel of an instance from before a
+reboot.  A probe that did not succeed is not cached, so the instance is
+probed again the next time its facts are needed.
+"""
+import logging
+import time
+
+from ssm_acquire import tracing
+from ssm_acquire.command import ensure_command
+from ssm_acquire.command import ensure_command_async
+from ssm_acquire.command import ensure_fleet_command
+from ssm_acquire.command import run_fleet_probe
+from ssm_acquire.config import config_manager
+
+
+config = config_manager
+logger = logging.getLogger(__name__)
+
+# Plans are selected for this distro when the probe did not succeed.
+DEFAULT_DISTRO = 'amzn2'
+
+# Prints one key=value line per fact.
+_FACTS_COMMANDS = [
+    '. /etc/os-release',
+    'echo "distro_id=$ID"',
+    'echo "distro_version=$VERSION_ID"',
+    'echo "kernel_release=$(uname -r)"',
+    'echo "arch=$(uname -m)"',
+    'echo "mem_total_kb=$(awk \'/MemTotal/ {print $2}\' /proc/meminfo)"',
+    'echo "home_free_kb=$(df -Pk /home/ec2-user | awk \'NR == 2 {print $4}\')"'
+]
+
+_FACTS_TIMEOUT = 120
+
+# Facts of the instances probed by this process and when they were probed, 
+# by instance id.
+_facts = {}
+
+
+class UnsupportedInstanceError(Exception):
+    """Raised when no plan matches the distro of an instance."""
+
+
+def parse_facts(output):
+    """Parses the output of the probe into a dict of facts."""
+    facts = {}
+
+    for line in output.splitlines():
+        key, _, value = line.strip().partition('=')
+
+        if not value:
+            continue
+
+        if key.endswith('_kb'):
+            facts[key[:-len('_kb')] + '_bytes'] = int(value) * 1024
+        else:
+            facts[key] = value
+
+    if 'distro_id' in facts:
+        # e.g. amzn 2 -> amzn2, ubuntu 18.04 -> ubuntu18
+        facts['distro'] = '{}{}'.format(
+            facts['distro_id'],
+            facts.get('distro_version', '').split('.')[0]
+        )
+
+    return facts
+
+
+def get_probe_plan():
+    """
+    Returns the probe as a plan, for callers that send it and read its
+    output themselves; see parse_facts.
+    """
+    return {'commands': list(_FACTS_COMMANDS), 'timeout': _FACTS_TIMEOUT}
+
+
+def _get_facts_from_invocation(instance_id, invocation):
+    if invocation['Status'] != 'Success':
+        logger.warning('Could not probe instance {}: {}'.format(
+            instance_id,
+            invocation['Status']
+        ))
+        return {}
+
+    facts = parse_facts(invocation['StandardOutputContent'])
+
+    logger.info('Facts for instance {}: {}'.format(instance_id, facts))
+
+    return facts
+
+
+def _get_ttl():
+    return float(config('facts_ttl', namespace='ssm_acquire', default='600'))
+
+
+def _remember(instance_id, facts):
+    """Caches the facts of the instance unless the probe failed."""
+    if facts:
+        _facts[instance_id] = (facts, time.time())
+
+    return facts
+
+
+def _lookup(instance_id):
+    """Returns the cached facts of the instance, or None if they expired."""
+    entry = _facts.get(instance_id)
+
+    if entry is None:
+        return None
+
+    facts, probed_at = entry
+
+    if time.time() - probed_at >= _get_ttl():
+        _facts.pop(instance_id, None)
+        return None
+
+    return facts
+
+
+def get_instance_facts(ssm_client, instance_id):
+    """Returns the facts of the instance, probing it on first use."""
+    facts = _lookup(instance_id)
+
+    if facts is None:
+        with tracing.span('facts.probe', instances=1):
+            facts = _remember(instance_id, _get_facts_from_invocation(
+                instance_id,
+                ensure_command(
+                    ssm_client,
+                    _FACTS_COMMANDS,
+                    instance_id,
+                    timeout=_FACTS_TIMEOUT
+                )
+            ))
+
+    return facts
+
+
+async def get_instance_facts_async(ssm_client, instance_id):
+    """Coroutine version of get_instance_facts."""
+    facts = _lookup(instance_id)
+
+    if facts is None:
+        with tracing.span('facts.probe', instances=1):
+            invocation = await ensure_command_async(
+                ssm_client,
+                _FACTS_COMMANDS,
+                instance_id,
+                timeout=_FACTS_TIMEOUT
+            )
+
+        facts = _remember(
+            instance_id,
+            _get_facts_from_invocation(instance_id, invocation)
+        )
+
+    return facts
+
+
+def get_fleet_facts(ssm_client, instance_ids):
+    """
+    Returns the facts of every instance.  The instances that were not probed
+    yet are probed with one fleet command.
+    """
+    facts = dict(
+        (instance_id, _lookup(instance_id)) for instance_id in instance_ids
+    )
+
+    unknown = [
+        instance_id for instance_id in instance_ids
+        if facts[instance_id] is None
+    ]
+
+    if unknown:
+        with tracing.span('facts.probe', instances=len(unknown)):
+            outputs = run_fleet_probe(
+                ssm_client,
+                _FACTS_COMMANDS,
+                unknown,
+                timeout=_FACTS_TIMEOUT
+            )
+
+        for instance_id in unknown:
+            if instance_id in outputs:
+                facts[instance_id] = _remember(
+                    instance_id,
+                    parse_facts(outputs[instance_id])
+                )
+            else:
+                logger.warning('Could not probe instance {}.'.format(
+                    instance_id))
+                facts[instance_id] = {}
+
+    return facts
+
+
+def get_distro(facts):
+    return facts.get('distro', DEFAULT_DISTRO)
+
+
+def select_plan(plans, distro):
+    """
+    Returns the plan for the distro from a plan file.  Raises
+    UnsupportedInstanceError if the plan file has none.
+    """
+    try:
+        return plans['distros'][distro]
+    except KeyError:
+        raise UnsupportedInstanceError(
+            '"{}" has no plan for {}.  Supported: {}'.format(
+                plans['name'],
+                distro,
+                sorted(plans['distros'])
+            )
+        )
+
+
+def capture_fits(facts):
+    """
+    Returns False if the home directory of the instance cannot hold a
+    capture of its memory.  Unknown sizes are assumed to fit.
+    """
+    if 'mem_total_bytes' not in facts or 'home_free_bytes' not in facts:
+        return True
+
+    return facts['home_free_bytes'] >= facts['mem_total_bytes']
+
+
+def group_by_distro(instance_ids, fleet_facts):
+    """
+    Groups the instances by the distro in their facts, as returned by 
+    get_fleet_facts.
+    """
+    groups = {}
+
+    for instance_id in instance_ids:
+        groups.setdefault(
+            get_distro(fleet_facts.get(instance_id, {})),
+            []
+        ).append(instance_id)
+
+    return groups
+
+
+def run_fleet_plan(ssm_client, get_plan, instance_ids, fleet_facts):
+    """
+    Runs a plan on a fleet as one fleet command per distro, with the facts 
+    from get_fleet_facts.  get_plan takes a distro and returns its plan.  
+    Instances on a distro without a plan get the status 'Unsupported'.
+
+    Returns the final status for each instance id.
+    """
+    statuses = {}
+
+    for distro, members in group_by_distro(instance_ids, fleet_facts).items():
+        try:
+            plan = get_plan(distro)
+        except UnsupportedInstanceError as e:
+            logger.warning('Skipping {} instances: {}'.format(len(members), e))
+            statuses.update((instance_id, 'Unsupported') for instance_id in members)
+            continue
+
+        statuses.update(ensure_fleet_command(
+            ssm_client,
+            plan['commands'],
+            members,
+            timeout=plan.get('timeout'),
+            expected_duration=plan.get('expected_duration')
+        ))
+
+    return statuses
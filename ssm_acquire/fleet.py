@@ -0,0 +1,207 @@
+"""Runs the ssm_acquire modes against a fleet of EC2 instances at once."""
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# EC2 takes at most 200 values per filter.
+_DESCRIBE_BATCH_SIZE = 200
+
+
+def _read_instance_file(instance_file):
+    """
+    Reads instance ids from a file, one per line.  Blank lines and lines
+    starting with '#' are ignored.
+    """
+    with open(instance_file) as f:
+        return [
+            line.strip() for line in f
+            if line.strip() and not line.strip().startswith('#')
+        ]
+
+
+def get_explicit_instance_ids(instance_id, instance_ids, instance_file):
+    """
+    Collects the instance ids given directly on the command line or in an
+    instance file.
+
+    Duplicates are removed and the order of first appearance is kept.
+    """
+    collected = []
+
+    if instance_id:
+        collected.append(instance_id)
+
+    if instance_ids:
+        collected.extend(i.strip() for i in instance_ids.split(',') if i.strip())
+
+    if instance_file:
+        collected.extend(_read_instance_file(instance_file))
+
+    return _dedupe(collected)
+
+
+def _dedupe(instance_ids):
+    """Removes duplicate instance ids, keeping the order of first appearance."""
+    deduped = []
+    seen = set()
+
+    for instance_id in instance_ids:
+        if instance_id not in seen:
+            seen.add(instance_id)
+            deduped.append(instance_id)
+
+    return deduped
+
+
+def _get_tag_filters(tags):
+    """
+    Converts 'Key=Value' strings into EC2 describe_instances filters.  Only
+    running instances are selected.
+    """
+    filters = [{'Name': 'instance-state-name', 'Values': ['running']}]
+
+    for tag in tags:
+        key, separator, value = tag.partition('=')
+
+        if not separator:
+            raise ValueError('Tag filter must look like Key=Value, got: '
+                '{}'.format(tag))
+
+        filters.append({'Name': 'tag:{}'.format(key), 'Values': [value]})
+
+    return filters
+
+
+def get_instance_ids_by_tags(ec2_client, tags):
+    """Returns the ids of the running instances that match all the tags."""
+    instance_ids = []
+
+    paginator = ec2_client.get_paginator('describe_instances')
+
+    for page in paginator.paginate(Filters=_get_tag_filters(tags)):
+        for reservation in page['Reservations']:
+            instance_ids.extend(
+                instance['InstanceId'] for instance in reservation['Instances']
+            )
+
+    logger.info('Found {} instances matching tags: {}'.format(
+        len(instance_ids),
+        tags
+    ))
+
+    return instance_ids
+
+
+def get_instance_tag_values(ec2_client, instance_ids, key):
+    """
+    Returns the value of the tag with this key for each instance that has
+    it.  Instances that no longer exist are left out rather than failing the
+    lookup.
+    """
+    values = {}
+
+    paginator = ec2_client.get_paginator('describe_instances')
+
+    for start in range(0, len(instance_ids), _DESCRIBE_BATCH_SIZE):
+        for page in paginator.paginate(Filters=[{
+            'Name': 'instance-id',
+            'Values': instance_ids[start:start + _DESCRIBE_BATCH_SIZE]
+        }]):
+            for reservation in page['Reservations']:
+                for instance in reservation['Instances']:
+                    for tag in instance.get('Tags', []):
+                        if tag['Key'] == key:
+                            values[instance['InstanceId']] = tag['Value']
+
+    return values
+
+
+def merge_instance_ids(*instance_id_lists):
+    """Merges lists of instance ids, removing duplicates."""
+    merged = []
+
+    for instance_ids in instance_id_lists:
+        merged.extend(instance_ids)
+
+    return _dedupe(merged)
+
+
+def run_fleet(ssm_client, instance_ids, credentials, acquire, build,
+        interrogate, stream=False, build_backend='instance'):
+    """
+    Performs the flagged modes on every instance of the fleet.  stream
+    selects the streaming acquisition, see dump_and_transfer, and
+    build_backend where profiles are built, see build_profile_fleet.
+
+    Returns a dict of {mode: {instance_id: status}}.
+    """
+    # The modes pull in boto3 and jinja2; reading the instance ids does not.
+    from ssm_acquire.acquire import dump_and_transfer_fleet
+    from ssm_acquire.build import build_profile_fleet
+    from ssm_acquire.facts import get_fleet_facts
+    from ssm_acquire.interrogate import interrogate_fleet
+
+    results = {}
+
+    if acquire or build or interrogate:
+        # One probe for the whole fleet; every mode reuses the facts.
+        get_fleet_facts(ssm_client, instance_ids)
+
+    if acquire:
+        results['acquire'] = dump_and_transfer_fleet(
+            ssm_client,
+            instance_ids,
+            credentials,
+            stream=stream
+        )
+
+    if build:
+        results['build'] = build_profile_fleet(
+            ssm_client,
+            instance_ids,
+            credentials,
+            backend=build_backend
+        )
+
+    if interrogate:
+        results['interrogate'] = interrogate_fleet(
+            ssm_client,
+            instance_ids,
+            credentials
+        )
+
+    return results
+
+
+def get_failed_instance_ids(results):
+    """Returns the ids of the instances that did not succeed in every mode."""
+    return sorted(set(
+        instance_id
+        for statuses in results.values()
+        for instance_id, status in statuses.items()
+        if status != 'Success'
+    ))
+
+
+def print_report(instance_ids, results):
+    """Prints the status of every mode for every instance of the fleet."""
+    modes = list(results)
+
+    print('Fleet results:')
+
+    for instance_id in instance_ids:
+        print('  {:<20} {}'.format(
+            instance_id,
+            '  '.join(
+                '{}: {}'.format(mode, results[mode].get(instance_id, 'Unknown'))
+                for mode in modes
+            )
+        ))
+
+    failed = get_failed_instance_ids(results)
+
+    print('{} of {} instances completed successfully.'.format(
+        len(instance_ids) - len(failed),
+        len(instance_ids)
+    ))
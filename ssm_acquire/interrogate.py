@@ -1,8 +1,16 @@
+import asyncio
 import logging
-import yaml
 
-from ssm_acquire.command import ensure_command
-from ssm_acquire.jinja2_io import get_jinja2_plan
+from ssm_acquire import tracing
+from ssm_acquire.command import ensure_command_async
+from ssm_acquire.facts import get_distro
+from ssm_acquire.facts import get_fleet_facts
+from ssm_acquire.facts import get_instance_facts_async
+from ssm_acquire.facts import run_fleet_plan
+from ssm_acquire.facts import select_plan
+from ssm_acquire.jinja2_io import FLEET_INSTANCE_ID
+from ssm_acquire.jinja2_io import get_plans
+from ssm_acquire.results import update_results
 
 
 logger = logging.getLogger(__name__)
@@ -14,52 +22,138 @@ def _get_interrogate_plans(credentials, instance_id):
     """
     j2_file = "interrogate-plans/osquery.yml.j2"
 
-    interrogate_plan = get_jinja2_plan(credentials, instance_id, j2_file)
+    return get_plans(credentials, instance_id, j2_file)
 
-    return yaml.safe_load(interrogate_plan)
+
+def _get_interrogate_plan(credentials, instance_id, distro):
+    """
+    Gets the plan to interrogate the instance using OSQuery.  The plan is 
+    selected for the distro of the instance; see get_distro.
+    """
+    return select_plan(
+        _get_interrogate_plans(credentials, instance_id),
+        distro
+    )
 
 
-def _get_interrogate_commands(credentials, instance_id):
+def _update_results(instance_id, credentials):
     """
-    TODO: Only supports amzn2 for now.  Add support for other distros.
-    
-    Gets commands to interrogate the instance using OSQuery.
+    Parses the query results into the results database of the instance. 
+    They stay in the asset bucket if that fails.
     """
-    return _get_interrogate_plans(
-        credentials, 
-        instance_id
-    )['distros']['amzn2']['commands']
+    try:
+        update_results(instance_id, credentials)
+    except Exception as e:
+        logger.warning('Could not update the results of instance {}: '
+            '{}'.format(instance_id, e))
+
 
+def interrogate_instance(ssm_client, instance_id, credentials):
+    """
+    Interrogates the specified EC2 instance using the OSQuery binary.  Runs 
+    interrogate_instance_async to completion.
 
-def _interrogate_instance_helper(ssm_client, instance_id, credentials):
+    Returns the final status of the interrogation.
     """
-    Loads and runs the commands to interrogate the instance using OSQuery.
+    return asyncio.run(interrogate_instance_async(
+        ssm_client, 
+        instance_id, 
+        credentials
+    ))
+
+
+@tracing.traced('interrogate.fleet')
+def interrogate_fleet(ssm_client, instance_ids, credentials):
     """
-    interrogate_commands = _get_interrogate_commands(credentials, instance_id)
+    Interrogates each of the specified EC2 instances using the OSQuery binary 
+    and uploads the result of each query to the asset bucket as a JSON 
+    document.
 
-    logger.info(
-        'Attempting to interrogate the instance using the OSQuery binary for '
-            'instance_id: {}'.format(instance_id)
+    Returns the final status of the interrogation for each instance id.
+    """
+    print('Interrogate mode active for {} instances.'.format(
+        len(instance_ids)))
+
+    fleet_facts = get_fleet_facts(ssm_client, instance_ids)
+
+    statuses = run_fleet_plan(
+        ssm_client, 
+        lambda distro: _get_interrogate_plan(
+            credentials, 
+            FLEET_INSTANCE_ID, 
+            distro
+        ), 
+        instance_ids, 
+        fleet_facts
     )
 
-    ensure_command(ssm_client, interrogate_commands, instance_id)
+    for instance_id, status in statuses.items():
+        if status == 'Success':
+            _update_results(instance_id, credentials)
+
+    print('Interrogate complete for the fleet.')
+
+    return statuses
+
+
+async def _interrogate_instance_helper_async(
+    ssm_client, 
+    instance_id, 
+    credentials, 
+    distro
+):
+    """
+    Loads and runs the commands to interrogate the instance using OSQuery, 
+    and parses the query results into the results database of the 
+    instance.  Returns the final status of the interrogation.
+    """
+    interrogate_plan = _get_interrogate_plan(credentials, instance_id, distro)
+
+    logger.info('Attempting to interrogate the instance using the OSQuery '
+        'binary for instance_id: {}'.format(instance_id))
+
+    invocation = await ensure_command_async(
+        ssm_client, 
+        interrogate_plan['commands'], 
+        instance_id, 
+        timeout=interrogate_plan.get('timeout'), 
+        expected_duration=interrogate_plan.get('expected_duration')
+    )
 
     logger.info('Interrogate instance complete.')
 
-    logger.info(
-        'A .log has been added to the asset store for instance: {}'.format(
-            instance_id
+    if invocation['Status'] == 'Success':
+        # The results are built from S3 with blocking calls.
+        await asyncio.get_event_loop().run_in_executor(
+            None, 
+            tracing.bind(_update_results), 
+            instance_id, 
+            credentials
         )
-    )
 
+    return invocation['Status']
 
-def interrogate_instance(ssm_client, instance_id, credentials):
+
+@tracing.traced('interrogate')
+async def interrogate_instance_async(ssm_client, instance_id, credentials):
     """
     Interrogates the specified EC2 instance using the OSQuery binary and 
-    uploads the results to the asset bucket as a .log file.
+    uploads the result of each query of the query pack to the asset bucket 
+    as a JSON document.  See ssm_acquire.query_pack.
+
+    Returns the final status of the interrogation.
     """
     print('Interrogate mode active.')
 
-    _interrogate_instance_helper(ssm_client, instance_id, credentials)
+    facts = await get_instance_facts_async(ssm_client, instance_id)
+
+    status = await _interrogate_instance_helper_async(
+        ssm_client, 
+        instance_id, 
+        credentials, 
+        get_distro(facts)
+    )
+
+    print('Interrogate completed with status: {}.'.format(status))
 
-    print('Interrogate completed successfully.')
\ No newline at end of file
+    return status
@@ -1,25 +1,275 @@
+"""
+Registry of the j2-formatted plans.
+
+Every plan under PLAN_DIRS is compiled once per process by a jinja2
+Environment with a bytecode cache, so later processes skip the compilation
+as well.  When the registry is loaded, each plan is rendered with sample
+variables and its schema is checked, so a broken plan fails before any
+command is sent rather than in the middle of an incident.  Rendering a plan
+for an instance is then one template render and one YAML parse.
+"""
+import base64
+import itertools
 import jinja2
-import os.path
+import logging
+import os
+import threading
 import yaml
 
-from ssm_acquire.config import asset_bucket
+from ssm_acquire.artifacts import ArtifactStore
+from ssm_acquire.artifacts import INSTANCE_CACHE_DIR
+from ssm_acquire.artifacts import get_tools
+from ssm_acquire.compression import CODECS
+from ssm_acquire.compression import get_compression
+from ssm_acquire.config import config_manager
+from ssm_acquire.config import get_asset_bucket
+from ssm_acquire.credential import get_instance_credentials
+from ssm_acquire.query_pack import get_query_pack
+
+
+config = config_manager
+logger = logging.getLogger(__name__)
+
+# Rendered in place of a literal instance id when a single plan is sent to a
+# whole fleet; each instance resolves its own id from the metadata service.
+# IMDSv2 needs a session token first, and works where IMDSv1 is disabled.
+# The headers are unquoted and have no space after the colon, so the id can
+# be used inside quotes in a plan and in a plain YAML scalar.
+FLEET_INSTANCE_ID = (
+    '$(curl -s -H X-aws-ec2-metadata-token:$(curl -s -X PUT '
+    '-H X-aws-ec2-metadata-token-ttl-seconds:60 '
+    'http://169.254.169.254/latest/api/token) '
+    'http://169.254.169.254/latest/meta-data/instance-id)'
+)
+
+PLAN_DIRS = [
+    'acquire-plans',
+    'build-plans',
+    'interrogate-plans',
+    'transfer-plans'
+]
+
+# Optional variables of the plans and their values when a caller does not
+# set them.
+_OPTIONAL_VARIABLES = {
+    'ssm_acquire_kernel_release': None,
+    'ssm_acquire_build_dir': None,
+    'ssm_acquire_local_build': False
+}
+
+_SafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+class PlanError(Exception):
+    """Raised when a plan does not render or does not match the schema."""
+
+
+def _b64encode(value):
+    """The b64encode filter, for passing text to a command unquoted."""
+    return base64.b64encode(str(value).encode('utf-8')).decode('ascii')
+
+
+def _is_positive_int(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value > 0
+
+
+def _validate_plans(j2_file, plans):
+    """Checks the schema of a rendered plan file."""
+    if not isinstance(plans, dict) or not isinstance(plans.get('name'), str):
+        raise PlanError('{}: a plan file needs a name.'.format(j2_file))
+
+    distros = plans.get('distros')
+
+    if not isinstance(distros, dict) or not distros:
+        raise PlanError('{}: a plan file needs at least one distro.'.format(
+            j2_file))
+
+    for distro, plan in distros.items():
+        commands = plan.get('commands') if isinstance(plan, dict) else None
+
+        if not commands or not isinstance(commands, list) or \
+                not all(isinstance(command, str) for command in commands):
+            raise PlanError('{}: the {} plan needs a list of commands.'.format(
+                j2_file, distro))
+
+        for key in ('timeout', 'expected_duration'):
+            if key in plan and not _is_positive_int(plan[key]):
+                raise PlanError('{}: {} of the {} plan must be a positive '
+                    'number of seconds.'.format(j2_file, key, distro))
+
+
+def _get_sample_variables():
+    """
+    Yields sets of variables that cover every branch of the conditionals
+    in the plans: staged and unstaged tools, local and on-instance builds,
+    and each compression codec.
+    """
+    for staged in (True, False):
+        artifacts = dict(
+            (name, {
+                'file_name': tool['file_name'],
+                'sha256': '0' * 64 if staged else None,
+                'key': 'artifacts/sample' if staged else None,
+                'url': tool['url']
+            })
+            for name, tool in get_tools().items()
+        )
+
+        for local_build, codec in itertools.product((True, False), CODECS):
+            yield {
+                'ssm_acquire_access_key': 'sample',
+                'ssm_acquire_secret_key': 'sample',
+                'ssm_acquire_session_token': 'sample',
+                'ssm_acquire_s3_bucket': 'sample',
+                'ssm_acquire_instance_id': FLEET_INSTANCE_ID,
+                'ssm_acquire_artifacts': artifacts,
+                'ssm_acquire_cache_dir': INSTANCE_CACHE_DIR,
+                'ssm_acquire_kernel_release': 'sample' if local_build else None,
+                'ssm_acquire_build_dir': '/build' if local_build else None,
+                'ssm_acquire_local_build': local_build,
+                'ssm_acquire_compression': get_compression(codec, level=1),
+                'ssm_acquire_query_pack': get_query_pack()
+            }
+
 
+def _get_bytecode_cache():
+    """
+    Returns the bytecode cache in plan_cache_dir, or None if the directory
+    cannot be created, e.g. on a read-only file system.
+    """
+    cache_dir = os.path.expanduser(config(
+        'plan_cache_dir',
+        namespace='ssm_acquire',
+        default='~/.cache/ssm_acquire/plans'
+    ))
 
-def get_jinja2_plan(credentials, instance_id, j2_file):
-    dirname = os.path.dirname(__file__)
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+    except OSError as e:
+        logger.warning('Not caching compiled plans: {}'.format(e))
+        return None
 
-    path = os.path.join(dirname, j2_file)
+    return jinja2.FileSystemBytecodeCache(cache_dir)
 
-    template = None
-    with open(path) as f:
-        template = jinja2.Template(f.read())
 
-    jinja2_plan = template.render(
-        ssm_acquire_access_key=credentials['Credentials']['AccessKeyId'],
-        ssm_acquire_secret_key=credentials['Credentials']['SecretAccessKey'],
-        ssm_acquire_session_token=credentials['Credentials']['SessionToken'],
-        ssm_acquire_s3_bucket=asset_bucket,
-        ssm_acquire_instance_id=instance_id
+class PlanRegistry(object):
+    def __init__(self, root=None):
+        self.root = root or os.path.dirname(__file__)
+        self.environment = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(self.root),
+            bytecode_cache=_get_bytecode_cache(),
+            undefined=jinja2.StrictUndefined,
+            auto_reload=False
+        )
+        self.environment.globals.update(_OPTIONAL_VARIABLES)
+        self.environment.filters['b64encode'] = _b64encode
+        self.templates = {}
+
+    def load(self):
+        """
+        Compiles and validates every plan.  Raises PlanError for the first
+        plan that is broken.
+        """
+        for plan_dir in PLAN_DIRS:
+            file_names = sorted(os.listdir(os.path.join(self.root, plan_dir)))
+
+            for file_name in file_names:
+                if not file_name.endswith('.j2'):
+                    continue
+
+                j2_file = '{}/{}'.format(plan_dir, file_name)
+
+                try:
+                    self.templates[j2_file] = \
+                        self.environment.get_template(j2_file)
+                except jinja2.TemplateError as e:
+                    raise PlanError('{}: {}'.format(j2_file, e))
+
+                for variables in _get_sample_variables():
+                    _validate_plans(j2_file, self.render(j2_file, variables))
+
+        logger.info('Loaded {} plans.'.format(len(self.templates)))
+
+        return self
+
+    def render_text(self, j2_file, variables):
+        """Renders a plan file and returns it as text."""
+        try:
+            template = self.templates[j2_file]
+        except KeyError:
+            raise PlanError('No plan named {}.'.format(j2_file))
+
+        try:
+            return template.render(**variables)
+        except jinja2.TemplateError as e:
+            raise PlanError('{}: {}'.format(j2_file, e))
+
+    def render(self, j2_file, variables):
+        """Renders a plan file and returns the parsed plans."""
+        try:
+            return yaml.load(
+                self.render_text(j2_file, variables), 
+                Loader=_SafeLoader
+            )
+        except yaml.YAMLError as e:
+            raise PlanError('{}: {}'.format(j2_file, e))
+
+
+def get_plan_registry():
+    """Returns the registry of this process, loading it on first use."""
+    global _registry
+
+    with _registry_lock:
+        if _registry is None:
+            _registry = PlanRegistry().load()
+
+    return _registry
+
+
+def _get_variables(credentials, instance_id, variables):
+    """
+    Returns the variables of a plan for the instance.  Extra variables are
+    passed to the template as they are, along with the staged tools, see
+    ssm_acquire.artifacts, the compression of captures, see
+    ssm_acquire.compression, and the osquery query pack, see
+    ssm_acquire.query_pack.
+    """
+    plan_variables = ArtifactStore(
+        credentials,
+        get_asset_bucket()
+    ).get_plan_variables()
+
+    instance_credentials = get_instance_credentials(credentials)
+
+    plan_variables.update(
+        ssm_acquire_access_key=instance_credentials['AccessKeyId'],
+        ssm_acquire_secret_key=instance_credentials['SecretAccessKey'],
+        ssm_acquire_session_token=instance_credentials['SessionToken'],
+        ssm_acquire_s3_bucket=get_asset_bucket(),
+        ssm_acquire_instance_id=instance_id,
+        ssm_acquire_compression=get_compression(),
+        ssm_acquire_query_pack=get_query_pack()
     )
+    plan_variables.update(variables)
 
-    return jinja2_plan
\ No newline at end of file
+    return plan_variables
+
+
+def get_plans(credentials, instance_id, j2_file, **variables):
+    """Renders a j2-formatted plan file and returns the parsed plans."""
+    return get_plan_registry().render(
+        j2_file,
+        _get_variables(credentials, instance_id, variables)
+    )
+
+
+def get_jinja2_plan(credentials, instance_id, j2_file, **variables):
+    """Renders a j2-formatted plan file and returns it as text."""
+    return get_plan_registry().render_text(
+        j2_file,
+        _get_variables(credentials, instance_id, variables)
+    )
@@ -0,0 +1,184 @@
+"""
+Builds rekall profiles off the instance, in a local container.
+
+The container runs the toolchain steps of the build plan against the
+kernel-devel package for the instance's kernel release, so nothing is
+installed on, or computed by, the suspect instance.  Packages downloaded by
+yum are kept in a named docker volume so that later builds start warm.  The
+zip is uploaded to <instance id>/<kernel release>.zip, where a build on the
+instance would have put it.
+"""
+import boto3
+import docker
+import logging
+import os
+import requests.exceptions
+
+from concurrent.futures import ThreadPoolExecutor
+
+from ssm_acquire import tracing
+from ssm_acquire.config import config_manager
+
+
+config = config_manager
+logger = logging.getLogger(__name__)
+
+# Where the host's build directory is mounted in the container.
+BUILD_DIR = '/build'
+
+# Runs before the plan so that yum keeps what it downloads in the cache
+# volume.
+_PRELUDE = [
+    'set -e',
+    "sed -i 's/^keepcache=0/keepcache=1/' /etc/yum.conf"
+]
+
+
+class LocalProfileBuilder(object):
+    def __init__(self, credentials, bucket_name):
+        self.credentials = credentials
+        self.bucket_name = bucket_name
+        self.s3_client = None
+
+        self.client = docker.from_env()
+        self.docker_image = config(
+            'profile_build_image',
+            namespace='ssm_acquire',
+            default='amazonlinux:2'
+        )
+        self.cache_volume = config(
+            'profile_build_cache_volume',
+            namespace='ssm_acquire',
+            default='ssm_acquire_yum_cache'
+        )
+        self.build_root = os.path.expanduser(config(
+            'profile_build_dir',
+            namespace='ssm_acquire',
+            default='~/.cache/ssm_acquire/builds'
+        ))
+        self.max_concurrency = int(config(
+            'profile_build_concurrency',
+            namespace='ssm_acquire',
+            default='2'
+        ))
+
+    def _connect(self):
+        if self.s3_client is None:
+            logger.info('Initializing an S3 Client.')
+            self.s3_client = boto3.client(
+                's3',
+                aws_access_key_id=self.credentials['Credentials']['AccessKeyId'],
+                aws_secret_access_key=self.credentials['Credentials']['SecretAccessKey'],
+                aws_session_token=self.credentials['Credentials']['SessionToken']
+            )
+            tracing.instrument(self.s3_client)
+
+    def _get_build_dir(self, kernel_release):
+        """
+        Returns the host directory for the build.  Builds for different
+        kernel releases can run at the same time.
+        """
+        build_dir = os.path.join(self.build_root, kernel_release)
+        if not os.path.isdir(build_dir):
+            os.makedirs(build_dir)
+        return build_dir
+
+    def _run_build(self, commands, build_dir, timeout):
+        """
+        Runs the plan in a container.  Returns the exit code, or None if the
+        build did not exit within timeout seconds.  The container is killed 
+        and removed either way.
+        """
+        container = self.client.containers.run(
+            image=self.docker_image,
+            command=['/bin/bash', '-c', '\n'.join(_PRELUDE + commands)],
+            detach=True,
+            volumes={
+                self.cache_volume: {'bind': '/var/cache/yum', 'mode': 'rw'},
+                build_dir: {'bind': BUILD_DIR, 'mode': 'rw'}
+            }
+        )
+
+        logger.info('Waiting for the profile build to exit.')
+        try:
+            result = container.wait(timeout=timeout)
+            logger.debug(container.logs())
+        except (requests.exceptions.ReadTimeout, 
+                requests.exceptions.ConnectionError):
+            logger.debug(container.logs())
+            return None
+        finally:
+            container.remove(force=True)
+
+        return result['StatusCode']
+
+    @tracing.traced('build.container')
+    def build(self, build_plan, kernel_release, instance_id):
+        """
+        Builds the profile for the kernel release with a build plan rendered
+        for BUILD_DIR, and uploads it for the instance.
+
+        Returns the final status of the build.
+        """
+        build_dir = self._get_build_dir(kernel_release)
+
+        logger.info('Building a rekall profile for kernel {} locally.'.format(
+            kernel_release))
+
+        status_code = self._run_build(
+            build_plan['commands'],
+            build_dir,
+            build_plan.get('timeout')
+        )
+
+        if status_code is None:
+            logger.warning('Local profile build for kernel {} did not finish '
+                'in {} seconds.'.format(kernel_release, 
+                build_plan.get('timeout')))
+            return 'TimedOut'
+
+        if status_code != 0:
+            logger.warning('Local profile build for kernel {} exited with '
+                '{}.'.format(kernel_release, status_code))
+            return 'Failed'
+
+        self._connect()
+        self.s3_client.upload_file(
+            os.path.join(
+                build_dir,
+                'rekall/tools/linux/{}.zip'.format(kernel_release)
+            ),
+            self.bucket_name,
+            '{}/{}.zip'.format(instance_id, kernel_release)
+        )
+
+        logger.info('Uploaded the rekall profile for kernel {} for instance '
+            '{}.'.format(kernel_release, instance_id))
+
+        return 'Success'
+
+    def build_many(self, builds):
+        """
+        Runs several builds, given as (build plan, kernel release, instance 
+        id), at most max_concurrency at a time.
+
+        Returns the final status of the build for each instance id.
+        """
+        build = tracing.bind(self.build)
+
+        with ThreadPoolExecutor(max_workers=max(1, self.max_concurrency)) \
+                as executor:
+            futures = dict(
+                (instance_id, executor.submit(
+                    build,
+                    build_plan,
+                    kernel_release,
+                    instance_id
+                ))
+                for build_plan, kernel_release, instance_id in builds
+            )
+
+        return dict(
+            (instance_id, future.result())
+            for instance_id, future in futures.items()
+        )
@@ -6,15 +6,21 @@ import yaml
 from ssm_acquire import config
 
 
+_policy_template = None
+
+
 def _get_policy_template():
-    dirname = os.path.dirname(__file__)
-    
-    path = os.path.join(dirname, "policies/instance-scoped-policy.yml")
+    """Loads the policy template the first time it is needed."""
+    global _policy_template
 
-    return yaml.safe_load(open(path))['PolicyDocument']
+    if _policy_template is None:
+        dirname = os.path.dirname(__file__)
+        
+        path = os.path.join(dirname, "policies/instance-scoped-policy.yml")
 
+        _policy_template = yaml.safe_load(open(path))['PolicyDocument']
 
-policy_template = _get_policy_template()
+    return _policy_template
 
 
 def _update_STMT1(STMT1, instance_id):
@@ -56,7 +62,28 @@ def _update_STMT4(STMT4):
     STMT4['Resource'][1] = config.get_s3_keys(s3_arn)
 
 
-def _update_statements(statements, region, instance_id):
+def _update_STMT5(STMT5, for_instance):
+    """
+    Modifies the Action and Resource dicts of STMT5 *in place* with the 
+    prefixes of the asset bucket that are shared by all instances.
+    
+    STMT5 requests permission to read and write shared assets, e.g. cached 
+    rekall profiles.  Credentials sent to an instance may only read the 
+    staged tools.
+    """
+    if for_instance:
+        STMT5['Action'] = ['s3:GetObject']
+        prefixes = config.instance_read_prefixes
+    else:
+        prefixes = config.shared_prefixes
+
+    STMT5['Resource'] = [
+        config.get_s3_keys(config.get_s3_arn(prefix)) 
+        for prefix in prefixes
+    ]
+
+
+def _update_statements(statements, region, instance_id, for_instance):
     """Modifies the policy statements *in place* with region, instance_id, 
     and asset bucket information."""
 
@@ -69,8 +96,10 @@ def _update_statements(statements, region, instance_id):
 
     _update_STMT4(statements[3])
 
+    _update_STMT5(statements[4], for_instance)
 
-def _get_updated_policy(region, instance_id):
+
+def _get_updated_policy(region, instance_id, for_instance=False):
     """
     Makes a copy of the policy template and sets the permission requests that 
     require information about the current region, asset bucket, and EC2 instance.
@@ -78,19 +107,41 @@ def _get_updated_policy(region, instance_id):
     Returns the modified copy.  The policy template is not modified.
     """
 
-    updated_policy = copy.deepcopy(policy_template)
+    updated_policy = copy.deepcopy(_get_policy_template())
+
+    if for_instance and not instance_id:
+        # Plans sent to a fleet write under the id of each instance.
+        instance_id = config.fleet_instance_prefix
 
-    _update_statements(updated_policy['Statement'], region, instance_id)
+    _update_statements(
+        updated_policy['Statement'], 
+        region, 
+        instance_id, 
+        for_instance
+    )
+
+    if for_instance:
+        # The instance only uses the asset bucket; it never calls SSM.
+        updated_policy['Statement'] = [
+            statement for statement in updated_policy['Statement']
+            if statement['Sid'] not in ('STMT2', 'STMT3')
+        ]
 
     return updated_policy
 
 
-def get_json_policy(region, instance_id):
-    """Returns a json object that contains permission requests to send 
-    commands to the EC2 instance and asset bucket."""
+def get_json_policy(region, instance_id, for_instance=False):
+    """
+    Returns a json object that contains permission requests to send 
+    commands to the EC2 instance and asset bucket.
+
+    With for_instance, returns the narrower policy of the credentials that 
+    plans carry to the instance: its own prefix of the asset bucket and 
+    read-only access to the staged tools.
+    """
 
-    updated_policy = _get_updated_policy(region, instance_id)
+    updated_policy = _get_updated_policy(region, instance_id, for_instance)
         
     json_policy = json.dumps(updated_policy)
         
-    return json_policy
\ No newline at end of file
+    return json_policy
@@ -0,0 +1,163 @@
+"""
+Content-addressed cache of rekall profiles converted to JSON.
+
+Converting a profile zip to JSON only depends on the zip, so converted
+profiles are stored under the sha256 of the zip: locally, with size-bounded
+eviction of the least recently used entries, and in the asset bucket under
+profiles/json/<kernel release>/<sha256>.json so other analyses and analysts
+can skip the conversion as well.
+"""
+import hashlib
+import logging
+import os
+import shutil
+
+from botocore.exceptions import ClientError
+
+from ssm_acquire.config import config_manager
+
+
+config = config_manager
+logger = logging.getLogger(__name__)
+
+# Prefix of the asset bucket shared by all instances; see policy.py.
+PROFILES_PREFIX = 'profiles'
+
+
+def _hash_file(path):
+    digest = hashlib.sha256()
+
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(data)
+
+    return digest.hexdigest()
+
+
+def get_kernel_release(zip_path):
+    """
+    Returns the kernel release a profile zip was built for, which is the
+    name of the zip, e.g. 4.14.72-73.55.amzn2.x86_64.
+    """
+    file_name = os.path.basename(zip_path)
+
+    if file_name.endswith('.zip'):
+        file_name = file_name[:-len('.zip')]
+
+    return file_name
+
+
+class ProfileCache(object):
+    def __init__(self, s3_client, bucket_name, cache_dir=None, max_bytes=None):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.cache_dir = os.path.expanduser(cache_dir or config(
+            'profile_cache_dir',
+            namespace='ssm_acquire',
+            default='~/.cache/ssm_acquire/profiles'
+        ))
+        self.max_bytes = max_bytes or int(config(
+            'profile_cache_max_mb',
+            namespace='ssm_acquire',
+            default='2048'
+        )) * 1024 * 1024
+
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def _local_path(self, digest):
+        return os.path.join(self.cache_dir, '{}.json'.format(digest))
+
+    def _object_key(self, zip_path, digest):
+        return '{}/json/{}/{}.json'.format(
+            PROFILES_PREFIX,
+            get_kernel_release(zip_path),
+            digest
+        )
+
+    def _fetch_from_bucket(self, object_key, local_path):
+        """
+        Downloads a converted profile from the bucket.  Returns False if it 
+        is not in the bucket; other errors, e.g. access denied, are raised.
+        """
+        try:
+            self.s3_client.download_file(
+                self.bucket_name,
+                object_key,
+                local_path + '.part'
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+                raise
+            return False
+
+        os.rename(local_path + '.part', local_path)
+        return True
+
+    def _evict(self):
+        """
+        Removes the least recently used profiles until the cache fits in
+        max_bytes.
+        """
+        entries = []
+
+        for file_name in os.listdir(self.cache_dir):
+            if file_name.endswith('.json'):
+                path = os.path.join(self.cache_dir, file_name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+
+            logger.info('Evicting {} from the profile cache.'.format(path))
+            os.remove(path)
+            total -= size
+
+    def get(self, zip_path, json_path):
+        """
+        Copies the converted profile for zip_path to json_path if it is in
+        the local cache or the bucket.  Returns True on a hit.
+        """
+        digest = _hash_file(zip_path)
+        local_path = self._local_path(digest)
+
+        if os.path.isfile(local_path):
+            logger.info('Profile cache hit for {}.'.format(digest))
+        elif self._fetch_from_bucket(
+            self._object_key(zip_path, digest),
+            local_path
+        ):
+            logger.info('Profile cache hit in the asset bucket for {}.'.format(
+                digest))
+            self._evict()
+        else:
+            logger.info('Profile cache miss for {}.'.format(digest))
+            return False
+
+        # mtime doubles as the last use for eviction.
+        os.utime(local_path, None)
+        shutil.copyfile(local_path, json_path)
+
+        return True
+
+    def put(self, zip_path, json_path):
+        """Stores the converted profile locally and in the bucket."""
+        digest = _hash_file(zip_path)
+        local_path = self._local_path(digest)
+
+        shutil.copyfile(json_path, local_path)
+
+        self.s3_client.upload_file(
+            json_path,
+            self.bucket_name,
+            self._object_key(zip_path, digest)
+        )
+
+        logger.info('Stored the converted profile for {} in the profile '
+            'cache.'.format(digest))
+
+        self._evict()
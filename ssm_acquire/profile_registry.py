@@ -0,0 +1,154 @@
+"""
+Registry of prebuilt rekall profiles, keyed by kernel release.
+
+Built profiles are published to profiles/zip/<kernel release>.zip in the
+asset bucket and listed in profiles/index.json.  Before building a profile
+on an instance, build_profile asks the registry for the instance's kernel
+release and, on a hit, copies the prebuilt zip to the instance's prefix
+instead of installing a toolchain on the host.
+"""
+import boto3
+import datetime
+import json
+import logging
+
+from botocore.exceptions import ClientError
+
+from ssm_acquire import tracing
+from ssm_acquire.profile_cache import PROFILES_PREFIX
+
+
+logger = logging.getLogger(__name__)
+
+_INDEX_KEY = '{}/index.json'.format(PROFILES_PREFIX)
+
+
+def _get_zip_key(kernel_release):
+    return '{}/zip/{}.zip'.format(PROFILES_PREFIX, kernel_release)
+
+
+class ProfileRegistry(object):
+    def __init__(self, credentials, bucket_name):
+        self.credentials = credentials
+        self.bucket_name = bucket_name
+        self.s3_client = None
+        self.index = None
+
+    def _connect(self):
+        if self.s3_client is None:
+            logger.info('Initializing an S3 Client.')
+
+            self.s3_client = boto3.client(
+                's3',
+                aws_access_key_id=self.credentials['Credentials']['AccessKeyId'],
+                aws_secret_access_key=self.credentials['Credentials']['SecretAccessKey'],
+                aws_session_token=self.credentials['Credentials']['SessionToken']
+            )
+
+            tracing.instrument(self.s3_client)
+
+    def _load_index(self):
+        """
+        Loads the index once per registry.  A missing index is empty; other 
+        errors, e.g. access denied, are raised rather than taken for a miss.
+        """
+        if self.index is None:
+            self._connect()
+
+            try:
+                response = self.s3_client.get_object(
+                    Bucket=self.bucket_name,
+                    Key=_INDEX_KEY
+                )
+
+                self.index = json.loads(response['Body'].read().decode('utf-8'))
+            except ClientError as e:
+                if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                    raise
+
+                self.index = {}
+
+        return self.index
+
+    def lookup(self, kernel_release):
+        """Returns the index entry for the kernel release, or None."""
+        return self._load_index().get(kernel_release)
+
+    def install(self, kernel_release, instance_id):
+        """
+        Copies the prebuilt profile for the kernel release to the instance's
+        prefix, where a profile built on the instance would be.  Returns
+        False if there is no prebuilt profile.
+        """
+        entry = self.lookup(kernel_release)
+
+        if entry is None:
+            return False
+
+        self._connect()
+        self.s3_client.copy_object(
+            Bucket=self.bucket_name,
+            Key='{}/{}.zip'.format(instance_id, kernel_release),
+            CopySource={'Bucket': self.bucket_name, 'Key': entry['key']}
+        )
+
+        logger.info('Installed prebuilt profile for kernel {} for instance '
+            '{}.'.format(kernel_release, instance_id))
+
+        return True
+
+    def publish(self, kernel_release, instance_id):
+        """
+        Publishes the profile built on the instance for every later instance
+        running the same kernel release.
+
+        Returns False, after logging why, if the instance has no profile for 
+        the kernel release or it cannot be published.  A failed publish 
+        does not fail the build.
+        """
+        self._connect()
+
+        zip_key = _get_zip_key(kernel_release)
+        source_key = '{}/{}.zip'.format(instance_id, kernel_release)
+
+        try:
+            self.s3_client.head_object(Bucket=self.bucket_name, Key=source_key)
+        except ClientError as e:
+            logger.error('Not publishing the profile for kernel {}: {} is '
+                'missing ({}).'.format(kernel_release, source_key,
+                e.response['Error']['Code']))
+            return False
+
+        try:
+            self.s3_client.copy_object(
+                Bucket=self.bucket_name,
+                Key=zip_key,
+                CopySource={'Bucket': self.bucket_name, 'Key': source_key}
+            )
+
+            # Re-read the index right before writing it to narrow the window 
+            # in which a concurrent publish could be lost.
+            self.index = None
+            index = self._load_index()
+
+            index[kernel_release] = {
+                'key': zip_key,
+                'source_instance_id': instance_id,
+                'published_at': datetime.datetime.utcnow().isoformat() + 'Z'
+            }
+
+            self.s3_client.put_object(
+                Bucket=self.bucket_name,
+                Key=_INDEX_KEY,
+                Body=json.dumps(index, indent=2, sort_keys=True).encode('utf-8'),
+                ContentType='application/json'
+            )
+        except ClientError as e:
+            logger.error('Failed to publish the profile for kernel {} from '
+                'instance {}: {}'.format(kernel_release, instance_id, e))
+            return False
+
+        logger.info('Published profile for kernel {} from instance {}.'.format(
+            kernel_release, instance_id))
+
+        return True
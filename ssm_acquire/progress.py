@@ -0,0 +1,197 @@
+"""
+Progress of long SSM steps, read from the markers that plans print.
+
+Long steps start a watcher, see plan-macros/progress.j2, that prints
+
+    @progress <phase> <seconds since start> <bytes done> <bytes total>
+
+whenever another few percent of the step is done.  The waiters in
+ssm_acquire.command read the output of running invocations, and a
+ProgressReport turns the markers into bytes done, rate and ETA for every
+instance.  When a step finishes its average rate is logged, which is what
+the timeouts of the plans should be sized with.
+"""
+import logging
+
+from ssm_acquire import tracing
+
+
+logger = logging.getLogger(__name__)
+
+MARKER = '@progress'
+
+
+def _format_bytes(count):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if count < 1024:
+            return '{:.1f} {}'.format(count, unit)
+        count /= 1024.0
+
+    return '{:.1f} TiB'.format(count)
+
+
+def _format_duration(seconds):
+    seconds = int(seconds)
+
+    if seconds >= 3600:
+        return '{}h {}m'.format(seconds // 3600, seconds % 3600 // 60)
+
+    if seconds >= 60:
+        return '{}m {}s'.format(seconds // 60, seconds % 60)
+
+    return '{}s'.format(seconds)
+
+
+class Progress(object):
+    """The latest marker of a phase, and the rate since its first marker."""
+    def __init__(self, phase, elapsed, done, total, rate=None):
+        self.phase = phase
+        self.elapsed = elapsed
+        # Reads of the tool itself are counted as well, so clamp to total.
+        self.done = min(done, total)
+        self.total = total
+        self.rate = rate
+
+    @property
+    def percent(self):
+        return 100 * self.done // self.total if self.total else 0
+
+    @property
+    def eta(self):
+        """Seconds left at the current rate, or None if it is unknown."""
+        if not self.rate:
+            return None
+
+        return (self.total - self.done) / self.rate
+
+    def __eq__(self, other):
+        return isinstance(other, Progress) and \
+            (self.phase, self.done, self.total) == \
+            (other.phase, other.done, other.total)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __str__(self):
+        text = '{}: {} of {} ({}%)'.format(
+            self.phase,
+            _format_bytes(self.done),
+            _format_bytes(self.total),
+            self.percent
+        )
+
+        if self.rate:
+            text += ' at {}/s, ETA {}'.format(
+                _format_bytes(self.rate),
+                _format_duration(self.eta)
+            )
+
+        return text
+
+
+def parse_progress(output):
+    """
+    Returns the Progress of the last phase reported in the output of an
+    invocation, or None if it has no markers.
+    """
+    samples = []
+
+    for line in output.splitlines():
+        fields = line.split()
+
+        if len(fields) != 5 or fields[0] != MARKER:
+            continue
+
+        try:
+            samples.append(
+                (fields[1], int(fields[2]), int(fields[3]), int(fields[4]))
+            )
+        except ValueError:
+            continue
+
+    if not samples:
+        return None
+
+    phase, elapsed, done, total = samples[-1]
+
+    first = next(sample for sample in samples if sample[0] == phase)
+
+    rate = None
+
+    if elapsed > first[1]:
+        rate = max(0, min(done, total) - first[2]) / float(elapsed - first[1])
+
+    return Progress(phase, elapsed, done, total, rate)
+
+
+class ProgressReport(object):
+    """The latest progress of every instance running a step."""
+    def __init__(self):
+        self.progress = {}
+
+    def update(self, instance_id, output):
+        """
+        Reads the markers in the output of the instance.  Returns its
+        Progress if it changed since the last update, otherwise None.
+        """
+        progress = parse_progress(output or '')
+
+        if progress is None or progress == self.progress.get(instance_id):
+            return None
+
+        self.progress[instance_id] = progress
+
+        return progress
+
+    def finish(self, instance_id, status):
+        """
+        Logs the average rate of the last phase once the step is done, and
+        adds the bytes it moved to the current span.
+        """
+        progress = self.progress.pop(instance_id, None)
+
+        if progress is None:
+            return
+
+        tracing.add_bytes(progress.done)
+
+        if not progress.elapsed:
+            return
+
+        logger.info('{} {} ended with status {} after {} at {}/s.'.format(
+            instance_id,
+            progress.phase,
+            status,
+            _format_duration(progress.elapsed),
+            _format_bytes(progress.done / float(progress.elapsed))
+        ))
+
+    def summary(self):
+        """
+        Returns one line on the progress of all running instances, naming
+        the one that will finish last.
+        """
+        if not self.progress:
+            return None
+
+        done = sum(progress.done for progress in self.progress.values())
+        total = sum(progress.total for progress in self.progress.values())
+
+        text = 'Progress: {} of {} on {} instances'.format(
+            _format_bytes(done),
+            _format_bytes(total),
+            len(self.progress)
+        )
+
+        estimates = dict(
+            (instance_id, progress.eta)
+            for instance_id, progress in self.progress.items()
+            if progress.eta is not None
+        )
+
+        if estimates:
+            slowest = max(estimates, key=estimates.get)
+
+            text += '; slowest {} {}'.format(slowest, self.progress[slowest])
+
+        return text + '.'
@@ -0,0 +1,182 @@
+"""
+The osquery query pack that the interrogate plan runs.
+
+The pack is a YAML file of named queries, query-packs/default.yml unless
+osquery_query_pack names another, so teams add queries without editing the
+plan.  The plan runs the queries in one osqueryi process, which starts and
+scans processes once rather than once per query.  Queries marked concurrent
+run in a second osqueryi process at the same time; both run without
+osquery's database and extensions so that they do not contend for them.
+
+Before each query the plan selects its name as ssm_acquire_query, and
+split.awk cuts osqueryi's output at those rows into one JSON document per
+query.  The documents are uploaded together, with a manifest of the
+queries, under <instance_id>/osquery/.
+"""
+import os
+import re
+import threading
+
+import yaml
+
+from ssm_acquire.config import config_manager
+from ssm_acquire.results import OSQUERY_DIR
+from ssm_acquire.results import OSQUERY_MANIFEST
+from ssm_acquire.results import get_table_columns
+
+
+config = config_manager
+
+# Where the plan writes the documents on the instance.
+OUTPUT_DIR = '/tmp/ssm_acquire_osquery'
+
+# The column of the row that names the next query in osqueryi's output.
+MARKER_COLUMN = 'ssm_acquire_query'
+
+_NAME_PATTERN = re.compile(r'^[a-z0-9_]+$')
+
+# Cuts osqueryi --json output into OUTPUT_DIR/<name>.json.  osqueryi prints
+# every result as '[', one row per line and ']', so the marker row is the
+# line between its own brackets; lines are printed one behind to drop the
+# '[' before it.
+_SPLIT_AWK = '''\
+/"{marker}":/ {{ split($0, field, "\\""); file = dir "/" field[4] ".json"; held = ""; drop = 1; next }}
+drop {{ drop = 0; next }}
+file != "" && held != "" {{ print held > file }}
+{{ held = $0 }}
+END {{ if (file != "" && held != "") print held > file }}
+'''.format(marker=MARKER_COLUMN)
+
+_packs = {}
+_packs_lock = threading.Lock()
+
+
+class QueryPackError(Exception):
+    """Raised when a query pack cannot be read or does not match the schema."""
+
+
+def get_default_pack_path():
+    return os.path.join(os.path.dirname(__file__), 'query-packs/default.yml')
+
+
+def _validate_query(path, name, query):
+    if not _NAME_PATTERN.match(name):
+        raise QueryPackError('{}: {} is not a valid query name.  Use lowercase '
+            'letters, digits and underscores.'.format(path, name))
+
+    if name + '.json' == OSQUERY_MANIFEST:
+        raise QueryPackError('{}: {} is the name of the manifest.'.format(
+            path, name))
+
+    if not isinstance(query, dict) or \
+            not isinstance(query.get('query'), str) or \
+            not query['query'].strip():
+        raise QueryPackError('{}: query {} needs SQL in query.'.format(
+            path, name))
+
+    table = query.get('table')
+
+    if table is None:
+        if query.get('columns'):
+            raise QueryPackError('{}: query {} has columns but no '
+                'table.'.format(path, name))
+        return
+
+    try:
+        columns = get_table_columns(table)
+    except KeyError:
+        raise QueryPackError('{}: query {} names an unknown table {}.'.format(
+            path, name, table))
+
+    for column in query.get('columns') or {}:
+        if column not in columns:
+            raise QueryPackError('{}: table {} of query {} has no column '
+                '{}.'.format(path, table, name, column))
+
+
+def _get_lane(queries):
+    """Returns the osqueryi input of a list of queries, with the markers."""
+    return {
+        'names': [query['name'] for query in queries],
+        'script': ''.join(
+            'SELECT \'{}\' AS {};\n{}\n'.format(
+                query['name'],
+                MARKER_COLUMN,
+                query['query'].strip().rstrip(';') + ';'
+            )
+            for query in queries
+        )
+    }
+
+
+def load_query_pack(path):
+    """
+    Reads and checks a query pack.  Returns it as the plan uses it:
+
+        name      the name of the pack
+        queries   every query, in order, with its name
+        lanes     the queries of each osqueryi process, see _get_lane
+        split     the awk program that splits the output
+        output_dir, prefix, manifest_name
+                  where the documents are written on the instance and
+                  uploaded under the instance id
+        manifest  what is uploaded as the manifest
+    """
+    try:
+        with open(path) as f:
+            pack = yaml.safe_load(f)
+    except (IOError, OSError, yaml.YAMLError) as e:
+        raise QueryPackError('{}: {}'.format(path, e))
+
+    if not isinstance(pack, dict) or not isinstance(pack.get('queries'), dict) \
+            or not pack['queries']:
+        raise QueryPackError('{}: a query pack needs at least one '
+            'query.'.format(path))
+
+    queries = []
+
+    for name, query in pack['queries'].items():
+        _validate_query(path, name, query)
+        queries.append(dict(query, name=name))
+
+    serial = [query for query in queries if not query.get('concurrent')]
+    concurrent = [query for query in queries if query.get('concurrent')]
+
+    return {
+        'name': pack.get('name') or os.path.basename(path),
+        'queries': queries,
+        'lanes': [_get_lane(lane) for lane in (serial, concurrent) if lane],
+        'split': _SPLIT_AWK,
+        'output_dir': OUTPUT_DIR,
+        'prefix': OSQUERY_DIR,
+        'manifest_name': OSQUERY_MANIFEST,
+        'manifest': {
+            'pack': pack.get('name') or os.path.basename(path),
+            'queries': [
+                {
+                    'name': query['name'],
+                    'table': query.get('table'),
+                    'columns': query.get('columns') or {}
+                }
+                for query in queries
+            ]
+        }
+    }
+
+
+def get_query_pack():
+    """
+    Returns the query pack in osquery_query_pack, or the default pack.  A
+    pack is read once per process.
+    """
+    path = os.path.expanduser(config(
+        'osquery_query_pack',
+        namespace='ssm_acquire',
+        default=get_default_pack_path()
+    ))
+
+    with _packs_lock:
+        if path not in _packs:
+            _packs[path] = load_query_pack(path)
+
+    return _packs[path]
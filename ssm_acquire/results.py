@@ -0,0 +1,688 @@
+"""
+Typed tables of the analysis and interrogation output of an instance.
+
+The raw output stays in the asset bucket as it was written: the JSON
+rendering of every rekall plugin, the yara matches and the JSON document of
+every osquery query under osquery/, with the manifest of the query pack that
+maps each query to a table (see ssm_acquire.query_pack).  Instances
+interrogated before the query pack have interrogation.log instead, whose
+osquery results are JSON arrays between echo banners.  This module
+stream-parses them, one row at a time, into an SQLite database per instance
+with these tables:
+
+    processes       source, pid, ppid, uid, name, path, cmdline,
+                    start_time, on_disk
+    sockets         source, pid, process, family, protocol,
+                    local_address, local_port, remote_address, remote_port,
+                    state
+    interfaces      source, name, address, mac
+    kernel_modules  source, name, size, status
+    yara_hits       source, namespace, rule, string, offset
+    metadata        key, value
+
+source is the rekall plugin or osquery query a row came from, e.g. psaux or
+listening_ports.  The database is uploaded next to the raw output as
+<instance_id>/results.sqlite, so that a question such as "which hosts had a
+process listening on 4444" reads a few indexed pages per host instead of
+every output file:
+
+    SELECT * FROM sockets WHERE local_port = 4444 AND state = 'LISTEN'
+
+see query_results and the --query option.
+"""
+import json
+import logging
+import os
+import re
+import sqlite3
+import time
+
+from ssm_acquire import tracing
+from ssm_acquire.config import get_asset_bucket
+
+
+logger = logging.getLogger(__name__)
+
+RESULTS_NAME = 'results.sqlite'
+
+# Bumped when the tables change, so that old databases can be told apart.
+SCHEMA_VERSION = 1
+
+_TABLES = {
+    'processes': (
+        ('source', 'TEXT'),
+        ('pid', 'INTEGER'),
+        ('ppid', 'INTEGER'),
+        ('uid', 'INTEGER'),
+        ('name', 'TEXT'),
+        ('path', 'TEXT'),
+        ('cmdline', 'TEXT'),
+        ('start_time', 'TEXT'),
+        ('on_disk', 'INTEGER')
+    ),
+    'sockets': (
+        ('source', 'TEXT'),
+        ('pid', 'INTEGER'),
+        ('process', 'TEXT'),
+        ('family', 'TEXT'),
+        ('protocol', 'TEXT'),
+        ('local_address', 'TEXT'),
+        ('local_port', 'INTEGER'),
+        ('remote_address', 'TEXT'),
+        ('remote_port', 'INTEGER'),
+        ('state', 'TEXT')
+    ),
+    'interfaces': (
+        ('source', 'TEXT'),
+        ('name', 'TEXT'),
+        ('address', 'TEXT'),
+        ('mac', 'TEXT')
+    ),
+    'kernel_modules': (
+        ('source', 'TEXT'),
+        ('name', 'TEXT'),
+        ('size', 'INTEGER'),
+        ('status', 'TEXT')
+    ),
+    'yara_hits': (
+        ('source', 'TEXT'),
+        ('namespace', 'TEXT'),
+        ('rule', 'TEXT'),
+        ('string', 'TEXT'),
+        ('offset', 'INTEGER')
+    )
+}
+
+_INDEXES = (
+    ('processes', 'name'),
+    ('processes', 'pid'),
+    ('sockets', 'local_port'),
+    ('sockets', 'remote_port'),
+    ('sockets', 'remote_address'),
+    ('interfaces', 'address'),
+    ('kernel_modules', 'name'),
+    ('yara_hits', 'rule')
+)
+
+# The names each column goes by in rekall, volatility3 and osquery output,
+# compared without case, spaces or punctuation.  The first present wins.
+_ALIASES = {
+    'pid': ('pid', 'procpid'),
+    'ppid': ('ppid', 'parentpid'),
+    'uid': ('uid', 'realuid'),
+    'name': ('name', 'comm', 'processname', 'command', 'proc', 'task',
+        'interface'),
+    'path': ('path', 'exe'),
+    'cmdline': ('cmdline', 'args', 'arguments', 'cmd'),
+    'start_time': ('starttime', 'start', 'createtime'),
+    'on_disk': ('ondisk',),
+    'process': ('processname', 'comm', 'name', 'command', 'task'),
+    'family': ('family', 'af'),
+    'protocol': ('protocol', 'proto', 'type'),
+    'local_address': ('localaddress', 'localaddr', 'sourceaddr', 'saddr',
+        'address', 'ipv4', 'ip'),
+    'local_port': ('localport', 'sourceport', 'sport', 'port'),
+    'remote_address': ('remoteaddress', 'remoteaddr', 'destinationaddr',
+        'daddr'),
+    'remote_port': ('remoteport', 'destinationport', 'dport'),
+    'state': ('state', 'status'),
+    'address': ('address', 'ipv4', 'ip', 'ipaddress'),
+    'mac': ('mac', 'macaddress', 'hwaddr'),
+    'size': ('size',),
+    'status': ('status', 'state'),
+    'namespace': ('namespace',),
+    'rule': ('rule',),
+    'string': ('string',),
+    'offset': ('physicaloffset', 'offset')
+}
+
+# The table of every rekall plugin.
+REKALL_TABLES = {
+    'psaux': 'processes',
+    'pstree': 'processes',
+    'pidhashtable': 'processes',
+    'netstat': 'sockets',
+    'ifconfig': 'interfaces'
+}
+
+# The table of every query of interrogation.log, and the values of columns
+# that a query implies rather than selects.
+OSQUERY_TABLES = {
+    'listening_ports': ('sockets', {'state': 'LISTEN'}),
+    'open_sockets': ('sockets', {}),
+    'deleted_binaries': ('processes', {'on_disk': 0}),
+    'kernel_modules': ('kernel_modules', {})
+}
+
+# The banner that interrogation.log has before the output of each query.
+_OSQUERY_BANNERS = {
+    'Find new processes listening on network ports.': 'listening_ports',
+    'Find non-HTTP traffic exchanged from this instance.': 'open_sockets',
+    'Find processes running whose binary has been deleted from disk.':
+        'deleted_binaries',
+    'Find any new kernel modules that have been loaded.': 'kernel_modules'
+}
+
+# <plugin>-<instance_id>-output.json, as written by every analysis backend.
+_OUTPUT_PATTERN = re.compile(
+    r'^(?P<plugin>[a-z0-9_-]+?)-(?P<instance_id>i-[0-9a-f]+)-output\.json$')
+
+_INTERROGATION_LOG = 'interrogation.log'
+
+# The directory of the osquery documents, and their manifest.
+OSQUERY_DIR = 'osquery'
+OSQUERY_MANIFEST = 'manifest.json'
+
+_CHUNK_SIZE = 64 * 1024
+
+# The largest element of an output that is parsed, in bytes.
+_MAX_ELEMENT = 64 * 1024 * 1024
+
+# Characters that can continue a number; no other element is followed by one.
+_NUMBER_CHARACTERS = frozenset('0123456789.eE+-')
+
+# Rows are inserted in batches of this many.
+_BATCH_SIZE = 1000
+
+
+def get_table_columns(table):
+    """Returns the column names of a table.  Raises KeyError if unknown."""
+    return [column for column, _ in _TABLES[table]]
+
+
+def _normalize_key(key):
+    return re.sub(r'[^a-z0-9]', '', key.lower())
+
+
+def _scalar(value):
+    """
+    Returns a text or number for a value of the output.  rekall renders
+    structs and times as objects, e.g. {"epoch": 1546300800}.
+    """
+    if isinstance(value, dict):
+        for key in ('value', 'epoch', 'string_value', 'str', 'Name', 'name',
+                'comm', 'pid'):
+            if key in value:
+                return _scalar(value[key])
+        return None
+    if isinstance(value, list):
+        return ' '.join(str(_scalar(v)) for v in value)
+    return value
+
+
+def _to_integer(value):
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    try:
+        return int(str(value), 0)
+    except ValueError:
+        try:
+            return int(float(value))
+        except ValueError:
+            return None
+
+
+def _to_text(value):
+    if value is None or value == '':
+        return None
+    return str(value)
+
+
+def _split_address(value):
+    """Splits rekall's 'address:port' into the address and the port."""
+    if not isinstance(value, str) or ':' not in value:
+        return value, None
+    address, _, port = value.rpartition(':')
+    if not port.isdigit():
+        return value, None
+    return address.strip('[]'), port
+
+
+def _normalize_row(table, row, source, implied=None):
+    """Returns the values of the table's columns, in order, for a raw row."""
+    keys = dict((_normalize_key(key), key) for key in row)
+    values = {'source': source}
+    values.update(implied or {})
+
+    for column, column_type in _TABLES[table]:
+        if column in values:
+            continue
+        for alias in _ALIASES.get(column, (column,)):
+            if alias in keys:
+                values[column] = _scalar(row[keys[alias]])
+                break
+
+    if table == 'sockets':
+        for address, port in (
+            ('local_address', 'local_port'),
+            ('remote_address', 'remote_port')
+        ):
+            if values.get(port) is None:
+                values[address], values[port] = \
+                    _split_address(values.get(address))
+
+    return tuple(
+        _to_integer(values.get(column)) if column_type == 'INTEGER'
+        else _to_text(values.get(column))
+        for column, column_type in _TABLES[table]
+    )
+
+
+def iter_json_array(f, chunk_size=_CHUNK_SIZE):
+    """
+    Yields the elements of the JSON array in the file object f one at a
+    time, holding about one element and one chunk in memory rather than the
+    whole array.
+
+    Raises ValueError if f does not hold a JSON array, or an element is
+    larger than _MAX_ELEMENT.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    finished = False
+    started = False
+
+    while True:
+        while position < len(buffer) and buffer[position] in ' \t\r\n,':
+            position += 1
+
+        element = end = None
+
+        if position < len(buffer):
+            if not started:
+                if buffer[position] != '[':
+                    raise ValueError('Not a JSON array.')
+                started = True
+                position += 1
+                continue
+
+            if buffer[position] == ']':
+                return
+
+            try:
+                element, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                pass
+
+        # A number at the end of the buffer may be cut short, and decode as
+        # a shorter number, e.g. 1.5 of 1.5e3.
+        cut_short = end is not None and not finished and (
+            end == len(buffer) or buffer[end] in _NUMBER_CHARACTERS
+        )
+
+        if end is not None and not cut_short:
+            yield element
+            position = end
+            continue
+
+        if finished:
+            if started or buffer[position:].strip():
+                raise ValueError('Truncated JSON array.')
+            return
+
+        if len(buffer) - position > _MAX_ELEMENT:
+            raise ValueError('An element of the array is larger than {} '
+                'bytes.'.format(_MAX_ELEMENT))
+
+        # Reading as much again as is buffered keeps large elements from
+        # being decoded over and over.
+        chunk = f.read(max(chunk_size, len(buffer) - position))
+        finished = not chunk
+        buffer = buffer[position:] + chunk
+        position = 0
+
+
+def iter_rekall_rows(path):
+    """Yields the rows of rekall's JSON rendering of a plugin."""
+    with open(path) as f:
+        for entry in iter_json_array(f):
+            if isinstance(entry, list) and len(entry) == 2 and \
+                    entry[0] == 'r' and isinstance(entry[1], dict):
+                yield entry[1]
+
+
+def iter_interrogation_log(path):
+    """
+    Yields the query and row of every osquery result in interrogation.log.
+    osqueryi --json writes one row per line; rows that span lines are put
+    back together.
+    """
+    query = None
+    pending = ''
+
+    with open(path) as f:
+        for line in f:
+            stripped = line.strip()
+
+            if stripped in _OSQUERY_BANNERS:
+                # A row cut short ends at the next banner.
+                query = _OSQUERY_BANNERS[stripped]
+                pending = ''
+                continue
+            elif pending:
+                pending += stripped
+            elif stripped.startswith('{'):
+                pending = stripped
+            else:
+                continue
+
+            try:
+                row = json.loads(pending.rstrip(','))
+            except ValueError:
+                continue
+
+            pending = ''
+
+            if query is not None and isinstance(row, dict):
+                yield query, row
+
+
+class ResultsStore(object):
+    """
+    The tables of one instance in an SQLite database.  The database is
+    written to a temporary file and moved into place by close(), so readers
+    never see half of it.
+    """
+    def __init__(self, path, instance_id):
+        self.path = path
+        self.instance_id = instance_id
+        self.temporary_path = path + '.part'
+        self.counts = dict((table, 0) for table in _TABLES)
+
+        if os.path.exists(self.temporary_path):
+            os.remove(self.temporary_path)
+
+        self.connection = sqlite3.connect(self.temporary_path)
+
+        # The file is rebuilt from the raw output if this run dies.
+        self.connection.execute('PRAGMA journal_mode = OFF')
+        self.connection.execute('PRAGMA synchronous = OFF')
+
+        for table, columns in _TABLES.items():
+            self.connection.execute('CREATE TABLE {} ({})'.format(
+                table,
+                ', '.join('{} {}'.format(*column) for column in columns)
+            ))
+
+        self.connection.execute(
+            'CREATE TABLE metadata (key TEXT PRIMARY KEY, value TEXT)')
+
+    def _flush(self, table, batch):
+        self.connection.executemany(
+            'INSERT INTO {} VALUES ({})'.format(
+                table,
+                ', '.join('?' * len(_TABLES[table]))
+            ),
+            batch
+        )
+        self.counts[table] += len(batch)
+
+    def _insert(self, rows):
+        """Inserts (table, values) pairs in batches per table."""
+        batches = dict((table, []) for table in _TABLES)
+
+        for table, values in rows:
+            batch = batches[table]
+            batch.append(values)
+            if len(batch) >= _BATCH_SIZE:
+                self._flush(table, batch)
+                del batch[:]
+
+        for table, batch in batches.items():
+            if batch:
+                self._flush(table, batch)
+
+    def add_rekall_output(self, plugin, path):
+        table = REKALL_TABLES.get(plugin)
+
+        if table is None:
+            logger.debug('No table for plugin {}.'.format(plugin))
+            return
+
+        self._insert(
+            (table, _normalize_row(table, row, plugin))
+            for row in iter_rekall_rows(path)
+        )
+
+    def add_osquery_rows(self, rows, tables=None):
+        """
+        Adds (query, row) pairs.  tables maps each query to its table and
+        implied columns, OSQUERY_TABLES by default; rows of other queries
+        are skipped.
+        """
+        tables = OSQUERY_TABLES if tables is None else tables
+
+        self._insert(
+            (
+                tables[query][0],
+                _normalize_row(tables[query][0], row, query, tables[query][1])
+            )
+            for query, row in rows
+            if query in tables
+        )
+
+    def add_interrogation_log(self, path):
+        self.add_osquery_rows(iter_interrogation_log(path))
+
+    def add_osquery_document(self, query, path, table, columns=None):
+        """Adds the rows of the JSON document of a query."""
+        with open(path) as f:
+            self.add_osquery_rows(
+                (
+                    (query, row) for row in iter_json_array(f)
+                    if isinstance(row, dict)
+                ),
+                {query: (table, columns or {})}
+            )
+
+    def add_yara_matches(self, path):
+        with open(path) as f:
+            self._insert(
+                ('yara_hits', _normalize_row('yara_hits', match, 'yara'))
+                for match in iter_json_array(f)
+                if isinstance(match, dict)
+            )
+
+    def close(self):
+        """Indexes the tables and moves the database into place."""
+        for table, column in _INDEXES:
+            self.connection.execute(
+                'CREATE INDEX {0}_{1} ON {0} ({1})'.format(table, column))
+
+        self.connection.executemany(
+            'INSERT INTO metadata VALUES (?, ?)',
+            [
+                ('instance_id', self.instance_id),
+                ('schema_version', str(SCHEMA_VERSION)),
+                ('built_at', str(int(time.time())))
+            ] + [
+                ('rows.{}'.format(table), str(count))
+                for table, count in sorted(self.counts.items())
+            ]
+        )
+        self.connection.commit()
+        self.connection.close()
+
+        os.rename(self.temporary_path, self.path)
+
+        return self.counts
+
+
+def _is_source(path):
+    """Returns True for the output that results are built from."""
+    if path.startswith(OSQUERY_DIR + '/'):
+        return path.endswith('.json')
+
+    return bool(_OUTPUT_PATTERN.match(path)) or path == _INTERROGATION_LOG
+
+
+def _add_file(store, directory, file_name):
+    path = os.path.join(directory, file_name)
+
+    with tracing.span('results.parse', file=file_name) as span:
+        span.add_bytes(os.path.getsize(path))
+        try:
+            if file_name == _INTERROGATION_LOG:
+                store.add_interrogation_log(path)
+            elif file_name.startswith('yara-scan-'):
+                store.add_yara_matches(path)
+            else:
+                store.add_rekall_output(
+                    _OUTPUT_PATTERN.match(file_name).group('plugin'),
+                    path
+                )
+        except (ValueError, UnicodeDecodeError) as e:
+            logger.warning('Skipping {}, which could not be parsed: '
+                '{}'.format(file_name, e))
+
+
+def _add_osquery_documents(store, directory):
+    """Adds the documents that the osquery manifest maps to a table."""
+    with open(os.path.join(directory, OSQUERY_MANIFEST)) as f:
+        manifest = json.load(f)
+
+    for query in manifest.get('queries', []):
+        path = os.path.join(directory, '{}.json'.format(query['name']))
+
+        if not query.get('table'):
+            continue
+
+        if not os.path.isfile(path):
+            logger.warning('Query {} has no output.'.format(query['name']))
+            continue
+
+        with tracing.span('results.parse', file=path) as span:
+            span.add_bytes(os.path.getsize(path))
+            try:
+                store.add_osquery_document(
+                    query['name'],
+                    path,
+                    query['table'],
+                    query.get('columns')
+                )
+            except (ValueError, UnicodeDecodeError) as e:
+                logger.warning('Skipping query {}, whose output could not be '
+                    'parsed: {}'.format(query['name'], e))
+
+
+@tracing.traced('results.build')
+def build_results(instance_id, directory=None):
+    """
+    Parses the output in the directory of the instance, /tmp/<instance_id>
+    by default, into its results database.  Output that cannot be parsed is
+    logged and skipped.  Returns the path of the database.
+    """
+    directory = directory or '/tmp/{}'.format(instance_id)
+    store = ResultsStore(os.path.join(directory, RESULTS_NAME), instance_id)
+
+    osquery_dir = os.path.join(directory, OSQUERY_DIR)
+    has_documents = os.path.isfile(os.path.join(osquery_dir, OSQUERY_MANIFEST))
+
+    for file_name in sorted(os.listdir(directory)):
+        # The documents supersede the log of an earlier interrogation.
+        superseded = has_documents and file_name == _INTERROGATION_LOG
+
+        if _is_source(file_name) and not superseded:
+            _add_file(store, directory, file_name)
+
+    if has_documents:
+        _add_osquery_documents(store, osquery_dir)
+
+    counts = store.close()
+
+    logger.info('Results of instance {}: {}'.format(
+        instance_id,
+        ', '.join('{} {}'.format(count, table)
+            for table, count in sorted(counts.items()))
+    ))
+
+    return store.path
+
+
+@tracing.traced('results')
+def update_results(instance_id, credentials):
+    """
+    Downloads the output of the instance from the asset bucket, leaving
+    out captures and profiles, rebuilds its results database and uploads
+    it next to the output.
+    """
+    from ssm_acquire.analyze import S3Manager
+
+    s3_manager = S3Manager(credentials, get_asset_bucket())
+    s3_manager.create_instance_directory(instance_id)
+
+    s3_manager.get_files([
+        s3_object
+        for s3_object in s3_manager.list_objects_for_key(
+            '{}/'.format(instance_id))
+        if _is_source(s3_object['Key'].split('/', 1)[-1])
+    ])
+
+    s3_manager.put_file(build_results(instance_id), instance_id)
+
+
+def _get_results_keys(s3_manager, instance_ids):
+    if instance_ids:
+        return [
+            '{}/{}'.format(instance_id, RESULTS_NAME)
+            for instance_id in instance_ids
+        ]
+
+    return sorted(
+        s3_object['Key']
+        for s3_object in s3_manager.list_objects_for_key('')
+        if s3_object['Key'].endswith('/' + RESULTS_NAME)
+    )
+
+
+def open_results(path):
+    """Opens a results database read-only."""
+    return sqlite3.connect('file:{}?mode=ro'.format(path), uri=True)
+
+
+def download_results(credentials, instance_ids=None):
+    """
+    Downloads the results database of each instance, or of every instance
+    in the asset bucket, and yields the instance id and the local path.
+    Instances without results are logged and skipped.  Only databases that
+    changed since the last download are downloaded.
+    """
+    from ssm_acquire.analyze import S3Manager
+
+    s3_manager = S3Manager(credentials, get_asset_bucket())
+
+    for key in _get_results_keys(s3_manager, instance_ids):
+        instance_id = key.split('/')[0]
+
+        s3_objects = s3_manager.list_objects_for_key(key)
+
+        if not s3_objects:
+            logger.warning('Instance {} has no results.'.format(instance_id))
+            continue
+
+        path, = s3_manager.get_files(s3_objects)
+
+        yield instance_id, path
+
+
+@tracing.traced('results.query')
+def query_results(credentials, sql, instance_ids=None):
+    """
+    Runs a read-only SQL query against the results database of each
+    instance, or of every instance in the asset bucket, and yields the
+    instance id, the column names and each row.
+    """
+    for instance_id, path in download_results(credentials, instance_ids):
+        connection = open_results(path)
+
+        try:
+            cursor = connection.execute(sql)
+            columns = [column[0] for column in cursor.description or []]
+
+            for row in cursor:
+                yield instance_id, columns, row
+        finally:
+            connection.close()
@@ -0,0 +1,187 @@
+"""
+Runs the ssm_acquire modes for one instance concurrently.
+
+Acquire, build and interrogate do not depend on each other, so they run at
+the same time.  Analyze needs both the capture and the rekall profile in the
+asset bucket, so it starts once acquire and build (if requested) have
+succeeded.
+"""
+import asyncio
+import logging
+
+from ssm_acquire import tracing
+from ssm_acquire.acquire import dump_and_transfer_async
+from ssm_acquire.build import build_profile_async
+from ssm_acquire.facts import get_instance_facts_async
+from ssm_acquire.interrogate import interrogate_instance_async
+
+
+logger = logging.getLogger(__name__)
+
+
+def _get_failed_prerequisites(prerequisites):
+    """
+    Returns the names of the finished prerequisite tasks that raised or did
+    not succeed.
+    """
+    failed = []
+
+    for name, task in prerequisites.items():
+        if task.exception() is not None or task.result() != 'Success':
+            failed.append(name)
+
+    return failed
+
+
+async def _analyze_when_ready(
+    prerequisites,
+    instance_id,
+    credentials,
+    backend='docker'
+):
+    """
+    Waits for the prerequisite tasks, then analyzes the capture.  Analysis
+    is skipped if any prerequisite failed.
+
+    Returns the final status of the analysis.
+    """
+    if prerequisites:
+        await asyncio.wait(list(prerequisites.values()))
+
+        failed = _get_failed_prerequisites(prerequisites)
+
+        if failed:
+            logger.warning('Skipping analysis because these modes did not '
+                'succeed: {}'.format(failed))
+            return 'Skipped'
+
+    # docker and volatility3 are only imported when analysis is requested.
+    from ssm_acquire.analyze import analyze_capture
+
+    loop = asyncio.get_event_loop()
+
+    # Analysis drives docker and S3 with blocking calls.
+    await loop.run_in_executor(
+        None,
+        tracing.bind(analyze_capture),
+        instance_id,
+        credentials,
+        backend
+    )
+
+    return 'Success'
+
+
+async def run_phases_async(
+    ssm_client,
+    instance_id,
+    credentials,
+    analyze=False,
+    acquire=False,
+    build=False,
+    interrogate=False,
+    stream=False,
+    build_backend='instance',
+    analyze_backend='docker'
+):
+    """
+    Runs the flagged modes concurrently and waits for all of them.  stream
+    selects the streaming acquisition, see dump_and_transfer,
+    build_backend where the profile is built, see build_profile, and
+    analyze_backend how the capture is analyzed, see analyze_capture.
+
+    The facts of the instance are probed once, before any mode starts, so
+    the modes share them instead of racing to probe.
+
+    Returns the final status of each mode that ran.  If a mode raised, the
+    remaining modes still finish before the first exception is re-raised.
+    """
+    tasks = {}
+
+    if acquire or build or interrogate:
+        await get_instance_facts_async(ssm_client, instance_id)
+
+    if acquire:
+        tasks['acquire'] = asyncio.ensure_future(
+            dump_and_transfer_async(
+                ssm_client,
+                instance_id,
+                credentials,
+                stream=stream
+            )
+        )
+
+    if build:
+        tasks['build'] = asyncio.ensure_future(
+            build_profile_async(
+                ssm_client,
+                instance_id,
+                credentials,
+                backend=build_backend
+            )
+        )
+
+    if interrogate:
+        tasks['interrogate'] = asyncio.ensure_future(
+            interrogate_instance_async(ssm_client, instance_id, credentials)
+        )
+
+    if analyze:
+        prerequisites = dict(
+            (name, tasks[name]) for name in ('acquire', 'build')
+            if name in tasks
+        )
+
+        tasks['analyze'] = asyncio.ensure_future(
+            _analyze_when_ready(
+                prerequisites,
+                instance_id,
+                credentials,
+                backend=analyze_backend
+            )
+        )
+
+    if tasks:
+        await asyncio.wait(list(tasks.values()))
+
+    return dict((name, task.result()) for name, task in tasks.items())
+
+
+def run_phases(
+    ssm_client,
+    instance_id,
+    credentials,
+    analyze=False,
+    acquire=False,
+    build=False,
+    interrogate=False,
+    stream=False,
+    build_backend='instance',
+    analyze_backend='docker'
+):
+    """
+    Runs the flagged modes concurrently on a fresh event loop.  See
+    run_phases_async.
+    """
+    loop = asyncio.new_event_loop()
+
+    try:
+        asyncio.set_event_loop(loop)
+
+        return loop.run_until_complete(
+            run_phases_async(
+                ssm_client,
+                instance_id,
+                credentials,
+                analyze=analyze,
+                acquire=acquire,
+                build=build,
+                interrogate=interrogate,
+                stream=stream,
+                build_backend=build_backend,
+                analyze_backend=analyze_backend
+            )
+        )
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
@@ -0,0 +1,255 @@
+"""
+Stateless submit and check steps, for running the phases from a state
+machine.
+
+submit() sends the plan of one phase to an instance and returns at once
+with the command id; check() reads the invocation once.  Everything a step
+needs is in the state it is given and returns, so AWS Step Functions can do
+the waiting between checks in Wait states, see lambda_handler/handle.py,
+instead of a Lambda that sits in ensure_command for the length of a dump.
+
+The state is a dict of JSON values:
+
+    phase, instance_id    what runs where
+    facts                 the result of the 'facts' phase, if it ran; it
+                          selects the plan for the distro and skips dumps
+                          that do not fit on disk
+    command_id            the SSM command, once submitted
+    status, done          the latest status and whether it is final
+    progress              the latest progress marker of the step, as text
+    checks, wait_seconds  the checks so far and the wait before the next
+"""
+import logging
+import math
+import time
+
+from ssm_acquire.command import Backoff
+from ssm_acquire.command import FINAL_STATUSES
+from ssm_acquire.command import cancel_command
+from ssm_acquire.command import check_command
+from ssm_acquire.command import submit_command
+from ssm_acquire.config import get_asset_bucket
+from ssm_acquire.facts import capture_fits
+from ssm_acquire.facts import get_distro
+from ssm_acquire.facts import get_probe_plan
+from ssm_acquire.facts import parse_facts
+from ssm_acquire.facts import select_plan
+from ssm_acquire.progress import parse_progress
+
+
+logger = logging.getLogger(__name__)
+
+# The plan file of every phase but 'facts'.
+_PHASE_PLANS = {
+    'dump': 'acquire-plans/linpmem.yml.j2',
+    'transfer': 'transfer-plans/linpmem.yml.j2',
+    'stream': 'acquire-plans/linpmem-stream.yml.j2',
+    'build': 'build-plans/linpmem.yml.j2',
+    'interrogate': 'interrogate-plans/osquery.yml.j2'
+}
+
+PHASES = ('facts',) + tuple(sorted(_PHASE_PLANS))
+
+# Bounds on the wait between two checks, in seconds.  Every check is a
+# state transition and a Lambda invocation, so they are farther apart than
+# the polls of ensure_command.
+_MIN_WAIT = 5
+_MAX_WAIT = 300
+
+# SSM takes a while to register a command; a check that comes too early
+# should not count towards the timeout.
+_REGISTRATION_GRACE = 60
+
+
+class StepError(Exception):
+    """Raised for an unknown phase or a state without a command id."""
+
+
+def _get_plan(phase, instance_id, credentials, facts):
+    if phase == 'facts':
+        return get_probe_plan()
+
+    if phase not in _PHASE_PLANS:
+        raise StepError('Unknown phase {}.  Choose one of: {}'.format(
+            phase,
+            ', '.join(PHASES)
+        ))
+
+    # jinja2 is only imported by the steps that render a plan.
+    from ssm_acquire.jinja2_io import get_plans
+
+    return select_plan(
+        get_plans(credentials, instance_id, _PHASE_PLANS[phase]),
+        get_distro(facts)
+    )
+
+
+def _get_wait(expected_duration, checks):
+    """Returns whole seconds to wait before the check after checks checks."""
+    backoff = Backoff(expected_duration, min_delay=_MIN_WAIT, max_delay=_MAX_WAIT)
+    backoff.attempt = checks
+
+    return max(_MIN_WAIT, int(math.ceil(backoff.next_delay())))
+
+
+def _finish(state, status):
+    state.update(status=status, done=True, wait_seconds=0)
+
+    return state
+
+
+def _install_prebuilt_profile(state, credentials):
+    """Returns True if the registry had a profile for the instance's kernel."""
+    from ssm_acquire.profile_registry import ProfileRegistry
+
+    kernel_release = state['facts'].get('kernel_release')
+
+    if kernel_release is None:
+        return False
+
+    registry = ProfileRegistry(credentials, get_asset_bucket())
+
+    return registry.install(kernel_release, state['instance_id'])
+
+
+def submit(ssm_client, credentials, phase, instance_id, facts=None):
+    """
+    Sends the plan of the phase to the instance.  Returns the state to
+    check the command with.
+
+    Nothing is sent, and the state is already done, if the registry has a
+    prebuilt profile for a 'build' or the capture of a 'dump' does not fit
+    on the instance's disk.
+    """
+    state = {
+        'phase': phase,
+        'instance_id': instance_id,
+        'facts': facts or {},
+        'command_id': None,
+        'status': 'Pending',
+        'done': False,
+        'progress': None,
+        'checks': 0
+    }
+
+    if phase == 'dump' and not capture_fits(state['facts']):
+        logger.error('The capture of instance {} does not fit in its home '
+            'directory.  Use the stream phase instead.'.format(instance_id))
+        return _finish(state, 'InsufficientDisk')
+
+    if phase == 'build' and _install_prebuilt_profile(state, credentials):
+        logger.info('Installed a prebuilt profile for instance {}.'.format(
+            instance_id))
+        return _finish(state, 'Success')
+
+    plan = _get_plan(phase, instance_id, credentials, state['facts'])
+
+    state.update(
+        command_id=submit_command(
+            ssm_client,
+            plan['commands'],
+            instance_id,
+            timeout=plan.get('timeout')
+        ),
+        submitted_at=time.time(),
+        timeout=plan.get('timeout'),
+        expected_duration=plan.get('expected_duration'),
+        wait_seconds=_get_wait(plan.get('expected_duration'), 0)
+    )
+
+    logger.info('Submitted the {} phase to instance {} as command {}.'.format(
+        phase,
+        instance_id,
+        state['command_id']
+    ))
+
+    return state
+
+
+def _expired(state):
+    if not state.get('timeout'):
+        return False
+
+    return time.time() > \
+        state['submitted_at'] + state['timeout'] + _REGISTRATION_GRACE
+
+
+def _on_success(state, invocation, credentials):
+    """Keeps what later phases need from a successful step."""
+    if state['phase'] == 'facts':
+        state['facts'] = parse_facts(invocation['StandardOutputContent'])
+    elif state['phase'] == 'build' and \
+            state['facts'].get('kernel_release') is not None:
+        from ssm_acquire.profile_registry import ProfileRegistry
+
+        ProfileRegistry(credentials, get_asset_bucket()).publish(
+            state['facts']['kernel_release'],
+            state['instance_id']
+        )
+    elif state['phase'] == 'interrogate':
+        from ssm_acquire.results import update_results
+
+        update_results(state['instance_id'], credentials)
+
+
+def check(ssm_client, state, credentials=None):
+    """
+    Reads the command of a submitted state once.  Returns the state with
+    its status, progress and the wait before the next check.
+
+    A command that outlives its timeout, e.g. because the instance stopped
+    reporting, is cancelled.  credentials are only needed to publish the
+    profile of a successful 'build' and the results of a successful
+    'interrogate'.
+    """
+    state = dict(state)
+
+    if state.get('done'):
+        return state
+
+    if not state.get('command_id'):
+        raise StepError('The state of the {} phase has no command id.'.format(
+            state.get('phase')))
+
+    state['checks'] = state.get('checks', 0) + 1
+
+    invocation = check_command(
+        ssm_client,
+        state['command_id'],
+        state['instance_id']
+    )
+
+    if invocation is not None:
+        state['status'] = invocation['Status']
+
+        progress = parse_progress(invocation.get('StandardOutputContent') or '')
+
+        if progress is not None:
+            state['progress'] = str(progress)
+
+        if invocation['Status'] in FINAL_STATUSES:
+            if invocation['Status'] == 'Success':
+                _on_success(state, invocation, credentials)
+
+            return _finish(state, invocation['Status'])
+
+    if not state.get('cancelled') and _expired(state):
+        logger.warning('The {} phase exceeded its timeout of {} seconds on '
+            'instance {}.  Cancelling.'.format(
+                state['phase'],
+                state['timeout'],
+                state['instance_id']
+            ))
+
+        cancel_command(ssm_client, state['command_id'], [state['instance_id']])
+        state['cancelled'] = True
+
+    if state.get('cancelled'):
+        state['wait_seconds'] = _MIN_WAIT
+    else:
+        state['wait_seconds'] = _get_wait(
+            state.get('expected_duration'),
+            state['checks']
+        )
+
+    return state
@@ -0,0 +1,249 @@
+"""
+Spans for the phases of a run, written to --metrics_out.
+
+A span records a phase of the run: its name, its parent, when it started
+and how long it took, its attributes, the bytes it moved and the AWS API
+calls made while it was the current span.  API calls are counted by a
+botocore hook on every client passed to instrument(), so call sites do not
+count them by hand.
+
+Tracing is off unless enable() is called, and spans then cost a function
+call.  Finished spans are written as JSON lines as they end, or as one JSON
+list when the run ends if the file name ends in .json.
+"""
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+from contextlib import contextmanager
+
+
+logger = logging.getLogger(__name__)
+
+_tracer = None
+
+
+# The span that new spans are children of, per thread and per asyncio task.
+_current = contextvars.ContextVar('ssm_acquire_span', default=None)
+
+
+class Span(object):
+    def __init__(self, tracer, name, parent, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent is not None else None
+        self.attributes = dict(attributes)
+        self.bytes = 0
+        self.api_calls = {}
+        self.status = 'ok'
+        self.error = None
+        self.start = time.time()
+        self.duration_ms = None
+        self.lock = threading.Lock()
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add_bytes(self, count):
+        with self.lock:
+            self.bytes += count
+
+    def count_call(self, operation):
+        with self.lock:
+            self.api_calls[operation] = self.api_calls.get(operation, 0) + 1
+
+    def end(self, error=None):
+        self.duration_ms = round((time.time() - self.start) * 1000.0, 3)
+
+        if error is not None:
+            self.status = 'error'
+            self.error = '{}: {}'.format(type(error).__name__, error)
+
+        self.tracer.record(self)
+
+    def to_dict(self):
+        return {
+            'trace_id': self.tracer.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': self.start,
+            'duration_ms': self.duration_ms,
+            'status': self.status,
+            'error': self.error,
+            'attributes': self.attributes,
+            'bytes': self.bytes,
+            'api_calls': self.api_calls
+        }
+
+
+class _NoSpan(object):
+    """The span of a run without tracing; every call is a no-op."""
+    def set(self, **attributes):
+        pass
+
+    def add_bytes(self, count):
+        pass
+
+    def count_call(self, operation):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+class Tracer(object):
+    def __init__(self, path):
+        self.path = path
+        self.trace_id = uuid.uuid4().hex
+        self.as_list = path.endswith('.json')
+        self.spans = []
+        self.lock = threading.Lock()
+        self.root = None
+
+        if not self.as_list:
+            # Truncates the file of a previous run.
+            open(path, 'w').close()
+
+    def record(self, span):
+        with self.lock:
+            if self.as_list:
+                self.spans.append(span.to_dict())
+                return
+
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(span.to_dict(), sort_keys=True) + '\n')
+
+    def close(self):
+        if self.as_list:
+            with open(self.path, 'w') as f:
+                json.dump(self.spans, f, indent=2, sort_keys=True)
+
+
+def _count_api_call(model=None, **kwargs):
+    """botocore before-call hook: counts the call on the current span."""
+    if model is not None:
+        current_span().count_call('{}.{}'.format(
+            model.service_model.service_name,
+            model.name
+        ))
+
+
+def instrument(client):
+    """Counts the API calls of a boto3 client if tracing is on."""
+    if _tracer is not None:
+        client.meta.events.register_first('before-call.*.*', _count_api_call)
+
+    return client
+
+
+def enable(path, **attributes):
+    """
+    Starts tracing the run to path.  The attributes are set on the root
+    span, which ends with finish().
+    """
+    global _tracer
+
+    _tracer = Tracer(os.path.expanduser(path))
+    _tracer.root = Span(_tracer, 'run', None, attributes)
+
+    return _tracer
+
+
+def finish(error=None):
+    """Ends the root span and writes the spans of the run."""
+    global _tracer
+
+    if _tracer is None:
+        return
+
+    _tracer.root.end(error)
+    _tracer.close()
+
+    logger.info('Wrote the spans of the run to {}.'.format(_tracer.path))
+
+    _tracer = None
+
+
+def current_span():
+    """Returns the current span, or a no-op span if tracing is off."""
+    if _tracer is None:
+        return _NO_SPAN
+
+    return _current.get() or _tracer.root
+
+
+@contextmanager
+def span(name, **attributes):
+    """Runs the body of the with statement in a new child span."""
+    if _tracer is None:
+        yield _NO_SPAN
+        return
+
+    new_span = Span(_tracer, name, current_span(), attributes)
+    token = _current.set(new_span)
+
+    try:
+        yield new_span
+    except BaseException as e:
+        new_span.end(e)
+        raise
+    else:
+        new_span.end()
+    finally:
+        _current.reset(token)
+
+
+def add_bytes(count):
+    """Adds to the bytes moved by the current span."""
+    current_span().add_bytes(count)
+
+
+def traced(name):
+    """Decorates a function or coroutine function to run in a span."""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def bind(func):
+    """
+    Returns func bound to the current span, for running it on another
+    thread, e.g. with run_in_executor, so that its spans nest correctly.
+    """
+    if _tracer is None:
+        return func
+
+    parent = current_span()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        token = _current.set(parent)
+
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _current.reset(token)
+
+    return wrapper
@@ -0,0 +1,405 @@
+"""
+Long-running worker that acquires the instances named on a queue.
+
+Messages are instance ids, or GuardDuty findings as EventBridge delivers
+them to SQS.  A finding for an instance that was handled less than
+worker_dedupe_window seconds ago, or is still being handled, is dropped, so
+a burst of findings for one host captures it once.  At most
+worker_concurrency instances are handled at a time, and at most
+worker_account_concurrency of them per AWS account, so a burst does not
+overwhelm SSM.  Jobs waiting only for their account's limit do not stop the
+worker from receiving, so a burst from one account does not hold back the
+others; at most worker_max_pending jobs wait at a time.  Every instance
+runs the modes of the worker through ssm_acquire.scheduler on a pool of
+threads.
+
+Messages stay on the queue until their instance is done, and their
+visibility timeout is extended while they wait or run.  The local queue
+reads messages from a file, one per line, as they are appended, and stands
+in for SQS when testing.
+"""
+import json
+import logging
+import os
+import time
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from ssm_acquire.config import config_manager
+
+
+config = config_manager
+logger = logging.getLogger(__name__)
+
+# Account of messages that do not name one.
+DEFAULT_ACCOUNT = 'default'
+
+# SQS returns at most 10 messages per receive and long-polls for at most 20
+# seconds.
+_MAX_RECEIVE = 10
+_LONG_POLL = 20
+
+# Wait for new messages this long while instances are being handled, so
+# that finished ones are noticed soon.
+_SHORT_POLL = 1
+
+
+def _get_int_setting(key, default):
+    return int(config(key, namespace='ssm_acquire', default=str(default)))
+
+
+class QueueMessage(object):
+    def __init__(self, body, handle):
+        self.body = body
+        self.handle = handle
+
+
+class SQSQueue(object):
+    """An SQS queue.  Messages are deleted once their instance is done."""
+    def __init__(self, sqs_client, queue_url, visibility_timeout=300):
+        self.sqs_client = sqs_client
+        self.queue_url = queue_url
+        self.visibility_timeout = visibility_timeout
+
+    def receive(self, max_messages, wait_seconds):
+        response = self.sqs_client.receive_message(
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=max(1, min(max_messages, _MAX_RECEIVE)),
+            WaitTimeSeconds=wait_seconds,
+            VisibilityTimeout=self.visibility_timeout
+        )
+
+        return [
+            QueueMessage(message['Body'], message['ReceiptHandle'])
+            for message in response.get('Messages', [])
+        ]
+
+    def delete(self, message):
+        self.sqs_client.delete_message(
+            QueueUrl=self.queue_url,
+            ReceiptHandle=message.handle
+        )
+
+    def extend(self, messages):
+        """Keeps messages that are still being handled invisible."""
+        for start in range(0, len(messages), _MAX_RECEIVE):
+            self.sqs_client.change_message_visibility_batch(
+                QueueUrl=self.queue_url,
+                Entries=[
+                    {
+                        'Id': str(index),
+                        'ReceiptHandle': message.handle,
+                        'VisibilityTimeout': self.visibility_timeout
+                    }
+                    for index, message in enumerate(
+                        messages[start:start + _MAX_RECEIVE]
+                    )
+                ]
+            )
+
+
+class LocalQueue(object):
+    """
+    A queue in memory, or in a file that messages are appended to, one per
+    line.  Lines that were read are not read again.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.offset = 0
+        self.messages = deque()
+        self.count = 0
+
+    def put(self, body):
+        self.count += 1
+        self.messages.append(QueueMessage(body, self.count))
+
+    def _read_file(self):
+        if self.path is None or not os.path.isfile(self.path):
+            return
+
+        with open(self.path) as f:
+            f.seek(self.offset)
+
+            for line in iter(f.readline, ''):
+                # A line that is still being written is read next time.
+                if not line.endswith('\n'):
+                    break
+
+                self.offset = f.tell()
+
+                if line.strip() and not line.startswith('#'):
+                    self.put(line.strip())
+
+    def receive(self, max_messages, wait_seconds):
+        self._read_file()
+
+        if not self.messages:
+            time.sleep(min(wait_seconds, _SHORT_POLL))
+            self._read_file()
+
+        return [
+            self.messages.popleft()
+            for _ in range(min(max_messages, len(self.messages)))
+        ]
+
+    def delete(self, message):
+        pass
+
+    def extend(self, messages):
+        pass
+
+
+class Job(object):
+    """One instance to handle, and the messages that asked for it."""
+    def __init__(self, instance_id, account_id, region, message):
+        self.instance_id = instance_id
+        self.account_id = account_id
+        self.region = region
+        self.messages = [message]
+
+
+def parse_message(body):
+    """
+    Returns the instance id, account id and region a message asks for.  The
+    body is an instance id, a JSON object with instance_id and optionally
+    account_id and region, or a GuardDuty finding.  The account and region
+    are None if the message does not name them.
+
+    Raises ValueError if the message names no instance.
+    """
+    body = body.strip()
+
+    if body.startswith('i-'):
+        return body, None, None
+
+    try:
+        message = json.loads(body)
+    except ValueError:
+        raise ValueError('Not an instance id or JSON: {}'.format(body[:100]))
+
+    # EventBridge wraps the finding in an event.
+    finding = message.get('detail', message)
+
+    instance_id = message.get('instance_id') or \
+        finding.get('resource', {}).get('instanceDetails', {}).get('instanceId')
+
+    if not instance_id:
+        raise ValueError('The message names no instance: {}'.format(body[:100]))
+
+    account_id = message.get('account_id') or finding.get('accountId') or \
+        message.get('account')
+
+    region = message.get('region') or finding.get('region')
+
+    return instance_id, account_id, region
+
+
+class Worker(object):
+    """
+    Hands the instances named on a queue to run_job, which is called with a
+    Job on a pool of threads and returns the status of each mode.
+    """
+    def __init__(
+        self,
+        queue,
+        run_job,
+        region,
+        concurrency=None,
+        account_concurrency=None,
+        dedupe_window=None
+    ):
+        self.queue = queue
+        self.run_job = run_job
+        self.region = region
+        self.concurrency = concurrency or \
+            _get_int_setting('worker_concurrency', 10)
+        self.account_concurrency = account_concurrency or \
+            _get_int_setting('worker_account_concurrency', 3)
+        self.dedupe_window = dedupe_window if dedupe_window is not None \
+            else _get_int_setting('worker_dedupe_window', 3600)
+        # Waiting jobs only cost memory and visibility extensions.
+        self.max_pending = _get_int_setting('worker_max_pending', 1000)
+
+        # Jobs waiting for a slot, in the order they arrived.
+        self.pending = []
+        # Running jobs by future.
+        self.running = {}
+        # When each instance was last accepted.
+        self.accepted = {}
+        self.results = {}
+        self.extended_at = time.time()
+
+    def _find_job(self, instance_id):
+        for job in self.pending + list(self.running.values()):
+            if job.instance_id == instance_id:
+                return job
+
+    def _accept(self, message):
+        try:
+            instance_id, account_id, region = parse_message(message.body)
+        except ValueError as e:
+            logger.warning('Dropping message: {}'.format(e))
+            self.queue.delete(message)
+            return
+
+        job = self._find_job(instance_id)
+
+        if job is not None:
+            # Deleted with the job's own message once it is done.
+            logger.info('Instance {} is already queued.'.format(instance_id))
+            job.messages.append(message)
+            return
+
+        last = self.accepted.get(instance_id)
+
+        if last is not None and time.time() - last < self.dedupe_window:
+            logger.info('Instance {} was handled {:.0f}s ago.  Dropping the '
+                'duplicate.'.format(instance_id, time.time() - last))
+            self.queue.delete(message)
+            return
+
+        self.accepted[instance_id] = time.time()
+        self.pending.append(Job(
+            instance_id,
+            account_id or DEFAULT_ACCOUNT,
+            region or self.region,
+            message
+        ))
+
+    def _running_in_account(self, account_id):
+        return sum(
+            1 for job in self.running.values()
+            if job.account_id == account_id
+        )
+
+    def _count_startable(self):
+        """
+        Returns how many pending jobs could start once a slot is free, i.e.
+        are not held back by the limit of their account.
+        """
+        pending = {}
+
+        for job in self.pending:
+            pending[job.account_id] = pending.get(job.account_id, 0) + 1
+
+        return sum(
+            min(
+                count,
+                max(
+                    0,
+                    self.account_concurrency - self._running_in_account(account_id)
+                )
+            )
+            for account_id, count in pending.items()
+        )
+
+    def _dispatch(self, executor):
+        """Starts the pending jobs that fit within the limits."""
+        for job in list(self.pending):
+            if len(self.running) >= self.concurrency:
+                return
+
+            if self._running_in_account(job.account_id) >= \
+                    self.account_concurrency:
+                continue
+
+            logger.info('Handling instance {} of account {}.'.format(
+                job.instance_id,
+                job.account_id
+            ))
+
+            self.pending.remove(job)
+            self.running[executor.submit(self.run_job, job)] = job
+
+    def _reap(self):
+        """Deletes the messages of the jobs that are done."""
+        for future in [future for future in self.running if future.done()]:
+            job = self.running.pop(future)
+
+            try:
+                statuses = future.result()
+            except Exception as e:
+                logger.error('Instance {} failed: {}'.format(job.instance_id, e))
+                statuses = {'worker': 'Failed'}
+
+            self.results[job.instance_id] = statuses
+
+            if any(status != 'Success' for status in statuses.values()):
+                # A later finding may try again.
+                self.accepted.pop(job.instance_id, None)
+
+            print('{} {}'.format(
+                job.instance_id,
+                '  '.join(
+                    '{}: {}'.format(mode, status)
+                    for mode, status in sorted(statuses.items())
+                )
+            ))
+
+            for message in job.messages:
+                self.queue.delete(message)
+
+    def _extend(self):
+        """Extends the visibility of messages halfway through the timeout."""
+        timeout = getattr(self.queue, 'visibility_timeout', None)
+
+        if not timeout or time.time() - self.extended_at < timeout / 2.0:
+            return
+
+        self.queue.extend([
+            message
+            for job in self.pending + list(self.running.values())
+            for message in job.messages
+        ])
+        self.extended_at = time.time()
+
+    def _poll(self, executor):
+        self._reap()
+
+        busy = bool(self.pending or self.running)
+
+        # Holding a few more jobs than slots lets a free slot start at once.
+        # Jobs blocked by their account's limit do not take up room, so
+        # other accounts are still received during a burst from one.
+        room = min(
+            2 * self.concurrency - self._count_startable() - len(self.running),
+            self.max_pending - len(self.pending)
+        )
+
+        received = []
+
+        if room > 0:
+            received = self.queue.receive(
+                room,
+                _SHORT_POLL if busy else _LONG_POLL
+            )
+        else:
+            time.sleep(_SHORT_POLL)
+
+        for message in received:
+            self._accept(message)
+
+        self._dispatch(executor)
+        self._extend()
+
+        return bool(received or self.pending or self.running)
+
+    def run(self, exit_when_idle=False):
+        """
+        Handles instances until interrupted, or until the queue is empty and
+        every job is done if exit_when_idle is set.  Returns the status of
+        each mode for every instance handled.
+        """
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            try:
+                while self._poll(executor) or not exit_when_idle:
+                    pass
+            except KeyboardInterrupt:
+                logger.warning('Interrupted.  Waiting for {} running '
+                    'instances; {} queued instances stay on the '
+                    'queue.'.format(len(self.running), len(self.pending)))
+
+        self._reap()
+
+        return self.results
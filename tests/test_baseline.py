@@ -0,0 +1,119 @@
+"""Tests for the fleet baselines and outliers of ssm_acquire.baseline."""
+import json
+
+from ssm_acquire import baseline
+from ssm_acquire import results
+
+
+def _build_host(tmpdir, instance_id, processes):
+    """Builds the results database of a host that runs the processes."""
+    rekall_path = str(tmpdir.join('{}-psaux.json'.format(instance_id)))
+
+    with open(rekall_path, 'w') as f:
+        json.dump(
+            [['r', {'pid': pid, 'comm': name}]
+                for pid, name in enumerate(processes, 1)],
+            f
+        )
+
+    path = str(tmpdir.join('{}.sqlite'.format(instance_id)))
+    store = results.ResultsStore(path, instance_id)
+    store.add_rekall_output('psaux', rekall_path)
+    store.close()
+
+    return instance_id, path
+
+
+def test_hash_row_is_stable_64_bits():
+    row_hash = baseline.hash_row('process', ('sshd',))
+
+    assert row_hash == baseline.hash_row('process', ('sshd',))
+    assert 0 <= row_hash < 2 ** 64
+
+
+def test_hash_row_depends_on_feature_and_row():
+    hashes = set([
+        baseline.hash_row('process', ('sshd',)),
+        baseline.hash_row('process', ('nginx',)),
+        baseline.hash_row('kernel_module', ('sshd',)),
+        baseline.hash_row('listening_port', ('sshd', 22)),
+        baseline.hash_row('listening_port', ('sshd', 2222))
+    ])
+
+    assert len(hashes) == 5
+
+
+def test_baseline_counts_hosts_per_row():
+    group = baseline.Baseline('web')
+    group.add_host([1, 2])
+    group.add_host([1])
+    group.add_host(iter([1, 3]))
+
+    assert group.hosts == 3
+    assert group.count(1) == 3
+    assert group.count(2) == 1
+    assert group.count(4) == 0
+
+
+def test_rare_limit_is_at_least_one_host():
+    group = baseline.Baseline('web')
+
+    for _ in range(10):
+        group.add_host([])
+
+    assert group.get_rare_limit(0.05) == 1
+    assert group.get_rare_limit(0.2) == 2
+
+
+def test_find_outliers(tmpdir):
+    paths = [
+        _build_host(tmpdir, 'i-0000000000000000{}'.format(index), processes)
+        for index, processes in enumerate([
+            ['systemd', 'sshd'],
+            ['systemd', 'sshd'],
+            ['systemd', 'sshd', 'nc'],
+            ['systemd', 'sshd']
+        ])
+    ]
+
+    outliers = list(baseline.find_outliers(
+        paths,
+        {},
+        max_fraction=0.25,
+        min_group=3
+    ))
+
+    assert outliers == [{
+        'instance_id': 'i-00000000000000002',
+        'group': baseline.UNGROUPED,
+        'feature': 'process',
+        'row': ['nc'],
+        'hosts': 1,
+        'group_hosts': 4
+    }]
+
+
+def test_find_outliers_compares_within_groups(tmpdir):
+    paths = [
+        _build_host(tmpdir, 'i-0000000000000000{}'.format(index), processes)
+        for index, processes in enumerate([
+            ['nginx'],
+            ['nginx'],
+            ['nginx'],
+            ['postgres'],
+            ['postgres']
+        ])
+    ]
+    groups = dict(
+        (instance_id, 'web' if index < 3 else 'db')
+        for index, (instance_id, _) in enumerate(paths)
+    )
+
+    # The db group is too small to have outliers, and nginx is common
+    # within the web group however rare it is in the fleet.
+    assert list(baseline.find_outliers(
+        paths,
+        groups,
+        max_fraction=0.25,
+        min_group=3
+    )) == []
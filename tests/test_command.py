@@ -0,0 +1,210 @@
+"""Tests for the backoff and the fleet waiter of ssm_acquire.command."""
+import random
+import time
+
+import boto3
+import pytest
+
+from botocore.stub import Stubber
+
+from ssm_acquire import command
+
+
+COMMAND_ID = '0b1c2d3e-4f50-6172-8394-a5b6c7d8e9f0'
+INSTANCE_A = 'i-0000000000000000a'
+INSTANCE_B = 'i-0000000000000000b'
+
+
+def _get_ssm_client():
+    return boto3.client(
+        'ssm',
+        region_name='us-east-1',
+        aws_access_key_id='testing',
+        aws_secret_access_key='testing'
+    )
+
+
+def _invocation(instance_id, status):
+    return {
+        'CommandId': COMMAND_ID,
+        'InstanceId': instance_id,
+        'Status': status
+    }
+
+
+def test_backoff_doubles_up_to_max_delay():
+    backoff = command.Backoff(min_delay=1, max_delay=8)
+
+    # Jitter picks a delay between half the step and the step itself.
+    for step in (1, 2, 4, 8, 8, 8):
+        delay = backoff.next_delay()
+        assert step / 2.0 <= delay <= step
+
+
+def test_backoff_jitter_spreads_delays():
+    random.seed(1)
+
+    delays = set(
+        command.Backoff(min_delay=1, max_delay=1).next_delay()
+        for _ in range(20)
+    )
+
+    assert len(delays) > 1
+
+
+def test_backoff_is_capped_by_expected_duration():
+    backoff = command.Backoff(expected_duration=20, min_delay=1, max_delay=30)
+
+    assert backoff.max_delay == 2
+
+    for _ in range(10):
+        assert backoff.next_delay() <= 2
+
+
+def test_backoff_throttled_and_reset():
+    backoff = command.Backoff(min_delay=1, max_delay=1000)
+
+    backoff.throttled()
+    assert 2 <= backoff.next_delay() <= 4
+
+    backoff.reset()
+    assert 0.5 <= backoff.next_delay() <= 1
+
+
+def test_backoff_exponent_does_not_overflow():
+    backoff = command.Backoff(min_delay=1, max_delay=30)
+    backoff.attempt = 10 ** 6
+
+    assert 15 <= backoff.next_delay() <= 30
+
+
+def test_deadline_clamps_delay():
+    deadline = command._Deadline(0.5)
+
+    assert not deadline.expired()
+    assert deadline.clamp(30) <= 0.5
+
+    deadline.expires_at = time.time() - 1
+
+    assert deadline.expired()
+    assert deadline.clamp(30) == 0
+
+
+def test_deadline_without_timeout_never_expires():
+    deadline = command._Deadline(None)
+
+    assert not deadline.expired()
+    assert deadline.clamp(30) == 30
+
+
+def test_fleet_waiter_collects_final_statuses():
+    ssm_client = _get_ssm_client()
+
+    with Stubber(ssm_client) as stubber:
+        stubber.add_response(
+            'list_command_invocations',
+            {
+                'CommandInvocations': [_invocation(INSTANCE_A, 'InProgress')]
+            },
+            {'CommandId': COMMAND_ID, 'Details': False}
+        )
+        stubber.add_response(
+            'list_command_invocations',
+            {
+                'CommandInvocations': [
+                    _invocation(INSTANCE_A, 'Success'),
+                    _invocation(INSTANCE_B, 'Failed')
+                ]
+            },
+            {'CommandId': COMMAND_ID, 'Details': False}
+        )
+
+        waiter = command.FleetCommandWaiter(
+            ssm_client,
+            {COMMAND_ID: [INSTANCE_A, INSTANCE_B]},
+            timeout=60
+        )
+
+        assert not waiter.poll()
+        assert waiter.poll()
+
+        stubber.assert_no_pending_responses()
+
+    assert waiter.statuses == {INSTANCE_A: 'Success', INSTANCE_B: 'Failed'}
+
+
+def test_fleet_waiter_retries_throttled_polls():
+    ssm_client = _get_ssm_client()
+
+    with Stubber(ssm_client) as stubber:
+        stubber.add_client_error(
+            'list_command_invocations',
+            service_error_code='ThrottlingException'
+        )
+        stubber.add_response(
+            'list_command_invocations',
+            {
+                'CommandInvocations': [_invocation(INSTANCE_A, 'Success')]
+            },
+            {'CommandId': COMMAND_ID, 'Details': False}
+        )
+
+        waiter = command.FleetCommandWaiter(
+            ssm_client,
+            {COMMAND_ID: [INSTANCE_A]},
+            timeout=60
+        )
+
+        assert not waiter.poll()
+        assert waiter.backoff.attempt == 2
+        assert waiter.poll()
+
+
+def test_fleet_waiter_cancels_at_the_deadline_and_gives_up():
+    ssm_client = _get_ssm_client()
+    running = {'CommandInvocations': [_invocation(INSTANCE_A, 'InProgress')]}
+
+    with Stubber(ssm_client) as stubber:
+        stubber.add_response('list_command_invocations', running)
+        stubber.add_response('cancel_command', {}, {'CommandId': COMMAND_ID})
+        stubber.add_response('list_command_invocations', running)
+
+        waiter = command.FleetCommandWaiter(ssm_client, {COMMAND_ID: [INSTANCE_A]})
+        waiter.deadline.expires_at = time.time() - 1
+
+        assert not waiter.poll()
+        assert waiter.cancelled
+
+        # SSM never reports the cancellation.
+        waiter.deadline.expires_at = time.time() - 1
+
+        assert waiter.poll()
+
+        stubber.assert_no_pending_responses()
+
+    assert waiter.statuses == {INSTANCE_A: 'TimedOut'}
+
+
+def test_fleet_waiter_defaults_its_timeout():
+    waiter = command.FleetCommandWaiter(
+        _get_ssm_client(),
+        {COMMAND_ID: [INSTANCE_A]}
+    )
+
+    assert waiter.timeout == command._DEFAULT_FLEET_TIMEOUT
+    assert waiter.deadline.expires_at is not None
+
+
+@pytest.mark.parametrize('status, finished', [
+    ('Pending', False),
+    ('InProgress', False),
+    ('Success', True),
+    ('Failed', True)
+])
+def test_is_batch_finished(status, finished):
+    statuses = {INSTANCE_A: 'Success', INSTANCE_B: status}
+
+    assert command._is_batch_finished(
+        [INSTANCE_A, INSTANCE_B],
+        statuses
+    ) == finished
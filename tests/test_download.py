@@ -0,0 +1,217 @@
+"""Tests for the ranged downloads of ssm_acquire.download."""
+import hashlib
+import io
+import os
+
+import boto3
+import pytest
+
+from botocore.exceptions import ClientError
+from botocore.response import StreamingBody
+from botocore.stub import Stubber
+
+from ssm_acquire import download
+
+
+BUCKET = 'asset-bucket'
+KEY = 'i-0000000000000000a/capture.aff4'
+DATA = b'0123456789'
+
+
+def _get_s3_client():
+    return boto3.client(
+        's3',
+        region_name='us-east-1',
+        aws_access_key_id='testing',
+        aws_secret_access_key='testing'
+    )
+
+
+def _etag(digest, parts=0):
+    return '"{}{}"'.format(digest, '-{}'.format(parts) if parts else '')
+
+
+def _s3_object(etag):
+    return {'Key': KEY, 'ETag': etag, 'Size': len(DATA)}
+
+
+def _add_range(stubber, etag, start, end):
+    chunk = DATA[start:end + 1]
+
+    stubber.add_response(
+        'get_object',
+        {'Body': StreamingBody(io.BytesIO(chunk), len(chunk))},
+        {
+            'Bucket': BUCKET,
+            'Key': KEY,
+            'Range': 'bytes={}-{}'.format(start, end),
+            'IfMatch': etag
+        }
+    )
+
+
+def _get_downloader(s3_client, chunk_size=4):
+    # One worker, so that the ranges are requested in the stubbed order.
+    return download.RangedDownloader(
+        s3_client,
+        BUCKET,
+        chunk_size=chunk_size,
+        max_concurrency=1
+    )
+
+
+def test_parse_etag():
+    assert download._parse_etag('"abc"') == ('abc', 0)
+    assert download._parse_etag('"abc-12"') == ('abc', 12)
+
+
+def test_download_in_ranges_and_skip_when_up_to_date(tmpdir):
+    destination = str(tmpdir.join('capture.aff4'))
+    etag = _etag(hashlib.md5(DATA).hexdigest())
+    s3_client = _get_s3_client()
+
+    with Stubber(s3_client) as stubber:
+        _add_range(stubber, etag, 0, 3)
+        _add_range(stubber, etag, 4, 7)
+        _add_range(stubber, etag, 8, 9)
+
+        downloader = _get_downloader(s3_client)
+
+        assert downloader.download(_s3_object(etag), destination)
+
+        stubber.assert_no_pending_responses()
+
+        # No calls are stubbed, so a second download would fail.
+        assert not downloader.download(_s3_object(etag), destination)
+
+    with open(destination, 'rb') as f:
+        assert f.read() == DATA
+
+    assert sorted(os.listdir(str(tmpdir))) == [
+        '.ssm_acquire_downloads.json',
+        'capture.aff4'
+    ]
+
+
+def test_download_resumes_after_a_failed_range(tmpdir):
+    destination = str(tmpdir.join('capture.aff4'))
+    etag = _etag(hashlib.md5(DATA).hexdigest())
+    s3_client = _get_s3_client()
+
+    with Stubber(s3_client) as stubber:
+        _add_range(stubber, etag, 0, 3)
+        stubber.add_client_error('get_object', service_error_code='SlowDown')
+        _add_range(stubber, etag, 8, 9)
+
+        with pytest.raises(ClientError):
+            _get_downloader(s3_client).download(_s3_object(etag), destination)
+
+        assert os.path.isfile(destination + '.part.log')
+        assert not os.path.exists(destination)
+
+        # Only the failed range is fetched again.
+        _add_range(stubber, etag, 4, 7)
+
+        assert _get_downloader(s3_client).download(
+            _s3_object(etag),
+            destination
+        )
+
+        stubber.assert_no_pending_responses()
+
+    with open(destination, 'rb') as f:
+        assert f.read() == DATA
+
+    assert not os.path.exists(destination + '.part.log')
+
+
+def test_download_restarts_for_another_version(tmpdir):
+    destination = str(tmpdir.join('capture.aff4'))
+    etag = _etag(hashlib.md5(DATA).hexdigest())
+    s3_client = _get_s3_client()
+
+    # A journal of another version of the object is discarded.
+    journal = download._Journal(destination + '.part.log', '"other"', 4)
+    journal.reset()
+    journal.record(0, hashlib.md5(b'xxxx').hexdigest())
+
+    with open(destination + '.part', 'wb') as f:
+        f.write(b'xxxx')
+
+    with Stubber(s3_client) as stubber:
+        _add_range(stubber, etag, 0, 3)
+        _add_range(stubber, etag, 4, 7)
+        _add_range(stubber, etag, 8, 9)
+
+        assert _get_downloader(s3_client).download(
+            _s3_object(etag),
+            destination
+        )
+
+    with open(destination, 'rb') as f:
+        assert f.read() == DATA
+
+
+def test_download_that_does_not_match_its_etag_is_removed(tmpdir):
+    destination = str(tmpdir.join('capture.aff4'))
+    etag = _etag(hashlib.md5(b'something else').hexdigest())
+    s3_client = _get_s3_client()
+
+    with Stubber(s3_client) as stubber:
+        _add_range(stubber, etag, 0, 3)
+        _add_range(stubber, etag, 4, 7)
+        _add_range(stubber, etag, 8, 9)
+
+        with pytest.raises(download.DownloadVerificationError):
+            _get_downloader(s3_client).download(_s3_object(etag), destination)
+
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_multipart_download_is_checked_by_part(tmpdir):
+    destination = str(tmpdir.join('capture.aff4'))
+    parts = [DATA[:5], DATA[5:]]
+    etag = _etag(
+        hashlib.md5(
+            b''.join(hashlib.md5(part).digest() for part in parts)
+        ).hexdigest(),
+        len(parts)
+    )
+    s3_client = _get_s3_client()
+
+    with Stubber(s3_client) as stubber:
+        # The ranges are the parts, whatever the configured chunk size.
+        stubber.add_response(
+            'head_object',
+            {'ContentLength': 5},
+            {'Bucket': BUCKET, 'Key': KEY, 'PartNumber': 1}
+        )
+        _add_range(stubber, etag, 0, 4)
+        _add_range(stubber, etag, 5, 9)
+
+        assert _get_downloader(s3_client, chunk_size=8).download(
+            _s3_object(etag),
+            destination
+        )
+
+        stubber.assert_no_pending_responses()
+
+    with open(destination, 'rb') as f:
+        assert f.read() == DATA
+
+
+def test_etag_that_is_not_an_md5_is_not_checked(tmpdir):
+    destination = str(tmpdir.join('capture.aff4'))
+    etag = _etag('kms')
+    s3_client = _get_s3_client()
+
+    with Stubber(s3_client) as stubber:
+        _add_range(stubber, etag, 0, 9)
+
+        assert _get_downloader(s3_client, chunk_size=16).download(
+            _s3_object(etag),
+            destination
+        )
+
+    with open(destination, 'rb') as f:
+        assert f.read() == DATA
@@ -0,0 +1,162 @@
+"""Tests for the instance facts of ssm_acquire.facts."""
+import boto3
+import pytest
+
+from botocore.stub import ANY
+from botocore.stub import Stubber
+
+from ssm_acquire import facts
+
+
+COMMAND_ID = '0b1c2d3e-4f50-6172-8394-a5b6c7d8e9f0'
+INSTANCE_A = 'i-0000000000000000a'
+INSTANCE_B = 'i-0000000000000000b'
+
+PROBE_OUTPUT = '\n'.join([
+    'distro_id=ubuntu',
+    'distro_version=18.04',
+    'kernel_release=4.15.0-1044-aws',
+    'arch=x86_64',
+    'mem_total_kb=2048',
+    'home_free_kb=4096'
+])
+
+
+@pytest.fixture(autouse=True)
+def empty_cache(monkeypatch):
+    monkeypatch.setattr(facts, '_facts', {})
+
+
+def _get_ssm_client():
+    return boto3.client(
+        'ssm',
+        region_name='us-east-1',
+        aws_access_key_id='testing',
+        aws_secret_access_key='testing'
+    )
+
+
+def test_parse_facts():
+    assert facts.parse_facts(PROBE_OUTPUT) == {
+        'distro_id': 'ubuntu',
+        'distro_version': '18.04',
+        'distro': 'ubuntu18',
+        'kernel_release': '4.15.0-1044-aws',
+        'arch': 'x86_64',
+        'mem_total_bytes': 2048 * 1024,
+        'home_free_bytes': 4096 * 1024
+    }
+
+
+def test_parse_facts_skips_empty_values():
+    result = facts.parse_facts(
+        'distro_id=amzn\ndistro_version=2\nhome_free_kb=\ngarbage\n'
+    )
+
+    assert result == {
+        'distro_id': 'amzn',
+        'distro_version': '2',
+        'distro': 'amzn2'
+    }
+
+
+def test_get_distro_defaults_without_facts():
+    assert facts.get_distro({}) == facts.DEFAULT_DISTRO
+
+
+def test_capture_fits():
+    assert facts.capture_fits({})
+    assert facts.capture_fits({'mem_total_bytes': 1, 'home_free_bytes': 1})
+    assert not facts.capture_fits({'mem_total_bytes': 2, 'home_free_bytes': 1})
+
+
+def test_lookup_returns_facts_within_the_ttl(monkeypatch):
+    monkeypatch.setenv('SSM_ACQUIRE_FACTS_TTL', '60')
+    monkeypatch.setattr(facts.time, 'time', lambda: 1000.0)
+
+    facts._remember(INSTANCE_A, {'distro': 'amzn2'})
+
+    monkeypatch.setattr(facts.time, 'time', lambda: 1059.0)
+
+    assert facts._lookup(INSTANCE_A) == {'distro': 'amzn2'}
+
+
+def test_lookup_expires_old_facts(monkeypatch):
+    monkeypatch.setenv('SSM_ACQUIRE_FACTS_TTL', '60')
+    monkeypatch.setattr(facts.time, 'time', lambda: 1000.0)
+
+    facts._remember(INSTANCE_A, {'distro': 'amzn2'})
+
+    monkeypatch.setattr(facts.time, 'time', lambda: 1060.0)
+
+    assert facts._lookup(INSTANCE_A) is None
+    assert INSTANCE_A not in facts._facts
+
+
+def test_failed_probe_is_not_remembered():
+    assert facts._remember(INSTANCE_A, {}) == {}
+    assert facts._lookup(INSTANCE_A) is None
+
+
+def test_get_fleet_facts_probes_only_unknown_instances():
+    facts._remember(INSTANCE_A, {'distro': 'amzn2'})
+
+    ssm_client = _get_ssm_client()
+
+    with Stubber(ssm_client) as stubber:
+        stubber.add_response(
+            'send_command',
+            {'Command': {'CommandId': COMMAND_ID}},
+            {
+                'InstanceIds': [INSTANCE_B],
+                'DocumentName': 'AWS-RunShellScript',
+                'Parameters': ANY,
+                'Comment': ANY
+            }
+        )
+        stubber.add_response(
+            'list_command_invocations',
+            {
+                'CommandInvocations': [
+                    {
+                        'CommandId': COMMAND_ID,
+                        'InstanceId': INSTANCE_B,
+                        'Status': 'Success',
+                        'CommandPlugins': [{'Output': PROBE_OUTPUT}]
+                    }
+                ]
+            },
+            {'CommandId': COMMAND_ID, 'Details': True}
+        )
+
+        fleet_facts = facts.get_fleet_facts(
+            ssm_client,
+            [INSTANCE_A, INSTANCE_B]
+        )
+
+        stubber.assert_no_pending_responses()
+
+    assert fleet_facts[INSTANCE_A] == {'distro': 'amzn2'}
+    assert fleet_facts[INSTANCE_B]['distro'] == 'ubuntu18'
+    assert facts._lookup(INSTANCE_B) == fleet_facts[INSTANCE_B]
+
+
+def test_group_by_distro():
+    fleet_facts = {
+        INSTANCE_A: {'distro': 'ubuntu18'},
+        INSTANCE_B: {}
+    }
+
+    assert facts.group_by_distro([INSTANCE_A, INSTANCE_B], fleet_facts) == {
+        'ubuntu18': [INSTANCE_A],
+        facts.DEFAULT_DISTRO: [INSTANCE_B]
+    }
+
+
+def test_select_plan_raises_for_unknown_distro():
+    plans = {'name': 'memdump', 'distros': {'amzn2': {'commands': []}}}
+
+    assert facts.select_plan(plans, 'amzn2') == {'commands': []}
+
+    with pytest.raises(facts.UnsupportedInstanceError):
+        facts.select_plan(plans, 'centos7')
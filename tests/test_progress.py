@@ -0,0 +1,70 @@
+"""Tests for the progress markers of ssm_acquire.progress."""
+from ssm_acquire import progress
+
+
+def test_parse_progress_without_markers():
+    assert progress.parse_progress('') is None
+    assert progress.parse_progress('Dumping memory\nDone\n') is None
+
+
+def test_parse_progress_returns_the_last_marker_and_its_rate():
+    output = '\n'.join([
+        'Starting linpmem',
+        '@progress dump 10 100 1000',
+        'some output of the tool',
+        '@progress dump 20 300 1000',
+        '@progress dump 30 500 1000'
+    ])
+
+    result = progress.parse_progress(output)
+
+    assert result.phase == 'dump'
+    assert result.elapsed == 30
+    assert result.done == 500
+    assert result.total == 1000
+    assert result.percent == 50
+    # 400 bytes in the 20 seconds since the first marker of the phase.
+    assert result.rate == 20.0
+    assert result.eta == 25.0
+
+
+def test_parse_progress_measures_the_rate_of_the_last_phase():
+    output = '\n'.join([
+        '@progress dump 10 1000 1000',
+        '@progress upload 12 0 1000',
+        '@progress upload 22 100 1000'
+    ])
+
+    result = progress.parse_progress(output)
+
+    assert result.phase == 'upload'
+    assert result.rate == 10.0
+
+
+def test_parse_progress_skips_malformed_markers():
+    output = '\n'.join([
+        '@progress dump 10 100 1000',
+        '@progress dump ten 200 1000',
+        '@progress dump 20 300',
+        '@progress dump 20 300 1000 extra'
+    ])
+
+    result = progress.parse_progress(output)
+
+    assert result.done == 100
+    assert result.rate is None
+    assert result.eta is None
+
+
+def test_parse_progress_clamps_done_to_total():
+    result = progress.parse_progress('@progress dump 5 1200 1000')
+
+    assert result.done == 1000
+    assert result.percent == 100
+
+
+def test_progress_str():
+    result = progress.Progress('dump', 60, 512 * 1024, 1024 * 1024, 1024)
+
+    assert str(result) == 'dump: 512.0 KiB of 1.0 MiB (50%) at 1.0 KiB/s, ' \
+        'ETA 8m 32s'
@@ -0,0 +1,133 @@
+"""Tests for the osquery query packs of ssm_acquire.query_pack."""
+import json
+import os
+import shutil
+import subprocess
+
+import pytest
+
+from ssm_acquire import query_pack
+
+
+def _write_pack(tmpdir, queries, name='test'):
+    path = str(tmpdir.join('pack.yml'))
+
+    with open(path, 'w') as f:
+        json.dump({'name': name, 'queries': queries}, f)
+
+    return path
+
+
+def _osqueryi_output(*results):
+    """Prints results the way osqueryi --json does."""
+    lines = []
+
+    for rows in results:
+        lines.append('[')
+        lines.extend(
+            '  ' + json.dumps(row) + (',' if index < len(rows) - 1 else '')
+            for index, row in enumerate(rows)
+        )
+        lines.append(']')
+
+    return '\n'.join(lines) + '\n'
+
+
+def test_default_pack_is_valid():
+    pack = query_pack.load_query_pack(query_pack.get_default_pack_path())
+
+    assert pack['queries']
+    assert pack['manifest']['queries']
+
+
+def test_concurrent_queries_get_their_own_lane(tmpdir):
+    pack = query_pack.load_query_pack(_write_pack(tmpdir, {
+        'processes': {'query': 'SELECT pid, name FROM processes;'},
+        'interfaces': {
+            'query': 'SELECT interface, address FROM interface_addresses',
+            'table': 'interfaces',
+            'concurrent': True
+        },
+        'modules': {'query': 'SELECT name FROM kernel_modules'}
+    }))
+
+    assert [lane['names'] for lane in pack['lanes']] == [
+        ['processes', 'modules'],
+        ['interfaces']
+    ]
+
+    # Every query is preceded by its marker and ends with one semicolon.
+    assert pack['lanes'][0]['script'] == (
+        "SELECT 'processes' AS ssm_acquire_query;\n"
+        "SELECT pid, name FROM processes;\n"
+        "SELECT 'modules' AS ssm_acquire_query;\n"
+        "SELECT name FROM kernel_modules;\n"
+    )
+
+
+def test_pack_without_concurrent_queries_has_one_lane(tmpdir):
+    pack = query_pack.load_query_pack(_write_pack(tmpdir, {
+        'processes': {'query': 'SELECT pid FROM processes'}
+    }))
+
+    assert len(pack['lanes']) == 1
+
+
+@pytest.mark.parametrize('queries', [
+    {},
+    {'Bad-Name': {'query': 'SELECT 1'}},
+    {'manifest': {'query': 'SELECT 1'}},
+    {'empty': {'query': ' '}},
+    {'unknown_table': {'query': 'SELECT 1', 'table': 'nope'}},
+    {'unknown_column': {
+        'query': 'SELECT 1',
+        'table': 'sockets',
+        'columns': {'nope': 1}
+    }},
+    {'columns_without_table': {'query': 'SELECT 1', 'columns': {'pid': 1}}}
+])
+def test_invalid_packs_are_rejected(tmpdir, queries):
+    with pytest.raises(query_pack.QueryPackError):
+        query_pack.load_query_pack(_write_pack(tmpdir, queries))
+
+
+def test_missing_pack_is_rejected(tmpdir):
+    with pytest.raises(query_pack.QueryPackError):
+        query_pack.load_query_pack(str(tmpdir.join('missing.yml')))
+
+
+@pytest.mark.skipif(shutil.which('awk') is None, reason='needs awk')
+def test_split_cuts_the_output_into_one_document_per_query(tmpdir):
+    output = _osqueryi_output(
+        [{query_pack.MARKER_COLUMN: 'listening_ports'}],
+        [{'name': 'nc', 'port': '4444'}, {'name': 'sshd', 'port': '22'}],
+        [{query_pack.MARKER_COLUMN: 'kernel_modules'}],
+        [{'name': 'ext4'}]
+    )
+
+    awk_path = str(tmpdir.join('split.awk'))
+
+    with open(awk_path, 'w') as f:
+        f.write(query_pack._SPLIT_AWK)
+
+    output_dir = tmpdir.mkdir('output')
+
+    subprocess.run(
+        ['awk', '-v', 'dir={}'.format(output_dir), '-f', awk_path],
+        input=output.encode('utf-8'),
+        check=True
+    )
+
+    assert sorted(os.listdir(str(output_dir))) == [
+        'kernel_modules.json',
+        'listening_ports.json'
+    ]
+
+    with open(str(output_dir.join('listening_ports.json'))) as f:
+        assert json.load(f) == [
+            {'name': 'nc', 'port': '4444'},
+            {'name': 'sshd', 'port': '22'}
+        ]
+
+    with open(str(output_dir.join('kernel_modules.json'))) as f:
+        assert json.load(f) == [{'name': 'ext4'}]
@@ -0,0 +1,154 @@
+"""Tests for the results databases of ssm_acquire.results."""
+import io
+import json
+import os
+import sqlite3
+
+import pytest
+
+from ssm_acquire import results
+
+
+INSTANCE_ID = 'i-0000000000000000a'
+
+
+def _iter(text, chunk_size=4):
+    return list(results.iter_json_array(io.StringIO(text), chunk_size))
+
+
+def _write_json(path, document):
+    with open(path, 'w') as f:
+        json.dump(document, f)
+
+
+def _select(path, sql):
+    connection = sqlite3.connect(path)
+
+    try:
+        return connection.execute(sql).fetchall()
+    finally:
+        connection.close()
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 4, 64 * 1024])
+def test_iter_json_array_across_chunks(chunk_size):
+    document = [
+        12345678,
+        'a string with , and ] in it',
+        {'nested': [1, 2, {'deeper': None}]},
+        [],
+        -1.5e3,
+        True
+    ]
+
+    assert _iter(json.dumps(document), chunk_size) == document
+
+
+def test_iter_json_array_with_whitespace():
+    assert _iter('\n [\n 1 ,\n\t2\n ]\n') == [1, 2]
+
+
+def test_iter_json_array_empty():
+    assert _iter('[]') == []
+    assert _iter('') == []
+
+
+def test_iter_json_array_not_an_array():
+    with pytest.raises(ValueError):
+        _iter('{"a": 1}')
+
+
+def test_iter_json_array_truncated():
+    with pytest.raises(ValueError):
+        _iter('[1, 2, {"a": ')
+
+
+def test_iter_json_array_element_too_large(monkeypatch):
+    monkeypatch.setattr(results, '_MAX_ELEMENT', 16)
+
+    with pytest.raises(ValueError):
+        _iter('[1, "{}"]'.format('x' * 64))
+
+
+def test_results_store(tmpdir):
+    rekall_path = str(tmpdir.join('psaux.json'))
+    _write_json(rekall_path, [
+        ['m', {'plugin_name': 'psaux'}],
+        ['r', {
+            'pid': 1,
+            'ppid': 0,
+            'uid': 0,
+            'comm': 'systemd',
+            'cmdline': '/sbin/init'
+        }],
+        ['r', {
+            'pid': '0x2a',
+            'ppid': 1,
+            'uid': 1000,
+            'comm': 'nc',
+            'cmdline': 'nc -l 4444'
+        }]
+    ])
+
+    sockets_path = str(tmpdir.join('listening_ports.json'))
+    _write_json(sockets_path, [
+        {'pid': '42', 'name': 'nc', 'address': '0.0.0.0', 'port': '4444'}
+    ])
+
+    path = str(tmpdir.join(results.RESULTS_NAME))
+    store = results.ResultsStore(path, INSTANCE_ID)
+    store.add_rekall_output('psaux', rekall_path)
+    store.add_osquery_document(
+        'listening_ports',
+        sockets_path,
+        'sockets',
+        {'state': 'LISTEN'}
+    )
+
+    assert not os.path.exists(path)
+
+    counts = store.close()
+
+    assert counts['processes'] == 2
+    assert counts['sockets'] == 1
+    assert not os.path.exists(path + '.part')
+
+    assert _select(
+        path,
+        'SELECT pid, ppid, uid, name, cmdline FROM processes ORDER BY pid'
+    ) == [
+        (1, 0, 0, 'systemd', '/sbin/init'),
+        (42, 1, 1000, 'nc', 'nc -l 4444')
+    ]
+    assert _select(
+        path,
+        'SELECT source, pid, process, local_address, local_port, state '
+        'FROM sockets'
+    ) == [
+        ('listening_ports', 42, 'nc', '0.0.0.0', 4444, 'LISTEN')
+    ]
+    assert dict(_select(path, 'SELECT key, value FROM metadata'))[
+        'instance_id'] == INSTANCE_ID
+
+
+def test_build_results_skips_output_that_cannot_be_parsed(tmpdir):
+    _write_json(
+        str(tmpdir.join('netstat-{}-output.json'.format(INSTANCE_ID))),
+        [['r', {
+            'pid': 7,
+            'comm': 'sshd',
+            'local': '10.0.0.1:22',
+            'remote': '10.0.0.2:50000',
+            'state': 'ESTABLISHED'
+        }]]
+    )
+
+    tmpdir.join('pstree-{}-output.json'.format(INSTANCE_ID)).write('oops')
+
+    tmpdir.join('capture.aff4').write('not output')
+
+    path = results.build_results(INSTANCE_ID, str(tmpdir))
+
+    assert _select(path, 'SELECT source, pid, process, state FROM sockets') \
+        == [('netstat', 7, 'sshd', 'ESTABLISHED')]
+    assert _select(path, 'SELECT COUNT(*) FROM processes') == [(0,)]
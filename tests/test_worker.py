@@ -0,0 +1,199 @@
+"""Tests for the queue worker of ssm_acquire.worker."""
+import json
+import threading
+import time
+
+from concurrent.futures import Future
+
+import pytest
+
+from ssm_acquire import worker
+
+
+INSTANCE_A = 'i-0000000000000000a'
+INSTANCE_B = 'i-0000000000000000b'
+INSTANCE_C = 'i-0000000000000000c'
+INSTANCE_D = 'i-0000000000000000d'
+
+
+@pytest.fixture(autouse=True)
+def short_polls(monkeypatch):
+    monkeypatch.setattr(worker, '_SHORT_POLL', 0.01)
+    monkeypatch.setattr(worker, '_LONG_POLL', 0.01)
+
+
+class _Executor(object):
+    """Records the jobs it is given and never runs them."""
+    def __init__(self):
+        self.jobs = []
+
+    def submit(self, func, job):
+        self.jobs.append(job)
+        return Future()
+
+
+def _message(instance_id, account_id):
+    return json.dumps({'instance_id': instance_id, 'account_id': account_id})
+
+
+def _get_worker(run_job=None, **kwargs):
+    kwargs.setdefault('concurrency', 10)
+    kwargs.setdefault('account_concurrency', 2)
+    kwargs.setdefault('dedupe_window', 3600)
+
+    return worker.Worker(
+        worker.LocalQueue(),
+        run_job or (lambda job: {'acquire': 'Success'}),
+        'us-east-1',
+        **kwargs
+    )
+
+
+def test_parse_message_instance_id():
+    assert worker.parse_message(' {}\n'.format(INSTANCE_A)) == \
+        (INSTANCE_A, None, None)
+
+
+def test_parse_message_guardduty_finding():
+    event = {
+        'account': '111111111111',
+        'region': 'eu-west-1',
+        'detail': {
+            'accountId': '222222222222',
+            'region': 'eu-west-1',
+            'resource': {'instanceDetails': {'instanceId': INSTANCE_A}}
+        }
+    }
+
+    assert worker.parse_message(json.dumps(event)) == \
+        (INSTANCE_A, '222222222222', 'eu-west-1')
+
+
+@pytest.mark.parametrize('body', ['not json', '{"detail": {}}'])
+def test_parse_message_without_instance(body):
+    with pytest.raises(ValueError):
+        worker.parse_message(body)
+
+
+def test_duplicate_messages_are_handled_once():
+    handled = []
+
+    def run_job(job):
+        handled.append(job.instance_id)
+        return {'acquire': 'Success'}
+
+    instance_worker = _get_worker(run_job)
+
+    for _ in range(3):
+        instance_worker.queue.put(INSTANCE_A)
+
+    results = instance_worker.run(exit_when_idle=True)
+
+    assert handled == [INSTANCE_A]
+    assert results == {INSTANCE_A: {'acquire': 'Success'}}
+
+
+def test_messages_within_the_dedupe_window_are_dropped():
+    instance_worker = _get_worker()
+    instance_worker.accepted[INSTANCE_A] = time.time() - 10
+    instance_worker.accepted[INSTANCE_B] = time.time() - 7200
+
+    instance_worker.queue.put(INSTANCE_A)
+    instance_worker.queue.put(INSTANCE_B)
+
+    assert list(instance_worker.run(exit_when_idle=True)) == [INSTANCE_B]
+
+
+def test_failed_instances_are_not_deduped():
+    instance_worker = _get_worker(lambda job: {'acquire': 'Failed'})
+    instance_worker.queue.put(INSTANCE_A)
+
+    instance_worker.run(exit_when_idle=True)
+
+    assert INSTANCE_A not in instance_worker.accepted
+
+
+def test_dispatch_honours_the_account_limit():
+    instance_worker = _get_worker(account_concurrency=2)
+
+    for instance_id, account_id in [
+        (INSTANCE_A, 'a'),
+        (INSTANCE_B, 'a'),
+        (INSTANCE_C, 'a'),
+        (INSTANCE_D, 'b')
+    ]:
+        instance_worker.queue.put(_message(instance_id, account_id))
+
+    for message in instance_worker.queue.receive(10, 0):
+        instance_worker._accept(message)
+
+    executor = _Executor()
+    instance_worker._dispatch(executor)
+
+    # The third job of account a waits; the job of account b does not.
+    assert [job.instance_id for job in executor.jobs] == \
+        [INSTANCE_A, INSTANCE_B, INSTANCE_D]
+    assert [job.instance_id for job in instance_worker.pending] == \
+        [INSTANCE_C]
+
+    # It is blocked by its account, so it leaves room to receive others.
+    assert instance_worker._count_startable() == 0
+
+
+def test_dispatch_honours_the_total_limit():
+    instance_worker = _get_worker(concurrency=2, account_concurrency=2)
+
+    for instance_id, account_id in [
+        (INSTANCE_A, 'a'),
+        (INSTANCE_B, 'b'),
+        (INSTANCE_C, 'c')
+    ]:
+        instance_worker.queue.put(_message(instance_id, account_id))
+
+    for message in instance_worker.queue.receive(10, 0):
+        instance_worker._accept(message)
+
+    executor = _Executor()
+    instance_worker._dispatch(executor)
+
+    assert [job.instance_id for job in executor.jobs] == \
+        [INSTANCE_A, INSTANCE_B]
+    assert instance_worker._count_startable() == 1
+
+
+def test_run_never_exceeds_the_account_limit():
+    lock = threading.Lock()
+    running = {}
+    most = {}
+
+    def run_job(job):
+        with lock:
+            running[job.account_id] = running.get(job.account_id, 0) + 1
+            most[job.account_id] = max(
+                most.get(job.account_id, 0),
+                running[job.account_id]
+            )
+
+        time.sleep(0.05)
+
+        with lock:
+            running[job.account_id] -= 1
+
+        return {'acquire': 'Success'}
+
+    instance_worker = _get_worker(
+        run_job,
+        concurrency=4,
+        account_concurrency=2
+    )
+
+    for index in range(8):
+        instance_worker.queue.put(_message(
+            'i-{:017x}'.format(index),
+            'a' if index < 6 else 'b'
+        ))
+
+    results = instance_worker.run(exit_when_idle=True)
+
+    assert len(results) == 8
+    assert most == {'a': 2, 'b': 2}